@@ -15,6 +15,7 @@ from instamatic.camera import Camera
 from instamatic.exceptions import TEMControllerError
 from instamatic.formats import write_tiff
 from instamatic.image_utils import rotate_image
+from instamatic.utils.instrumentation import track
 
 
 _ctrl = None  # store reference of ctrl so it can be accessed without re-initializing
@@ -178,6 +179,14 @@ class TEMController:
             This function is run after the last acquisition item has run.
         backlash: bool
         Move the stage with backlash correction.
+        optimize_route: bool
+            Reorder the items to minimize the estimated stage time, the items keep
+            their index in `nav_items`.
+        process: callable, list of callables
+            Post-processing functions, run on worker threads while the stage moves
+            on to the next item. They take an `ItemResult` as their argument.
+        write: callable, list of callables
+            Functions to write the `ItemResult` after processing, called in order.
         """
         from instamatic.acquire_at_items import AcquireAtItems
 
@@ -200,6 +209,8 @@ class TEMController:
                     `acquire`
                     `pre_acquire`
                     `post_acquire`
+                Optionally, `process` and `write` functions can be defined to run
+                the post-processing in pipelined mode (see `acquire_at_items`).
 
         backlash: bool
             Toggle to move to each position with backlash correction
@@ -218,12 +229,16 @@ class TEMController:
 
         pre_acquire = getattr(acquire, 'pre_acquire', None)
         post_acquire = getattr(acquire, 'post_acquire', None)
+        process = getattr(acquire, 'process', None)
+        write = getattr(acquire, 'write', None)
         acquire = getattr(acquire, 'acquire', None)
 
         self.acquire_at_items(nav_items,
                               acquire=acquire,
                               pre_acquire=pre_acquire,
                               post_acquire=post_acquire,
+                              process=process,
+                              write=write,
                               backlash=backlash)
 
     def run_script(self, script: str, verbose: bool = True) -> None:
@@ -466,12 +481,13 @@ class TEMController:
         if 'all' in keys or not keys:
             keys = funcs.keys()
 
-        for key in keys:
-            try:
-                dct[key] = funcs[key]()
-            except ValueError:
-                # print(f"No such key: `{key}`")
-                pass
+        with track('TEMController.to_dict'):
+            for key in keys:
+                try:
+                    dct[key] = funcs[key]()
+                except ValueError:
+                    # print(f"No such key: `{key}`")
+                    pass
 
         return dct
 
@@ -634,7 +650,8 @@ class TEMController:
 
         h['ImageGetTimeStart'] = time.perf_counter()
 
-        arr = self.get_rotated_image(exposure=exposure, binsize=binsize)
+        with track('TEMController.get_rotated_image'):
+            arr = self.get_rotated_image(exposure=exposure, binsize=binsize)
 
         h['ImageGetTimeEnd'] = time.perf_counter()
 
@@ -1,4 +1,6 @@
 from instamatic import config
+from instamatic.utils.instrumentation import instrument
+from instamatic.utils.recording import record
 
 default_tem_interface = config.microscope.interface
 
@@ -23,6 +25,8 @@ def get_tem(interface: str):
         from .fei_microscope import FEIMicroscope as cls
     elif interface == 'fei_simu':
         from .fei_simu_microscope import FEISimuMicroscope as cls
+    elif interface == 'replay':
+        from .replay_microscope import ReplayMicroscope as cls
     else:
         raise ValueError(f'No such microscope interface: `{interface}`')
 
@@ -33,7 +37,7 @@ def Microscope(name: str = None, use_server: bool = False):
     """Generic class to load microscope interface class.
 
     name: str
-        Specify which microscope to use, must be one of `jeol`, `fei_simu`, `simulate`
+        Specify which microscope to use, must be one of `jeol`, `fei`, `fei_simu`, `simulate`, `replay`
     use_server: bool
         Connect to microscope server running on the host/port defined in the config file
 
@@ -56,4 +60,6 @@ def Microscope(name: str = None, use_server: bool = False):
         cls = get_tem(interface)
         tem = cls(name=name)
 
-    return tem
+    tem = record(tem, target='tem')
+
+    return instrument(tem)
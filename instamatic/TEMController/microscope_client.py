@@ -1,5 +1,4 @@
 import atexit
-import datetime
 import json
 import pickle
 import socket
@@ -13,6 +12,7 @@ from instamatic.exceptions import exception_list
 from instamatic.exceptions import TEMCommunicationError
 from instamatic.server.serializer import dumper
 from instamatic.server.serializer import loader
+from instamatic.utils.telemetry import TelemetrySampler
 
 
 HOST = config.settings.tem_server_host
@@ -49,6 +49,7 @@ class MicroscopeClient:
 
         self.name = name
         self._bufsize = BUFSIZE
+        self._lock = threading.Lock()
 
         try:
             self.connect()
@@ -94,11 +95,14 @@ class MicroscopeClient:
         return wrapper
 
     def _eval_dct(self, dct):
-        """Takes approximately 0.2-0.3 ms per call if HOST=='localhost'."""
+        """Takes approximately 0.2-0.3 ms per call if HOST=='localhost'.
 
-        self.s.send(dumper(dct))
-
-        response = self.s.recv(self._bufsize)
+        The lock makes sure requests/responses from different threads
+        (i.e. a telemetry sampler) do not interleave on the socket.
+        """
+        with self._lock:
+            self.s.send(dumper(dct))
+            response = self.s.recv(self._bufsize)
 
         if response:
             status, data = loader(response)
@@ -132,6 +136,9 @@ class MicroscopeClient:
 class TraceVariable:
     """Simple class to trace a variable over time.
 
+    Thin wrapper around `instamatic.utils.telemetry.TelemetrySampler`, use
+    that class directly to sample multiple variables or stream to a file.
+
     Usage:
         t = TraceVariable(ctrl.stage.get, verbose=True)
         t.start()
@@ -152,28 +159,22 @@ class TraceVariable:
         self.interval = interval
         self.verbose = verbose
 
-        self._traced = []
+        self._sampler = TelemetrySampler({name: func},
+                                         rate=1.0 / interval,
+                                         callback=self._print if verbose else None)
+
+    def _print(self, sample):
+        print(f'{sample["t"]:10.3f} | Trace {self.name}: {sample[self.name]}')
 
     def start(self):
         print(f'Trace started: {self.name}')
-        self.update()
+        self._sampler.start()
 
-    def stop(self):
-        self._timer.cancel()
+    def stop(self) -> list:
+        """Stop the trace and return a list of `(time, value)` tuples, the
+        time is in seconds since the start of the trace."""
+        data = self._sampler.stop()
 
         print(f'Trace canceled: {self.name}')
 
-        return self._traced
-
-    def update(self):
-        ret = self.func()
-
-        now = datetime.datetime.now().strftime('%H:%M:%S.%f')
-
-        if self.verbose:
-            print(f'{now} | Trace {self.name}: {ret}')
-
-        self._traced.append((now, ret))
-
-        self._timer = threading.Timer(self.interval, self.update)
-        self._timer.start()
+        return list(zip(data['t'].tolist(), data[self.name].tolist()))
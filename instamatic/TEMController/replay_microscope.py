@@ -0,0 +1,48 @@
+from instamatic import config
+from instamatic.utils.recording import SessionReplay
+
+
+class ReplayMicroscope:
+    """Plays back the microscope calls from a recorded session (see
+    `instamatic.utils.recording`).
+
+    Each method returns the recorded return values in order, regardless of
+    the arguments it is called with. The session log is taken from
+    `config.settings.session_replay` unless `fn` is given. If `realtime` is
+    True, every call takes as long as it did in the original session,
+    otherwise the session is played back as fast as possible.
+    """
+
+    def __init__(self, name: str = 'replay', fn: str = None, realtime: bool = None):
+        super().__init__()
+
+        if fn is None:
+            fn = config.settings.session_replay
+        if not fn:
+            raise ValueError('No session log defined for replay (`session_replay` in settings.yaml)')
+        if realtime is None:
+            realtime = config.settings.session_replay_realtime
+
+        self.name = name
+        self._replay = SessionReplay(fn, target='tem', realtime=realtime)
+
+    def __getattr__(self, attr_name):
+        if attr_name.startswith('_') or attr_name not in self._replay:
+            raise AttributeError(f'`{self.__class__.__name__}` object has no attribute `{attr_name}`')
+
+        if self._replay.is_attribute(attr_name):
+            return self._replay.call(attr_name)
+
+        def replay(*args, **kwargs):
+            return self._replay.call(attr_name)
+
+        replay.__name__ = attr_name
+        return replay
+
+    def __dir__(self):
+        return list(self._replay.queues.keys())
+
+    def _set_instant_stage_movement(self):
+        """For compatibility with `SimuMicroscope`, replay timing is set by
+        `realtime`"""
+        pass
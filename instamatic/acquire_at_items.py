@@ -1,8 +1,127 @@
+import concurrent.futures
+import queue
+import threading
+import time
 from collections import defaultdict
 
 import numpy as np
 from tqdm.auto import tqdm
 
+from instamatic.utils.stage_route import plan_route
+from instamatic.utils.stage_route import StageCostModel
+
+STAGES = ('move', 'acquire', 'wait', 'process', 'write')
+
+
+class ItemResult:
+    """Data and timings of the acquisition at a single item.
+
+    i: int
+        Index of the item in `nav_items`
+    item: NavItem or tuple
+        The item itself
+    raw: dict
+        Return values of the `acquire` functions by function name, released
+        once the item has been written in the pipelined mode, and right
+        after the acquisition otherwise, so the run is not held in memory
+    data: dict
+        Return values of the `process` functions by function name
+    timings: dict
+        Time in seconds spent in each stage (`move`, `acquire`, `wait`,
+        `process`, `write`), where `wait` is the time the acquisition was
+        blocked because too many items were still being processed
+    error: Exception
+        Error raised while processing or writing the item, or None
+    """
+
+    def __init__(self, i: int, item):
+        super().__init__()
+        self.i = i
+        self.item = item
+        self.raw = {}
+        self.data = {}
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        self.error = None
+
+    def __repr__(self):
+        timings = ', '.join(f'{stage}={t:.2f}' for stage, t in self.timings.items())
+        return f'{self.__class__.__name__}(i={self.i}, {timings}, error={self.error!r})'
+
+
+class _Pipeline:
+    """Runs the `process` functions on a pool of worker threads and the
+    `write` functions on a single writer thread. Items are written and
+    collected in the order they were submitted. At most `max_pending`
+    items are in flight, `submit` blocks until a slot is free."""
+
+    def __init__(self, process: list, write: list, workers: int, max_pending: int, results: list):
+        super().__init__()
+        self.process = process
+        self.write = write
+        self.results = results
+        self.error = None
+
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._queue = queue.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._writer = threading.Thread(target=self._run_writer, name='AcquireAtItems', daemon=True)
+        self._writer.start()
+
+    def check(self) -> None:
+        """Raise the first error from the processing or writing stage."""
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, result: ItemResult) -> None:
+        self.check()
+        t0 = time.perf_counter()
+        self._slots.acquire()
+        result.timings['wait'] = time.perf_counter() - t0
+        try:
+            future = self._executor.submit(self._run_process, result)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._queue.put((result, future))
+
+    def _run_process(self, result: ItemResult) -> None:
+        t0 = time.perf_counter()
+        try:
+            for func in self.process:
+                result.data[func.__name__] = func(result)
+        except Exception as e:
+            result.error = e
+        result.timings['process'] = time.perf_counter() - t0
+
+    def _run_writer(self) -> None:
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            result, future = task
+            future.result()
+
+            if result.error is None:
+                t0 = time.perf_counter()
+                try:
+                    for func in self.write:
+                        func(result)
+                except Exception as e:
+                    result.error = e
+                result.timings['write'] = time.perf_counter() - t0
+
+            if result.error is not None and self.error is None:
+                self.error = result.error
+            result.raw = {}
+            self.results.append(result)
+            self._slots.release()
+
+    def join(self) -> None:
+        """Wait until all submitted items have been written."""
+        self._queue.put(None)
+        self._writer.join()
+        self._executor.shutdown(wait=True)
+
 
 class AcquireAtItems:
     """Class to automated acquisition at many stage locations. The acquisition
@@ -29,7 +148,32 @@ class AcquireAtItems:
         e.g. every_n={2: every_2nd, 3: every_3rd}. These will be called in
         sequence _after_ the main acquisition function.
     backlash: bool
-        Move the stage with backlash correction.
+        Move the stage with backlash correction. The correction is skipped
+        if the stage already approaches the target from the right
+        direction.
+    optimize_route: bool
+        Reorder the items to minimize the estimated stage time (see
+        `instamatic.utils.stage_route`), the items keep their index in
+        `nav_items` (see `start`)
+    cost_model: StageCostModel
+        Model to estimate the stage time, uses the default if None
+    process: callable, list of callables
+        Post-processing functions. If given (or `write`), the acquisition
+        runs in pipelined mode: the stage moves to the next item while the
+        previous items are processed on a pool of worker threads. The
+        functions take an `ItemResult` as their argument, where
+        `result.raw` holds the return values of the `acquire` functions,
+        and must not use `ctrl`. Their return values are stored in
+        `result.data`.
+    write: callable, list of callables
+        Functions to write the results in pipelined mode, called with the
+        `ItemResult` after processing, one item at a time and in the order
+        of acquisition.
+    workers: int
+        Number of worker threads for the `process` functions
+    max_pending: int
+        Maximum number of items being processed or written, the
+        acquisition waits for the workers if they fall this far behind
 
     Returns
     -------
@@ -43,7 +187,13 @@ class AcquireAtItems:
                  pre_acquire=None,
                  post_acquire=None,
                  every_n: dict = {},
-                 backlash: bool = True):
+                 backlash: bool = True,
+                 optimize_route: bool = False,
+                 cost_model: StageCostModel = None,
+                 process=None,
+                 write=None,
+                 workers: int = 2,
+                 max_pending: int = 4):
         super().__init__()
 
         self.nav_items = nav_items
@@ -69,11 +219,30 @@ class AcquireAtItems:
             print(f'Post-acquire:', ', '.join([func.__name__ for func in self._post_acquire]))
 
         self.backlash = backlash
+        self.optimize_route = optimize_route
+        self.cost_model = cost_model or StageCostModel(backlash=backlash)
+        self.route = None
+        self._last_xy = None
+
+        if process:
+            self._process = self.validate(process)
+            print('Process:', ', '.join([func.__name__ for func in self._process]))
+
+        if write:
+            self._write = self.validate(write)
+            print('Write:', ', '.join([func.__name__ for func in self._write]))
+
+        self.pipelined = bool(process or write)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.results = []
 
     # blank placeholders
     _acquire = ()
     _pre_acquire = ()
     _post_acquire = ()
+    _process = ()
+    _write = ()
 
     def validate(self, funcs):
         """`func` can be a callable or a list of callables."""
@@ -95,19 +264,28 @@ class AcquireAtItems:
         for func in self._post_acquire:
             func(ctrl)
 
-    def acquire(self, ctrl, i: int = 1):
+    def acquire(self, ctrl, i: int = 1) -> dict:
         """Handler to call functions at each stage position/NavItem (or at
-        specific intervals)."""
+        specific intervals).
+
+        Returns the return values of the functions by function name.
+        """
+        ret = {}
+        if not self._acquire:
+            return ret
         r = self._acquire_intervals
         tasks = r[(i + 1) % r == 0]
         for interval in tasks:
             funcs = self._acquire[interval]
             for func in funcs:
                 # print(f" >> {interval}: {func.__name__}")
-                func(ctrl)
+                ret[func.__name__] = func(ctrl)
+        return ret
 
-    def move_to_item(self, item):
-        """Move the stage to the stage coordinates given by the NavItem."""
+    @staticmethod
+    def get_coordinates(item) -> tuple:
+        """Return the stage coordinates (x, y, z) in nm of the NavItem or
+        coordinate tuple, z is None if not given."""
         try:
             x = item.stage_x * 1000  # um -> nm
             y = item.stage_y * 1000  # um -> nm
@@ -120,16 +298,50 @@ class AcquireAtItems:
                 x, y, z = item
             else:
                 raise IndexError(f'Coordinate must have 2 (x, y) or 3 (x, y, z) elements: {item}')
+        return x, y, z
+
+    # nm, maximum distance from the last position to skip the backlash correction
+    backlash_tolerance = 500
+
+    def needs_backlash_correction(self, x: float, y: float) -> bool:
+        """Return True unless the stage is still at the position of the last
+        move, and target `x`, `y` is reached by moving in the positive x and
+        y direction, i.e. from the same direction as the backlash
+        correction."""
+        if self._last_xy is None:
+            return True
+        current = np.array(self.ctrl.stage.xy)
+        if np.any(np.abs(current - self._last_xy) > self.backlash_tolerance):
+            return True  # moved in between, the approach direction is unknown
+        return x < current[0] or y < current[1]
+
+    def move_to_item(self, item):
+        """Move the stage to the stage coordinates given by the NavItem."""
+        x, y, z = self.get_coordinates(item)
 
         if z is not None:
             self.ctrl.stage.set(z=z)
 
-        if self.backlash:
+        if self.backlash and self.needs_backlash_correction(x, y):
             set_xy = self.ctrl.stage.set_xy_with_backlash_correction
         else:
             set_xy = self.ctrl.stage.set
 
         set_xy(x=x, y=y)
+        self._last_xy = np.array((x, y))
+
+    def plan_route(self, nav_items: list) -> list:
+        """Reorder `nav_items` to minimize the estimated stage time from the
+        current stage position, the route is stored in `self.route`."""
+        coords = [self.get_coordinates(item) for item in nav_items]
+        if any(z is None for x, y, z in coords):
+            coords = [(x, y) for x, y, z in coords]
+
+        x, y, z, a, b = self.ctrl.stage.get()
+        self.route = route = plan_route(coords, model=self.cost_model, start=(x, y, z))
+        print(route)
+
+        return [nav_items[i] for i in route.order]
 
     def start(self, start_index: int = 0):
         """Start serial acquisition protocol.
@@ -137,13 +349,18 @@ class AcquireAtItems:
         Parameters
         ----------
         start_index : int
-            Start acquisition from this item.
+            Start acquisition from this item, counted in the order of
+            `nav_items` (e.g. the nav file), also with `optimize_route`.
+            `ctrl.current_i`, `ItemResult.i`, and the `every_n` intervals
+            always refer to the index in `nav_items`.
         """
-        import time
-        import msvcrt
-
         ctrl = self.ctrl
         nav_items = self.nav_items[start_index:]
+        indices = list(range(start_index, start_index + len(nav_items)))
+
+        if self.optimize_route:
+            nav_items = self.plan_route(nav_items)
+            indices = [indices[j] for j in self.route.order]
 
         ntot = len(nav_items)
 
@@ -153,29 +370,69 @@ class AcquireAtItems:
         self.move_to_item(nav_items[0])  # pre-move
         self.pre_acquire(ctrl)
 
+        self.results = []
+        if self.pipelined:
+            pipeline = _Pipeline(self._process, self._write, workers=self.workers,
+                                 max_pending=self.max_pending, results=self.results)
+
         t0 = time.perf_counter()
 
-        for i, item in enumerate(tqdm(nav_items)):
+        n_items = 0
+        for i, item in zip(indices, tqdm(nav_items)):
             # Run script in try/except block so that Keyboard interrupt
             # will safely break out of the loop
             try:
-                i += start_index
+                n_items += 1
                 ctrl.current_item = item
                 ctrl.current_i = i
 
+                result = ItemResult(i, item)
+
+                t = time.perf_counter()
                 self.move_to_item(item)
-                self.acquire(ctrl, i=i)
+                result.timings['move'] = time.perf_counter() - t
+
+                t = time.perf_counter()
+                result.raw = self.acquire(ctrl, i=i)
+                result.timings['acquire'] = time.perf_counter() - t
+
+                if self.pipelined:
+                    pipeline.submit(result)
+                else:
+                    result.raw = {}
+                    self.results.append(result)
 
             except (Exception, KeyboardInterrupt) as e:
                 print(repr(e.with_traceback(None)))
                 print(f'\nAcquisition was interrupted during item `{item}`!')
                 break
 
+        if self.pipelined:
+            pipeline.join()
+            errors = [result for result in self.results if result.error is not None]
+            for result in errors:
+                print(f'Processing failed for item `{result.item}`: {result.error!r}')
+
         t1 = time.perf_counter()
 
         self.post_acquire(ctrl)
 
         dt = t1 - t0
-        n_items = i + 1
         print(f'Total time taken: {dt:.0f} s for {n_items} items ({dt/n_items:.2f} s/item)')
+        print(self.timing_summary())
         print('\nAll done!')
+
+    @property
+    def timings(self) -> np.ndarray:
+        """Per-item timings as a structured array with the item index `i`
+        and the time in seconds spent in each stage."""
+        dtype = [('i', int)] + [(stage, float) for stage in STAGES]
+        return np.array([(result.i, *result.timings.values()) for result in self.results], dtype=dtype)
+
+    def timing_summary(self) -> str:
+        """Mean time per item spent in each stage."""
+        timings = self.timings
+        if not len(timings):
+            return 'No items acquired.'
+        stages = STAGES if self.pipelined else STAGES[:2]
+        return 'Time per item: ' + ' | '.join(f'{stage} {timings[stage].mean():.2f} s' for stage in stages)
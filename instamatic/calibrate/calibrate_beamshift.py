@@ -3,16 +3,13 @@ import os
 import pickle
 import sys
 
-import matplotlib.pyplot as plt
 import numpy as np
-from skimage.registration import phase_cross_correlation
 
 from .filenames import *
 from .fit import fit_affine_transformation
 from instamatic import config
 from instamatic.image_utils import autoscale
 from instamatic.image_utils import imgscale
-from instamatic.processing.find_holes import find_holes
 from instamatic.tools import find_beam_center
 from instamatic.tools import printer
 logger = logging.getLogger(__name__)
@@ -81,6 +78,7 @@ class CalibBeamShift:
         pickle.dump(self, open(fout, 'wb'))
 
     def plot(self, to_file=None, outdir=''):
+        import matplotlib.pyplot as plt
         if not self.has_data:
             return
 
@@ -133,6 +131,7 @@ def calibrate_beamshift_live(ctrl, gridsize=None, stepsize=None, save_images=Fal
     return:
         instance of Calibration class with conversion methods
     """
+    from skimage.registration import phase_cross_correlation
 
     exposure = kwargs.get('exposure', ctrl.cam.default_exposure)
     binsize = kwargs.get('binsize', ctrl.cam.default_binsize)
@@ -215,6 +214,10 @@ def calibrate_beamshift_from_image_fn(center_fn, other_fn):
     return:
         instance of Calibration class with conversion methods
     """
+    from skimage.registration import phase_cross_correlation
+
+    from instamatic.processing.find_holes import find_holes
+
     print()
     print('Center:', center_fn)
 
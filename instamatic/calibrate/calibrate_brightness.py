@@ -2,12 +2,10 @@ import logging
 import pickle
 import sys
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 from .filenames import *
 from instamatic.image_utils import autoscale
-from instamatic.processing.find_holes import find_holes
 from instamatic.tools import find_beam_center
 logger = logging.getLogger(__name__)
 
@@ -56,6 +54,7 @@ class CalibBrightness:
         pickle.dump(self, open(fn, 'wb'))
 
     def plot(self):
+        import matplotlib.pyplot as plt
         if not self.has_data:
             pass
 
@@ -88,6 +87,7 @@ def calibrate_brightness_live(ctrl, step=1000, save_images=False, **kwargs):
     return:
         instance of CalibBrightness class with conversion methods
     """
+    from instamatic.processing.find_holes import find_holes
 
     raise NotImplementedError('calibrate_brightness_live function needs fixing...')
 
@@ -140,6 +140,7 @@ def calibrate_brightness_from_image_fn(fns):
     return:
         instance of Calibration class with conversion methods
     """
+    from instamatic.processing.find_holes import find_holes
 
     values = []
 
@@ -3,9 +3,7 @@ import os
 import pickle
 import sys
 
-import matplotlib.pyplot as plt
 import numpy as np
-from skimage.registration import phase_cross_correlation
 
 from .filenames import *
 from .fit import fit_affine_transformation
@@ -156,6 +154,7 @@ class CalibDirectBeam:
         self._dct[key] = dct
 
     def plot(self, key, to_file=None, outdir=''):
+        import matplotlib.pyplot as plt
         data_shifts = self._dct[key]['data_shifts']   # pixelshifts
         data_readout = self._dct[key]['data_readout']  # microscope readout
 
@@ -195,6 +194,7 @@ def calibrate_directbeam_live(ctrl, key='DiffShift', gridsize=None, stepsize=Non
     return:
         instance of Calibration class with conversion methods
     """
+    from skimage.registration import phase_cross_correlation
 
     if ctrl.mode != 'diff':
         print(' >> Switching to diffraction mode')
@@ -262,6 +262,7 @@ def calibrate_directbeam_live(ctrl, key='DiffShift', gridsize=None, stepsize=Non
 
 
 def calibrate_directbeam_from_file(center_fn, other_fn, key='DiffShift'):
+    from skimage.registration import phase_cross_correlation
     print()
     print('Center:', center_fn)
 
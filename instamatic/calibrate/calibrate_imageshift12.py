@@ -1,7 +1,6 @@
 import logging
 
 import numpy as np
-from skimage.registration import phase_cross_correlation
 from tqdm.auto import tqdm
 
 from instamatic.calibrate.fit import fit_affine_transformation
@@ -9,6 +8,7 @@ logger = logging.getLogger(__name__)
 
 
 def Calibrate_Imageshift(ctrl, diff_defocus, stepsize, logger, key='IS1'):
+    from skimage.registration import phase_cross_correlation
 
     if key != 'S':
         input(f"""Calibrate {key}
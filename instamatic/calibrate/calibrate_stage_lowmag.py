@@ -2,9 +2,7 @@ import logging
 import pickle
 import sys
 
-import matplotlib.pyplot as plt
 import numpy as np
-from skimage.registration import phase_cross_correlation
 
 from .filenames import *
 from .fit import fit_affine_transformation
@@ -189,6 +187,7 @@ class CalibStage:
         pickle.dump(self, open(fn, 'wb'))
 
     def plot(self):
+        import matplotlib.pyplot as plt
         if not self.has_data:
             return
 
@@ -225,6 +224,7 @@ def calibrate_stage_lowmag_live(ctrl, gridsize=5, stepsize=50000, save_images=Fa
     return:
         instance of Calibration class with conversion methods
     """
+    from skimage.registration import phase_cross_correlation
 
     exposure = kwargs.get('exposure', ctrl.cam.default_exposure)
     binsize = kwargs.get('binsize', ctrl.cam.default_binsize)
@@ -307,6 +307,7 @@ def calibrate_stage_lowmag_from_image_fn(center_fn, other_fn):
     return:
         instance of Calibration class with conversion methods
     """
+    from skimage.registration import phase_cross_correlation
     img_cent, h_cent = read_image(center_fn)
 
     img_cent, scale = autoscale(img_cent, maxdim=512)
@@ -3,7 +3,6 @@ import sys
 import time
 
 import numpy as np
-from skimage.registration import phase_cross_correlation
 
 from .calibrate_stage_lowmag import CalibStage
 from .filenames import *
@@ -59,6 +58,7 @@ def calibrate_mag1_live(ctrl, gridsize=5, stepsize=5000, minimize_backlash=True,
     return:
         instance of Calibration class with conversion methods
     """
+    from skimage.registration import phase_cross_correlation
 
     work_drc = get_new_work_subdirectory(stem='calib_mag1')
 
@@ -184,6 +184,7 @@ def calibrate_mag1_from_image_fn(center_fn, other_fn):
     return:
         instance of Calibration class with conversion methods
     """
+    from skimage.registration import phase_cross_correlation
     img_cent, h_cent = read_image(center_fn)
 
     # binsize = h_cent["ImageBinsize"]
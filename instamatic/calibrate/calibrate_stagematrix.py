@@ -1,10 +1,8 @@
 from pathlib import Path
 
-import matplotlib.pyplot as plt
 import numpy as np
 import yaml
 from scipy import stats
-from skimage.registration import phase_cross_correlation
 
 from instamatic import config
 from instamatic.calibrate.fit import fit_affine_transformation
@@ -40,6 +38,7 @@ def get_outlier_filter(data, threshold: float = 2.0) -> list:
 
 def cross_correlate_image_pairs(pairs: tuple) -> list:
     """Cross correlate image pairs."""
+    from skimage.registration import phase_cross_correlation
     translations = []
     for img0, img1 in pairs:
         translation, error, phasediff = phase_cross_correlation(img0, img1, upsample_factor=10)
@@ -102,6 +101,7 @@ def calibrate_stage_from_file(drc: str, plot: bool = False):
     t = fit_result.t
 
     if plot:
+        import matplotlib.pyplot as plt
         r_i = np.linalg.inv(r)
         translations_ = np.dot(stage_shifts, r_i)
 
@@ -225,6 +225,7 @@ def calibrate_stage_from_stageshifts(ctrl,
         yaml.dump(d, open(drc / 'log.yaml', 'w'))
 
     if plot:
+        import matplotlib.pyplot as plt
         r_i = np.linalg.inv(r)
         translations_ = np.dot(stage_shifts, r_i)
 
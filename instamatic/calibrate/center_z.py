@@ -1,7 +1,6 @@
 import time
 
 import numpy as np
-from skimage.registration import phase_cross_correlation
 
 from instamatic.processing.find_crystals import find_crystals_timepix
 
@@ -33,6 +32,7 @@ def center_z_height(ctrl, verbose=False):
     Ultramicroscopy 46.1-4 (1992): 207-227.
     http://www.msg.ucsf.edu/agard/Publications/52-Koster.pdf
     """
+    from skimage.registration import phase_cross_correlation
     print('\033[k', 'Finding eucentric height...', end='\r')
     if ctrl.mode != 'mag1':
         ctrl.mode.set('mag1')
@@ -0,0 +1,245 @@
+"""Persistent map of the eucentric height over a grid.
+
+Finding the eucentric height (`center_z_height_HYMethod`) or recording
+the tracking offsets of a crystal takes many images and stage tilts.
+Over a grid, the height varies smoothly (tilt and bending of the grid),
+so `HeightMap` stores the heights and tracking offsets measured at
+stage x/y positions, and predicts them at new positions:
+
+- the height is fitted with a plane, and with a thin-plate spline
+  through the residuals once there are enough measurements and the
+  spline predicts the left-out measurements better than the plane
+- the uncertainty of the prediction is the standard error of the plane
+  fit (or the leave-one-out error of the spline), scaled by the
+  leverage of the position, so it grows away from the measurements
+- the tracking offsets (stage y versus angle, see `cred_tvips`) are the
+  distance-weighted average of the nearest measured tracks
+
+The expensive measurement only needs to run when `needs_measurement`
+is True, i.e. the uncertainty is above `max_uncertainty`. Every new
+measurement is added to the map, which is written to a YAML file, so
+that the map can be used again when the grid is loaded in a later
+session.
+
+Usage:
+    height_map = HeightMap.load('grid_01.yaml')
+    if height_map.needs_measurement(x, y):
+        center_z_height_HYMethod(ctrl)
+        height_map.add(*ctrl.stage.get()[:3])
+    else:
+        z, sigma = height_map.predict(x, y)
+        ctrl.stage.z = z
+"""
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from instamatic import config
+
+Prediction = namedtuple('Prediction', ['z', 'sigma'])
+
+
+class HeightMap:
+    """Measured eucentric heights and tracking offsets by stage position.
+
+    fn: str
+        YAML file to store the measurements in, the map is written after
+        every `add` if given
+    max_uncertainty: float
+        Measure the height if the uncertainty of the prediction (nm) is
+        larger than this
+    noise: float
+        Precision of a single height measurement (nm), lower limit of the
+        standard error of the fit
+    min_spline: int
+        Minimum number of measurements for the thin-plate spline
+    n_tracks: int
+        Number of nearest tracks to average for `predict_track`
+    """
+
+    def __init__(self,
+                 fn: str = None,
+                 max_uncertainty: float = 1000,
+                 noise: float = 250,
+                 min_spline: int = 8,
+                 n_tracks: int = 3,
+                 ):
+        super().__init__()
+        self.fn = Path(fn) if fn else None
+        self.max_uncertainty = max_uncertainty
+        self.noise = noise
+        self.min_spline = min_spline
+        self.n_tracks = n_tracks
+
+        self.records = []
+        self._fit = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(fn={str(self.fn)!r}, measurements={len(self)})'
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @classmethod
+    def load(cls, fn: str, **kwargs):
+        """Read the map from `fn`, an empty map is returned if the file does
+        not exist yet. Measurements are added to the same file."""
+        height_map = cls(fn, **kwargs)
+        if height_map.fn.exists():
+            d = yaml.safe_load(open(height_map.fn, 'r')) or {}
+            height_map.records = d.get('measurements', [])
+        return height_map
+
+    def save(self, fn: str = None) -> None:
+        """Write the map to `fn` (defaults to `self.fn`)."""
+        fn = Path(fn) if fn else self.fn
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        yaml.safe_dump({'measurements': self.records}, open(fn, 'w'), default_flow_style=None)
+
+    def add(self, x: float, y: float, z: float, angles=None, offsets=None) -> None:
+        """Add a height `z` measured at stage position `x`, `y` (nm).
+
+        `angles` (degrees) and `offsets` (nm) optionally give the tracking
+        offsets, i.e. the stage y position relative to `y` that keeps the
+        crystal centered at every angle.
+        """
+        record = {'x': float(x), 'y': float(y), 'z': float(z), 'time': time.time()}
+        if angles is not None:
+            order = np.argsort(angles)
+            record['angles'] = np.asarray(angles, dtype=float)[order].tolist()
+            record['offsets'] = np.asarray(offsets, dtype=float)[order].tolist()
+        self.records.append(record)
+        self._fit = None
+        if self.fn:
+            self.save()
+
+    @property
+    def xy(self) -> np.ndarray:
+        """Stage positions (nm) of the measurements"""
+        return np.array([(r['x'], r['y']) for r in self.records], dtype=float).reshape(-1, 2)
+
+    @property
+    def z(self) -> np.ndarray:
+        return np.array([r['z'] for r in self.records], dtype=float)
+
+    def _design(self, xy: np.ndarray) -> np.ndarray:
+        # plane in um relative to the mean position, for numerical stability
+        uv = (xy - self._fit['center']) / 1000
+        return np.column_stack((np.ones(len(uv)), uv))
+
+    def _spline(self, xy: np.ndarray, residuals: np.ndarray):
+        from scipy.interpolate import Rbf
+        u, v = (xy - self._fit['center']).T / 1000
+        return Rbf(u, v, residuals, function='thin_plate', smooth=1.0)
+
+    def fit(self) -> None:
+        """Fit the plane (and spline) to the measurements, this is done
+        automatically on the first prediction after a change."""
+        xy, z = self.xy, self.z
+        n = len(z)
+        self._fit = fit = {'center': xy.mean(axis=0) if n else np.zeros(2), 'spline': None}
+        if n < 4:
+            # the plane is not overdetermined, so its error is unknown
+            return
+
+        X = self._design(xy)
+        coef, *_ = np.linalg.lstsq(X, z, rcond=None)
+        residuals = z - X @ coef
+        fit['coef'] = coef
+        fit['cov'] = np.linalg.inv(X.T @ X)
+        fit['s'] = max(np.sqrt((residuals ** 2).sum() / (n - 3)), self.noise)
+
+        if n >= self.min_spline:
+            # leave-one-out error of plane + spline
+            errors = []
+            for i in range(n):
+                keep = np.arange(n) != i
+                c, *_ = np.linalg.lstsq(X[keep], z[keep], rcond=None)
+                spline = self._spline(xy[keep], z[keep] - X[keep] @ c)
+                u, v = (xy[i] - fit['center']) / 1000
+                errors.append(z[i] - X[i] @ c - spline(u, v))
+            s_spline = max(np.sqrt(np.mean(np.square(errors))), self.noise)
+            if s_spline < fit['s']:
+                fit['spline'] = self._spline(xy, residuals)
+                fit['s'] = s_spline
+
+    def predict(self, x: float, y: float) -> Prediction:
+        """Predict the height at stage position `x`, `y` (nm).
+
+        Returns the height and its uncertainty (standard error, nm). The
+        uncertainty is infinite if there are fewer than 4 measurements.
+        """
+        if self._fit is None:
+            self.fit()
+        fit = self._fit
+        z = self.z
+        if 'coef' not in fit:
+            return Prediction(float(z.mean()) if len(z) else np.nan, np.inf)
+
+        X = self._design(np.array([[x, y]], dtype=float))[0]
+        z_pred = X @ fit['coef']
+        if fit['spline'] is not None:
+            u, v = (np.array((x, y)) - fit['center']) / 1000
+            z_pred += fit['spline'](u, v)
+        sigma = fit['s'] * np.sqrt(1 + X @ fit['cov'] @ X)
+        return Prediction(float(z_pred), float(sigma))
+
+    def needs_measurement(self, x: float, y: float) -> bool:
+        """Whether the height at `x`, `y` must be measured, because the
+        uncertainty of the prediction is above `max_uncertainty`."""
+        return self.predict(x, y).sigma > self.max_uncertainty
+
+    def predict_track(self, x: float, y: float, angles) -> np.ndarray:
+        """Predict the tracking offsets (nm) at `angles` for a crystal at
+        `x`, `y` from the nearest measured tracks (inverse distance
+        weighted). Returns None if there are no tracks."""
+        tracks = [r for r in self.records if 'angles' in r]
+        if not tracks:
+            return None
+        dist = np.array([np.hypot(r['x'] - x, r['y'] - y) for r in tracks])
+        nearest = np.argsort(dist)[:self.n_tracks]
+        weights = 1 / (dist[nearest] + 1000)  # nm, avoids division by zero
+
+        angles = np.asarray(angles, dtype=float)
+        offsets = np.array([np.interp(angles, tracks[i]['angles'], tracks[i]['offsets']) for i in nearest])
+        return weights @ offsets / weights.sum()
+
+    def write_track_file(self, fn: str, x: float, y: float, angle_min: float, angle_max: float, step: float = 1.0) -> Path:
+        """Write a tracking file for a crystal at `x`, `y` in the format
+        read by `cred_tvips.Experiment.load_tracking_file`, with the
+        height and tracking offsets predicted by the map."""
+        import pickle
+        from scipy.interpolate import interp1d
+
+        angles = np.arange(min(angle_min, angle_max), max(angle_min, angle_max) + step, step)
+        offsets = self.predict_track(x, y, angles)
+        if offsets is None:
+            raise ValueError('No tracks in the height map')
+
+        d = {}
+        d['y_offset'] = interp1d(angles, offsets, fill_value='extrapolate', kind='linear')
+        d['x_offset'] = 0
+        d['x_center'] = x
+        d['y_center'] = y
+        d['z_pos'] = self.predict(x, y).z
+        d['angle_min'] = angle_min
+        d['angle_max'] = angle_max
+        d['i'] = 0
+
+        fn = Path(fn)
+        pickle.dump(d, open(fn, 'wb'))
+        return fn
+
+
+def get_height_map() -> HeightMap:
+    """Return the height map of the current grid given by
+    `config.settings.height_map` (relative to the data directory), or None
+    if it is not set."""
+    name = config.settings.height_map
+    if not name:
+        return None
+    fn = Path(config.locations['data']) / name
+    return HeightMap.load(fn, max_uncertainty=config.settings.height_map_max_uncertainty)
@@ -2,6 +2,8 @@ import logging
 from pathlib import Path
 
 from instamatic import config
+from instamatic.utils.instrumentation import instrument
+from instamatic.utils.recording import record
 logger = logging.getLogger(__name__)
 
 __all__ = ['Camera']
@@ -26,6 +28,8 @@ def get_cam(interface: str = None):
         from instamatic.camera import camera_timepix as cam
     elif interface in ('emmenu', 'tvips'):
         from instamatic.camera.camera_emmenu import CameraEMMENU as cam
+    elif interface == 'replay':
+        from instamatic.camera.camera_replay import CameraReplay as cam
     else:
         raise ValueError(f'No such camera interface: {interface}')
 
@@ -61,6 +65,9 @@ def Camera(name: str = None, as_stream: bool = False, use_server: bool = False):
         else:
             cam = cam_cls(name=name)
 
+    cam = record(cam, target='cam')
+    cam = instrument(cam)
+
     if as_stream:
         if cam.streamable:
             from .videostream import VideoStream
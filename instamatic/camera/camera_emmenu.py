@@ -1,12 +1,12 @@
 import atexit
 import logging
 import time
-from pathlib import Path
 
 import comtypes.client
 import numpy as np
 
 from instamatic import config
+from instamatic.camera.emmenu_export import TiffExport
 logger = logging.getLogger(__name__)
 
 
@@ -47,6 +47,41 @@ def EMVector2dict(vec):
     return d
 
 
+class _ExportConnection:
+    """Connection to EMMENU for a `TiffExport` worker thread.
+
+    COM interfaces cannot be used from another thread (apartment)
+    without marshalling, so the connection is opened in the worker
+    thread itself. `CreateObject` connects to the running EMMENU.
+    """
+
+    def __init__(self, drc_index: int):
+        super().__init__()
+        try:
+            comtypes.CoInitializeEx(comtypes.COINIT_MULTITHREADED)
+        except OSError:
+            comtypes.CoInitialize()
+
+        self.drc_index = drc_index
+        obj = comtypes.client.CreateObject('EMMENU4.EMMENUApplication.1', comtypes.CLSCTX_ALL)
+        self._immgr = obj.ImageManager
+        self._emf = obj.EMFile
+        self._emi = obj.EMImages
+
+    def writeTiff(self, image_index: int, filename: str) -> None:
+        p = self._immgr.Image(self.drc_index, image_index)
+        self._emf.WriteTiff(p, filename)
+
+    def deleteImageByIndex(self, image_index: int) -> None:
+        p = self._immgr.Image(self.drc_index, image_index)
+        self._emi.DeleteImage(p)
+
+    def close(self) -> None:
+        # release the interfaces before uninitializing COM on this thread
+        self._immgr = self._emf = self._emi = None
+        comtypes.CoUninitialize()
+
+
 class CameraEMMENU:
     """Software interface for the EMMENU program.
 
@@ -76,6 +111,8 @@ class CameraEMMENU:
         self._obj = comtypes.client.CreateObject('EMMENU4.EMMENUApplication.1', comtypes.CLSCTX_ALL)
 
         self._recording = False
+        self._export = None  # running `TiffExport`
+        self._frames = None  # (start_index, end_index, pointers) of the last sweep
 
         # get first camera
         self._cam = self._obj.TEMCameras.Item(1)
@@ -303,7 +340,12 @@ class CameraEMMENU:
     def deleteImageByIndex(self, img_index: int, drc_index: int = None) -> int:
         """Delete the image from EMMENU by its index."""
         p = self.getImageByIndex(img_index, drc_index)
-        self._emi.DeleteImage(p)  # alternative: self._emi.Remove(p.ImgHandle)
+        self.deleteImage(p)
+
+    def deleteImage(self, image_pointer) -> None:
+        """Delete the image from EMMENU by its pointer, this also clears the
+        buffer."""
+        self._emi.DeleteImage(image_pointer)  # alternative: self._emi.Remove(p.ImgHandle)
 
     def getImageByIndex(self, img_index: int, drc_index: int = None) -> int:
         """Grab data from the image manager by index. Return image pointer
@@ -318,6 +360,26 @@ class CameraEMMENU:
 
         return p
 
+    def getImagesByIndex(self, start_index: int, end_index: int, drc_index: int = None) -> list:
+        """Grab the image pointers (COM) from `start_index` to `end_index`
+        (inclusive) in one pass.
+
+        The pointers are kept for `get_timestamps` on the same range, until
+        new images are acquired. They can only be used on this thread.
+
+        Not accessible through server.
+        """
+        frames = self._frames
+        if frames is not None and frames[:2] == (start_index, end_index) and drc_index in (None, self.drc_index):
+            return frames[2]
+
+        if not drc_index:
+            drc_index = self.drc_index
+        pointers = [self._immgr.Image(drc_index, image_index) for image_index in range(start_index, end_index + 1)]
+        if drc_index == self.drc_index:
+            self._frames = (start_index, end_index, pointers)
+        return pointers
+
     def getImageDataByIndex(self, img_index: int, drc_index: int = None) -> 'np.array':
         """Grab data from the image manager by index.
 
@@ -375,34 +437,58 @@ class CameraEMMENU:
 
         self.writeTiffFromPointer(p, filename)
 
-    def writeTiffs(self, start_index: int, stop_index: int, path: str, clear_buffer: bool = False) -> None:
+    def writeTiffs(self,
+                   start_index: int,
+                   stop_index: int,
+                   path: str,
+                   clear_buffer: bool = False,
+                   workers: int = 1,
+                   callback=None,
+                   wait: bool = True,
+                   ) -> None:
         """Write a series of data in tiff format and writes them to the given
-        `path` using EMMENU machinery."""
-        path = Path(path)
-        drc_index = self.drc_index
+        `path` using EMMENU machinery.
+
+        The files are written by `workers` threads, each with its own
+        connection to EMMENU (see `_ExportConnection`). If `wait` is False,
+        the export runs in the background, and the next acquisition waits
+        for it to finish (see `wait_export`). `callback(n_done, n_total)` is
+        called after every file.
 
+        The running `TiffExport` is kept in `self._export`, it is not
+        returned, so that the call can go through the camera server.
+        """
         if stop_index <= start_index:
             raise IndexError(f'`stop_index`: {stop_index} >= `start_index`: {start_index}')
 
-        for i, image_index in enumerate(range(start_index, stop_index + 1)):
-            p = self.getImageByIndex(image_index, drc_index)
-
-            fn = str(path / f'{i:04d}.tiff')
-            print(f'Image #{image_index} -> {fn}')
-
-            # TODO: wrap writeTiff in try/except
-            # writeTiff causes vague error if image does not exist
-
-            self.writeTiffFromPointer(p, fn)
+        self.wait_export()
 
-            if clear_buffer:
-                # self._immgr.DeleteImageBuffer(drc_index, image_index)  # does not work on 3200
-                self._emi.DeleteImage(p)  # also clears from buffer
-
-        print(f'Wrote {i+1} images to {path}')
+        drc_index = self.drc_index
+        self._export = TiffExport(lambda: _ExportConnection(drc_index),
+                                  range(start_index, stop_index + 1),
+                                  path,
+                                  clear_buffer=clear_buffer,
+                                  workers=workers,
+                                  callback=callback)
+        if clear_buffer:
+            self._frames = None
+        if wait:
+            self.wait_export()
+
+    def wait_export(self, timeout: float = None) -> None:
+        """Wait for the running export (`writeTiffs`) to finish, raises an
+        `OSError` if images could not be written."""
+        export = self._export
+        if export is None:
+            return
+        export.wait(timeout)
+        if export.done:
+            self._export = None
+            export.check()
 
     def getImage(self, **kwargs) -> 'np.array':
         """Acquire image through EMMENU and return data as np array."""
+        self._before_acquire()
         self._vp.AcquireAndDisplayImage()
         i = self.get_image_index()
         return self.getImageDataByIndex(i)
@@ -410,9 +496,15 @@ class CameraEMMENU:
     def acquireImage(self, **kwargs) -> int:
         """Acquire image through EMMENU and store in the Image Manager Returns
         the image index."""
+        self._before_acquire()
         self._vp.AcquireAndDisplayImage()
         return self.get_image_index()
 
+    def _before_acquire(self) -> None:
+        # new images may overwrite the buffers that are being exported
+        self.wait_export()
+        self._frames = None
+
     def set_image_index(self, index: int) -> None:
         """Change the currently selected buffer by the image index Note that
         the interface here is 0-indexed, whereas the image manager is 1-indexed
@@ -440,6 +532,7 @@ class CameraEMMENU:
     def start_record(self) -> int:
         i = self.get_image_index()
         print(f'Start recording (Image index={i})')
+        self._before_acquire()
         self._vp.StartRecorder()
         self._recording = True
         return i
@@ -453,6 +546,7 @@ class CameraEMMENU:
 
     def start_liveview(self, delay: float = 3.0) -> None:
         print('Start live view')
+        self._before_acquire()
         try:
             self._vp.StartContinuous()
         except comtypes.COMError as e:
@@ -482,16 +576,12 @@ class CameraEMMENU:
 
     def get_timestamps(self, start_index: int, end_index: int) -> list:
         """Get timestamps in seconds for given image index range."""
-        drc_index = self.drc_index
-        timestamps = []
-        for i, image_index in enumerate(range(start_index, end_index + 1)):
-            p = self.getImageByIndex(image_index, drc_index)
-            t = p.EMVector.lImgCreationTime
-            timestamps.append(t)
-        return timestamps
+        pointers = self.getImagesByIndex(start_index, end_index)
+        return [p.EMVector.lImgCreationTime for p in pointers]
 
     def releaseConnection(self) -> None:
         """Release the connection to the camera."""
+        self.wait_export()
         self.stop_liveview()
 
         self._vp.DirectoryHandle = self.top_drc_index
@@ -0,0 +1,68 @@
+import logging
+
+from instamatic import config
+from instamatic.utils.recording import SessionReplay
+logger = logging.getLogger(__name__)
+
+
+class CameraReplay:
+    """Plays back the camera calls and frames from a recorded session (see
+    `instamatic.utils.recording`).
+
+    Defaults (exposure, binsize, dimensions) are read from the camera
+    config, all other calls return the recorded values in order,
+    regardless of the arguments they are called with. The session log is
+    taken from `config.settings.session_replay` unless `fn` is given. If
+    `realtime` is True, every call takes as long as it did in the original
+    session, otherwise the session is played back as fast as possible.
+    """
+
+    def __init__(self, name: str = 'replay', fn: str = None, realtime: bool = None):
+        super().__init__()
+
+        if fn is None:
+            fn = config.settings.session_replay
+        if not fn:
+            raise ValueError('No session log defined for replay (`session_replay` in settings.yaml)')
+        if realtime is None:
+            realtime = config.settings.session_replay_realtime
+
+        self.name = name
+        self._replay = SessionReplay(fn, target='cam', realtime=realtime)
+
+        self.load_defaults()
+
+        # frames are consumed on every call, so do not run a live stream
+        self.streamable = False
+
+        logger.info(f'Camera {self.name} initialized, replaying `{fn}`')
+
+    def load_defaults(self):
+        if self.name != config.settings.camera:
+            config.load_camera_config(camera_name=self.name)
+
+        self.__dict__.update(config.camera.mapping)
+
+    def __getattr__(self, attr_name):
+        if attr_name.startswith('_') or attr_name not in self._replay:
+            raise AttributeError(f'`{self.__class__.__name__}` object has no attribute `{attr_name}`')
+
+        if self._replay.is_attribute(attr_name):
+            return self._replay.call(attr_name)
+
+        def replay(*args, **kwargs):
+            return self._replay.call(attr_name)
+
+        replay.__name__ = attr_name
+        return replay
+
+    def getCameraDimensions(self) -> (int, int):
+        """Get the dimensions reported by the camera."""
+        return self.dimensions
+
+    def getName(self) -> str:
+        """Get the name reported by the camera."""
+        return self.name
+
+    def releaseConnection(self) -> None:
+        self._replay.close()
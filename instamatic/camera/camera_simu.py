@@ -1,12 +1,18 @@
 import atexit
 import logging
+import threading
 import time
+from collections import namedtuple
 
 import numpy as np
 
 from instamatic import config
+from instamatic.camera.emmenu_export import TiffExport
 logger = logging.getLogger(__name__)
 
+# image buffer of the simulated EMMENU image manager
+SimImage = namedtuple('SimImage', ['index', 'timestamp'])
+
 
 class CameraSimu:
     """Simple class that simulates the camera interface and mocks the method
@@ -32,6 +38,13 @@ class CameraSimu:
         self._exposure = self.default_exposure
         self._autoincrement = True
         self._start_record_time = -1
+        self._buffers = {}
+        self._frames = None
+        self._export = None
+
+        # EMMENU handles one COM call at a time, each takes about this long (s)
+        self.emmenu_latency = 0.002
+        self._emmenu_lock = threading.Lock()
 
     def load_defaults(self):
         if self.name != config.settings.camera:
@@ -133,7 +146,10 @@ class CameraSimu:
         if t1 >= 0:
             t2 = time.perf_counter()
             n_images = int((t2 - t1) / self._exposure)
-            new_index = self.get_image_index() + n_images
+            index = self.get_image_index()
+            new_index = index + n_images
+            for i in range(index + 1, new_index + 1):
+                self._buffers[i] = SimImage(i, t1 + (i - index) * self._exposure)
             self.set_image_index(new_index)
             print('stop_record', t1, t2, self._exposure, new_index)
             self._start_record_time = -1
@@ -141,6 +157,8 @@ class CameraSimu:
             pass
 
     def start_record(self) -> None:
+        self.wait_export()
+        self._frames = None
         self._start_record_time = time.perf_counter()
 
     def stop_liveview(self) -> None:
@@ -148,6 +166,7 @@ class CameraSimu:
         print('Liveview stopped')
 
     def start_liveview(self, delay=3.0) -> None:
+        self.wait_export()
         time.sleep(delay)
         print('Liveview started')
 
@@ -157,11 +176,69 @@ class CameraSimu:
     def get_exposure(self) -> int:
         return self._exposure
 
+    def _emmenu_call(self) -> None:
+        with self._emmenu_lock:
+            time.sleep(self.emmenu_latency)
+
+    def getImageByIndex(self, img_index: int, drc_index: int = None) -> SimImage:
+        """Return the simulated image buffer, or None if it is empty."""
+        self._emmenu_call()
+        return self._buffers.get(img_index)
+
+    def getImagesByIndex(self, start_index: int, end_index: int, drc_index: int = None) -> list:
+        frames = self._frames
+        if frames is not None and frames[:2] == (start_index, end_index):
+            return frames[2]
+        pointers = [self.getImageByIndex(i) for i in range(start_index, end_index + 1)]
+        self._frames = (start_index, end_index, pointers)
+        return pointers
+
     def get_timestamps(self, start_index, end_index):
-        return list(range(20))
+        return [p.timestamp for p in self.getImagesByIndex(start_index, end_index)]
+
+    def writeTiffFromPointer(self, image_pointer, filename: str) -> None:
+        from instamatic.formats import write_tiff
+        self._emmenu_call()
+        binsize = self.getBinning()
+        shape = tuple(int(d / binsize) for d in self.getCameraDimensions())
+        arr = np.random.RandomState(image_pointer.index).randint(256, size=shape).astype(np.uint16)
+        write_tiff(filename, arr)
 
     def getBinning(self):
         return self.default_binsize
 
-    def writeTiffs(self, start_index: int, stop_index: int, path: str, clear_buffer=True) -> None:
-        pass
+    def writeTiff(self, image_index: int, filename: str) -> None:
+        p = self.getImageByIndex(image_index)
+        if p is None:
+            raise OSError(f'Image buffer {image_index} is empty')
+        self.writeTiffFromPointer(p, filename)
+
+    def deleteImageByIndex(self, image_index: int) -> None:
+        self._emmenu_call()
+        self._buffers.pop(image_index, None)
+
+    def writeTiffs(self,
+                   start_index: int,
+                   stop_index: int,
+                   path: str,
+                   clear_buffer: bool = False,
+                   workers: int = 1,
+                   callback=None,
+                   wait: bool = True,
+                   ) -> None:
+        self.wait_export()
+        self._export = TiffExport(lambda: self, range(start_index, stop_index + 1), path,
+                                  clear_buffer=clear_buffer, workers=workers, callback=callback)
+        if clear_buffer:
+            self._frames = None
+        if wait:
+            self.wait_export()
+
+    def wait_export(self, timeout: float = None) -> None:
+        export = self._export
+        if export is None:
+            return
+        export.wait(timeout)
+        if export.done:
+            self._export = None
+            export.check()
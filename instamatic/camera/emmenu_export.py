@@ -0,0 +1,159 @@
+"""Background export of EMMENU image buffers to TIFF files.
+
+After a TVIPS sweep, the frames are still in the image buffers of EMMENU,
+and EMMENU writes them to TIFF files (`EMFile.WriteTiff`). `TiffExport`
+does this in worker threads, so that the next crystal can be set up in
+the meantime. The buffers are optionally deleted after they are written,
+and progress is reported through a callback.
+
+COM interfaces belong to the apartment of the thread that created them,
+and cannot be used from another thread without marshalling. Every worker
+therefore opens its own connection with the `connect` function, and
+passes image indices, not image pointers, to it. A connection implements
+`writeTiff(image_index, filename)`, `deleteImageByIndex(image_index)`,
+and optionally `close()`.
+
+The camera must not record into the buffers before the export is done.
+`CameraEMMENU` (and the simulated camera) therefore wait for the running
+export before they acquire new images.
+
+Usage:
+    export = TiffExport(connect, range(1, n + 1), path, callback=progress)
+    ...  # set up the next crystal
+    export.wait()
+    export.check()
+"""
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+logger = logging.getLogger(__name__)
+
+
+class TiffExport:
+    """Write image buffers to TIFF files in background threads.
+
+    connect: callable
+        Called in every worker thread, returns the connection used by
+        that thread (see above)
+    indices: list
+        Image indices to write, the files are numbered in this order
+    path: str
+        Directory to write the files to
+    clear_buffer: bool
+        Delete the image buffers after they are written
+    workers: int
+        Number of worker threads, each with its own connection
+    callback: callable
+        Called as `callback(n_done, n_total)` from the worker threads after
+        every file, if None, a summary is printed when the export is done
+    """
+
+    def __init__(self, connect, indices, path: str, clear_buffer: bool = False, workers: int = 1, callback=None):
+        super().__init__()
+        self.connect = connect
+        self.path = Path(path)
+        self.clear_buffer = clear_buffer
+        self.callback = callback
+
+        self.indices = list(indices)
+        self.filenames = [self.path / f'{i:04d}.tiff' for i in range(len(self.indices))]
+        self.n_total = len(self.indices)
+        self.n_done = 0
+        self.errors = []
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        for i in range(self.n_total):
+            self._queue.put(i)
+
+        self.t_start = time.perf_counter()
+        self.t_end = None
+        self._threads = [threading.Thread(target=self._run, name=f'TiffExport-{j}', daemon=True)
+                         for j in range(max(min(workers, self.n_total), 1))]
+        for thread in self._threads:
+            thread.start()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.path)!r}, done={self.n_done}/{self.n_total})'
+
+    def _run(self) -> None:
+        try:
+            connection = self.connect()
+        except Exception as e:
+            logger.error(f'Could not connect for the TIFF export: {e}')
+            connection, error = None, e
+        try:
+            while True:
+                try:
+                    i = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if connection is None:
+                    self._done(i, error)
+                else:
+                    self._write(connection, i)
+        finally:
+            close = getattr(connection, 'close', None)
+            if close:
+                close()
+
+    def _write(self, connection, i: int) -> None:
+        image_index = self.indices[i]
+        try:
+            connection.writeTiff(image_index, str(self.filenames[i]))
+            if self.clear_buffer:
+                connection.deleteImageByIndex(image_index)
+        except Exception as e:
+            # a missing buffer gives a vague COM error, keep writing the others
+            logger.error(f'Failed to write image #{image_index} to {self.filenames[i]}: {e}')
+            self._done(i, e)
+        else:
+            self._done(i)
+
+    def _done(self, i: int, error: Exception = None) -> None:
+        with self._lock:
+            if error is not None:
+                self.errors.append((self.indices[i], error))
+            self.n_done += 1
+            n_done = self.n_done
+            if n_done == self.n_total:
+                self.t_end = time.perf_counter()
+
+        if self.callback:
+            self.callback(n_done, self.n_total)
+        elif n_done == self.n_total:
+            msg = f'Wrote {self.n_written} images to {self.path} ({self.duration:.1f} s)'
+            if self.errors:
+                msg += f', {len(self.errors)} images failed'
+            print(msg)
+
+    @property
+    def done(self) -> bool:
+        return self.n_done == self.n_total
+
+    @property
+    def n_written(self) -> int:
+        return self.n_done - len(self.errors)
+
+    @property
+    def duration(self) -> float:
+        """Time in seconds since the start of the export, or the total time
+        if it is done."""
+        t_end = self.t_end if self.t_end is not None else time.perf_counter()
+        return t_end - self.t_start
+
+    def wait(self, timeout: float = None) -> int:
+        """Wait for the export to finish, or at most `timeout` seconds per
+        worker. Returns the number of files written so far."""
+        for thread in self._threads:
+            thread.join(timeout)
+        return self.n_written
+
+    def check(self) -> None:
+        """Raise an `OSError` if any of the images could not be written."""
+        if self.errors:
+            image_index, error = self.errors[0]
+            raise OSError(f'Failed to write {len(self.errors)} of {self.n_total} images to {self.path} '
+                          f'(first: image #{image_index}: {error})')
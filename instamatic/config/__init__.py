@@ -8,6 +8,8 @@ from pathlib import Path
 
 import yaml
 
+from .calibration_tables import CalibrationTables
+from .config_cache import YAMLCache
 from .config_updater import check_defaults_yaml
 from .config_updater import check_settings_yaml
 from .config_updater import convert_config
@@ -25,6 +27,7 @@ _camera = 'camera'
 _scripts = 'scripts'
 _alignments = 'alignments'
 _instamatic = 'instamatic'
+_cache = '.config_cache.pickle'
 
 
 def nested_update(d: dict, u: dict) -> dict:
@@ -89,7 +92,8 @@ def get_alignments() -> dict:
     Use `ctrl.from_dict` to load the alignments
     """
     fns = alignments_drc.glob('*.yaml')
-    alignments = {fn.name: yaml.full_load(open(fn)) for fn in fns}
+    alignments = {fn.name: yaml_cache.load(fn, loader=yaml.FullLoader) for fn in fns}
+    yaml_cache.save()
     return alignments
 
 
@@ -113,11 +117,11 @@ class ConfigObject:
     def from_file(cls, path: str):
         """Read configuration from yaml file, returns namespace."""
         name = Path(path).stem
-        return cls(yaml.load(open(path, 'r'), Loader=yaml.Loader), name=name, location=path)
+        return cls(yaml_cache.load(path), name=name, location=path)
 
     def update_from_file(self, path: str) -> None:
         """Update configuration from yaml file."""
-        self.update(yaml.load(open(path, 'r'), Loader=yaml.Loader))
+        self.update(yaml_cache.load(path))
         self.location = path
 
     def update(self, mapping: dict):
@@ -134,6 +138,7 @@ class ConfigObject:
 
 def load_calibration(calibration_name: str = None):
     global calibration
+    global calibration_tables
 
     if not calibration_name:
         calibration_name = settings.calibration
@@ -151,8 +156,10 @@ def load_calibration(calibration_name: str = None):
         calibration_config.update(d)
 
     calibration = calibration_config
+    calibration_tables = CalibrationTables(calibration.mapping)
 
     settings.calibration = calibration.name
+    yaml_cache.save()
 
 
 def load_microscope_config(microscope_name: str = None):
@@ -173,6 +180,7 @@ def load_microscope_config(microscope_name: str = None):
     microscope = microscope_config
 
     settings.microscope = microscope.name
+    yaml_cache.save()
 
 
 def load_camera_config(camera_name: str = None):
@@ -198,6 +206,7 @@ def load_camera_config(camera_name: str = None):
     camera.name = camera_name
 
     settings.camera = camera.name
+    yaml_cache.save()
 
 
 def load_defaults():
@@ -207,6 +216,7 @@ def load_defaults():
 
     defaults = ConfigObject.from_file(Path(__file__).parent / _defaults_yaml)  # load defaults
     defaults.update_from_file(config_drc / _defaults_yaml)             # update user parameters
+    yaml_cache.save()
 
 
 def load_settings():
@@ -221,6 +231,7 @@ def load_settings():
 
     today = datetime.datetime.now().strftime('%Y-%m-%d')
     settings.work_directory = settings.data_directory / f'{today}'
+    yaml_cache.save()
 
 
 def load_all(microscope_name: str = None,
@@ -238,6 +249,52 @@ def load_all(microscope_name: str = None,
     load_calibration(calibration_name)
 
 
+def reload(force: bool = False) -> bool:
+    """Reload the configuration if any of the loaded config files has
+    changed on disk (or always if `force` is True). The currently loaded
+    microscope/calibration/camera configs are reloaded.
+
+    Note that the config objects are replaced, so modules must access them
+    through `config.settings` etc. to see the update. Returns True if the
+    configuration was reloaded.
+    """
+    changed = yaml_cache.changed()
+    if not (changed or force):
+        return False
+
+    for fn in changed:
+        logger.info('Config file changed: %s', fn)
+
+    def name(cfg):
+        return Path(cfg.location).stem if cfg.location else None
+
+    load_all(microscope_name=name(microscope),
+             calibration_name=name(calibration),
+             camera_name=name(camera))
+    locations.update(get_locations())
+    return True
+
+
+def get_locations() -> dict:
+    return {
+        'base': base_drc,
+        'config': config_drc,
+        'logs': logs_drc,
+        'scripts': scripts_drc,
+        'camera': alignments_drc,
+        'microscope': calibration.location,
+        'calibration': microscope.location,
+        'alignments': camera.location,
+        'data': settings.data_directory,
+        'work': settings.work_directory,
+        'microscope_config': calibration.location,
+        'calibration_config': microscope.location,
+        'alignments_config': camera.location,
+        'settings': config_drc / _settings_yaml,
+        'defaults': config_drc / _defaults_yaml,
+    }
+
+
 base_drc = get_base_drc()
 config_drc = base_drc / _config
 
@@ -255,28 +312,15 @@ logs_drc.mkdir(exist_ok=True)
 
 print(f'Config directory: {config_drc}')
 
+yaml_cache = YAMLCache(config_drc / _cache)
+
 settings = None
 defaults = None
 microscope = None
 calibration = None
+calibration_tables = None
 camera = None
 
 load_all()
 
-locations = {
-    'base': base_drc,
-    'config': config_drc,
-    'logs': logs_drc,
-    'scripts': scripts_drc,
-    'camera': alignments_drc,
-    'microscope': calibration.location,
-    'calibration': microscope.location,
-    'alignments': camera.location,
-    'data': settings.data_directory,
-    'work': settings.work_directory,
-    'microscope_config': calibration.location,
-    'calibration_config': microscope.location,
-    'alignments_config': camera.location,
-    'settings': config_drc / _settings_yaml,
-    'defaults': config_drc / _defaults_yaml,
-}
+locations = get_locations()
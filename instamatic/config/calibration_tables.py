@@ -0,0 +1,65 @@
+"""Pre-indexed lookup tables for the calibration config."""
+import bisect
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class CalibrationTables:
+    """Flattened index of a calibration config, i.e. `pixelsize`,
+    `stagematrix`, `rot90` for every mode, indexed by magnification or
+    camera length.
+
+    Usage:
+        tables = CalibrationTables(config.calibration.mapping)
+        tables['diff', 'pixelsize', 300]  # == config.calibration['diff']['pixelsize'][300]
+        tables.get('mag1', 'rot90', 2500, default=0)
+        mags, values = tables.table('mag1', 'pixelsize')
+    """
+
+    def __init__(self, mapping: dict):
+        super().__init__()
+        self._index = {}
+        self._keys = {}
+
+        for mode, items in mapping.items():
+            if not isinstance(items, Mapping):
+                continue
+            for key, table in items.items():
+                if not isinstance(table, Mapping):
+                    continue
+                for mag, value in table.items():
+                    self._index[mode, key, mag] = value
+                self._keys[mode, key] = sorted(mag for mag in table if isinstance(mag, (int, float)))
+
+    def __getitem__(self, item: tuple):
+        return self._index[item]
+
+    def __contains__(self, item: tuple) -> bool:
+        return item in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, mode: str, key: str, mag, default=None):
+        """Return the calibrated value of `key` for `mode` at `mag`, or
+        `default` if it is not calibrated."""
+        return self._index.get((mode, key, mag), default)
+
+    def table(self, mode: str, key: str) -> tuple:
+        """Return the sorted magnifications/camera lengths and corresponding
+        values of `key` for `mode` as arrays."""
+        mags = self._keys[mode, key]
+        values = [self._index[mode, key, mag] for mag in mags]
+        return np.array(mags), np.array(values)
+
+    def nearest(self, mode: str, key: str, mag):
+        """Return the value of `key` for the calibrated magnification/camera
+        length closest to `mag`"""
+        mags = self._keys[mode, key]
+        if not mags:
+            raise KeyError((mode, key, mag))
+        i = bisect.bisect_left(mags, mag)
+        if i == len(mags) or (i > 0 and mag - mags[i - 1] <= mags[i] - mag):
+            i -= 1
+        return self._index[mode, key, mags[i]]
@@ -0,0 +1,109 @@
+"""Cache for parsed configuration files.
+
+Parsing the yaml files with the pure-python `yaml.Loader` dominates the
+time it takes to load the configuration. `YAMLCache` keeps the parsed
+contents of every file as a pickle, keyed by the absolute path, and
+persists them in a single snapshot file. An entry is used only if the
+modification time and size of the file still match, otherwise the file
+is parsed again.
+"""
+import logging
+import os
+import pickle
+from pathlib import Path
+
+import yaml
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+class YAMLCache:
+    """Cache of parsed yaml files, stored in `fn`
+
+    fn : str
+        Path to the snapshot file, if None, the cache is kept in memory only
+    """
+
+    def __init__(self, fn: str = None):
+        super().__init__()
+        self.fn = Path(fn) if fn else None
+        self.entries = {}  # path -> ((mtime_ns, size), pickled data)
+        self.loaded = {}   # path -> (mtime_ns, size) for files loaded in this session
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+        if self.fn:
+            self._read()
+
+    def _read(self) -> None:
+        try:
+            with open(self.fn, 'rb') as f:
+                version, entries = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.debug('Could not read config cache %s: %s', self.fn, e)
+            return
+        if version == CACHE_VERSION:
+            self.entries = entries
+
+    @staticmethod
+    def stamp(path: str) -> tuple:
+        """Return the (mtime, size) used to check if `path` has changed."""
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def load(self, path: str, loader=yaml.Loader):
+        """Return the contents of yaml file `path`, a fresh copy is returned
+        on every call."""
+        path = os.path.abspath(path)
+        stamp = self.stamp(path)
+        self.loaded[path] = stamp
+
+        entry = self.entries.get(path)
+        if entry and entry[0] == stamp:
+            self.hits += 1
+            return pickle.loads(entry[1])
+
+        self.misses += 1
+        with open(path, 'r') as f:
+            data = yaml.load(f, Loader=loader)
+        self.entries[path] = (stamp, pickle.dumps(data, protocol=4))
+        self.dirty = True
+        return data
+
+    def changed(self) -> list:
+        """Return the files loaded in this session that have changed on disk
+        since."""
+        changed = []
+        for path, stamp in self.loaded.items():
+            try:
+                if self.stamp(path) != stamp:
+                    changed.append(path)
+            except FileNotFoundError:
+                changed.append(path)
+        return changed
+
+    def save(self) -> None:
+        """Write the snapshot to `fn` if any entry was added or updated."""
+        if not (self.dirty and self.fn):
+            return
+        tmp = self.fn.with_name(f'{self.fn.name}.{os.getpid()}.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump((CACHE_VERSION, self.entries), f, protocol=4)
+            os.replace(tmp, self.fn)
+        except OSError as e:
+            logger.debug('Could not write config cache %s: %s', self.fn, e)
+            return
+        self.dirty = False
+
+    def clear(self) -> None:
+        """Remove all entries and delete the snapshot file."""
+        self.entries.clear()
+        self.loaded.clear()
+        self.dirty = False
+        if self.fn and self.fn.exists():
+            self.fn.unlink()
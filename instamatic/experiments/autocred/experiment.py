@@ -24,9 +24,11 @@ from instamatic.calibrate.calibrate_imageshift12 import Calibrate_Imageshift2
 from instamatic.calibrate.calibrate_imageshift12 import Calibrate_Stage
 from instamatic.calibrate.center_z import center_z_height_HYMethod
 from instamatic.calibrate.filenames import *
+from instamatic.calibrate.height_map import get_height_map
 from instamatic.formats import write_tiff
 from instamatic.neural_network import predict
 from instamatic.neural_network import preprocess
+from instamatic.processing.crystal_tracker import CrystalTracker
 from instamatic.processing.find_crystals import find_crystals_timepix
 from instamatic.processing.ImgConversionTPX import ImgConversionTPX as ImgConversion
 from instamatic.tools import find_beam_center
@@ -294,36 +296,14 @@ class Experiment:
         return warn
 
     def img_var(self, img, apert_pos):
-        apert_pos = [int(apert_pos[0]), int(apert_pos[1])]
-        window_size = img.shape[0]
-        half_w = int(window_size / 2)
-        x_range = range(apert_pos[0] - half_w, apert_pos[0] + half_w)
-        y_range = range(apert_pos[1] - half_w, apert_pos[1] + half_w)
-
-        if not any(x in range(255, 261) for x in x_range) and not any(y in range(255, 261) for y in y_range):
-            return np.var(img)
-        else:
-            if any(x in range(255, 261) for x in x_range):
-                indx = []
-                for px in range(255, 261):
-                    try:
-                        indx.append(x_range.index(px))
-                    except BaseException:
-                        pass
-
-                img = np.delete(img, indx, 0)
-
-            if any(y in range(255, 261) for y in y_range):
-                indy = []
-                for px in range(255, 261):
-                    try:
-                        indy.append(y_range.index(px))
-                    except BaseException:
-                        pass
-
-                img = np.delete(img, indy, 1)
-
-            return np.var(img)
+        """Variance of `img`, cropped at `apert_pos` (see `image_cropper`),
+        without the rows/columns of the cross between the Timepix chips."""
+        half_w = int(img.shape[0] / 2)
+        rows = np.arange(img.shape[0]) + int(apert_pos[0]) - half_w
+        cols = np.arange(img.shape[1]) + int(apert_pos[1]) - half_w
+        keep_rows = (rows < 255) | (rows > 260)
+        keep_cols = (cols < 255) | (cols > 260)
+        return np.var(img[np.ix_(keep_rows, keep_cols)])
 
     def check_img_outsidebeam_byscale(self, img1_scale, img2_scale):
         """img1 is the original image for reference, img2 is the new image."""
@@ -616,6 +596,16 @@ class Experiment:
 
             self.logger.debug(f'Tracking method: {trackmethod}. Initial crystal_pos: {crystal_pos} by find_defocused_image_center.')
 
+            if trackmethod == 'p' and config.settings.autocred_fast_tracking:
+                # track the crystal by correlation of a small ROI, the particle recognition is the fallback
+                def locate(img, center):
+                    return -np.array(self.tracking_by_particlerecog(img))
+
+                tracker = CrystalTracker(img0, angle=0, cross=(255, 261), fallback=locate)
+                self.logger.debug(f'Tracking with {tracker}')
+            else:
+                tracker = None
+
         if self.unblank_beam:
             self.ctrl.beam.unblank()
 
@@ -730,6 +720,23 @@ class Experiment:
                             self.logger.debug(f'Beam shift coordinates: {delta_beamshiftcoord}')
                             bs_x0, bs_y0 = self.setandupdate_bs(bs_x0, bs_y0, delta_beamshiftcoord)
 
+                    elif trackmethod == 'p' and tracker is not None:
+
+                        # the frame number is proportional to the rotation angle
+                        result = tracker.update(img, angle=i, center=crystal_pos)
+                        self.logger.debug(f'Tracking: {result}')
+                        if result.offset is None:
+                            self.print_and_del('Collection stopping because the crystal was lost...')
+                            self.stopEvent.set()
+                            continue
+
+                        shift = tuple(-result.offset)
+                        delta_beamshiftcoord = np.matmul(shift, transform_beamshift_d_defoc)
+                        self.logger.debug(f'Beam shift coordinates: {delta_beamshiftcoord}')
+
+                        bs_x0, bs_y0 = self.setandupdate_bs(bs_x0, bs_y0, delta_beamshiftcoord)
+                        tracker.correct(result.offset)
+
                     elif trackmethod == 'p':
 
                         shift = self.tracking_by_particlerecog(img)
@@ -746,8 +753,7 @@ class Experiment:
                         self.logger.debug(f'Beamshift close to limit warning: bs_x0 = {bs_x0}, bs_y0 = {bs_y0}')
                         self.stopEvent.set()
 
-                    crystal_pos, r = find_defocused_image_center(img)
-                    crystal_pos = crystal_pos[::-1]
+                    # `crystal_pos` is the beam center of `img`, found by `image_cropper`
                     crystal_pos_dif = crystal_pos - appos0
                     apmv = -crystal_pos_dif
                     dpmv = delta_beamshiftcoord @ transform_beamshift_d_
@@ -1008,11 +1014,22 @@ class Experiment:
         x_zheight = 0
         y_zheight = 0
 
-        t = tqdm(self.offsets, desc=f'Number of crystals scanned: {self.number_crystals_scanned}; Number of experiments performed: {self.number_exp_performed}')
+        height_map = get_height_map()
+        if height_map is not None:
+            self.print_and_log(logger=self.logger, msg=f'Using {height_map}')
+
+        planner = None
+        if config.settings.autocred_adaptive_scan:
+            planner = self.plan_raster_scan((center_x, center_y), box=(box_x * 1000, box_y * 1000))
+
+        t = tqdm(self.visit_offsets(planner, center_x, center_y),
+                 total=len(self.offsets),
+                 desc=f'Number of crystals scanned: {self.number_crystals_scanned}; Number of experiments performed: {self.number_exp_performed}')
 
-        for j, (x_offset, y_offset) in enumerate(t):
+        for j, (x_offset, y_offset) in t:
             x = center_x + x_offset
             y = center_y + y_offset
+            n_crystals_scanned = self.number_crystals_scanned
 
             self.ctrl.stage.set(x=x, y=y)
             # print("Stage position: x = {}, y = {}".format(x,y))
@@ -1020,7 +1037,17 @@ class Experiment:
             y_change = y - y_zheight
             dist = np.linalg.norm((x_change, y_change))
 
-            if dist > 50000 or x_zheight * y_zheight == 0 or x_zheight == 999999:
+            if height_map is not None:
+                # only measure the height if it cannot be predicted from the previous measurements
+                z_pred, sigma = height_map.predict(x, y)
+                measure = sigma > height_map.max_uncertainty
+                if not measure:
+                    self.ctrl.stage.z = z_pred
+                    self.logger.info(f'Stage position: x = {x}, y = {y}. Z height set to {z_pred:.0f} +- {sigma:.0f} from the height map')
+            else:
+                measure = dist > 50000 or x_zheight * y_zheight == 0 or x_zheight == 999999
+
+            if measure:
                 try:
                     img, h = self.ctrl.get_image(exposure=self.expt, header_keys=None)
                     if img.mean() > 10:
@@ -1035,6 +1062,8 @@ class Experiment:
                             if x_zheight != 999999:
                                 xpoint, ypoint, zpoint, aaa, bbb = self.ctrl.stage.get()
                                 self.logger.info(f'Stage position: x = {xpoint}, y = {ypoint}. Z height adjusted to {zpoint}. Tilt angle x {aaa} deg, Tilt angle y {bbb} deg')
+                                if height_map is not None:
+                                    height_map.add(xpoint, ypoint, zpoint)
                             else:
                                 self.print_and_del('Z height not found.')
                 except BaseException:
@@ -1043,12 +1072,50 @@ class Experiment:
 
             self.start_collection_point()
 
+            if planner is not None:
+                planner.update(j, self.number_crystals_scanned - n_crystals_scanned)
+
             t.set_description(f'Number of crystals scanned: {self.number_crystals_scanned}; Number of experiments performed: {self.number_exp_performed}')
 
             if self.stopEvent_rasterScan.is_set():
                 print('\nRaster Scan stopped manually.')
                 break
 
+    def plan_raster_scan(self, center, box):
+        """Estimate the number of crystals at every raster scan position from
+        a low-magnification overview image, see
+        `instamatic.experiments.serialed.scan_planner`.
+
+        Returns the `ScanPlanner`, or None if the overview failed.
+        """
+        from instamatic.experiments.serialed.scan_planner import ScanPlanner
+        from instamatic.experiments.serialed.scan_planner import take_overview
+
+        planner = ScanPlanner(np.array(center) + self.offsets, box=box)
+        try:
+            img, stagecoord, stagematrix = take_overview(self.ctrl, config.settings.autocred_overview_magnification, exposure=self.expt)
+            planner.estimate([img], stagecoords=[stagecoord], stagematrix=stagematrix)
+        except Exception as e:
+            self.print_and_del(f'Overview failed ({e}), scanning all positions.')
+            return None
+
+        report = planner.report(start=center)
+        print(report)
+        self.logger.info('Adaptive raster scan:\n%s', report)
+        return planner
+
+    def visit_offsets(self, planner, center_x, center_y):
+        """Yield the index and the offset of the raster scan positions in
+        the order of the planner, or in grid order if there is none."""
+        if planner is None:
+            yield from enumerate(self.offsets)
+            return
+
+        j = planner.next((center_x, center_y))
+        while j is not None:
+            yield j, self.offsets[j]
+            j = planner.next(planner.positions[j])
+
     def start_collection_point(self):
 
         IS1_Neut = self.ctrl.imageshift1.get()
@@ -10,6 +10,9 @@ import instamatic
 from instamatic import config
 from instamatic.formats import write_tiff
 from instamatic.processing.ImgConversionTPX import ImgConversionTPX as ImgConversion
+from instamatic.processing.online_conversion import OnlineConversion
+from instamatic.utils.framebuffer import FrameBuffer
+from instamatic.utils.telemetry import TelemetrySampler
 
 # degrees to rotate before activating data collection procedure
 ACTIVATION_THRESHOLD = 0.2
@@ -104,7 +107,16 @@ class Experiment:
         self.relax_beam_before_experiment = self.image_interval_enabled and config.settings.cred_relax_beam_before_experiment
 
         self.track_stage_position = config.settings.cred_track_stage_positions
-        self.stage_positions = []
+        self.telemetry = None
+
+        self.spot_finding = config.settings.cred_spot_finding
+        self.track_beamstop = config.settings.cred_track_beamstop
+        self.stop_on_dead_crystal = config.settings.cred_stop_on_dead_crystal
+        self.spot_monitor = None
+
+        self.spill_to_disk = config.settings.cred_spill_to_disk
+        self.online_conversion = config.settings.cred_online_conversion
+        self.converter = None
 
         if use_vm:
             self.s2 = socket.socket()
@@ -140,7 +152,8 @@ class Experiment:
         self.logger.info(f'Data collection camera length: {self.camera_length} mm')
         self.logger.info(f'Data collection spot size: {self.spotsize}')
 
-        self.logger.info(self.stage_positions)
+        if self.telemetry:
+            self.logger.info(f'Stage positions tracked: {self.telemetry.n_samples} samples at {self.telemetry.effective_rate():.1f} Hz ({self.telemetry.out})')
 
         with open(self.path / 'cRED_log.txt', 'w') as f:
             print(f'Program: {instamatic.__long_title__}', file=f)
@@ -192,7 +205,6 @@ class Experiment:
         Returns the starting value for the rotation.
         """
         self.start_position = self.ctrl.stage.get()
-        self.stage_positions.append((0, self.start_position))
         a = self.start_position[3]
 
         if self.mode == 'simulate':
@@ -244,8 +256,14 @@ class Experiment:
         self.setup_paths()
         self.log_start_status()
 
-        buffer = []
-        image_buffer = []
+        if self.spill_to_disk:
+            # frames are written to scratch files during the data collection
+            window = config.settings.cred_buffer_window
+            buffer = FrameBuffer(self.path / 'scratch' / 'diff', window=window)
+            image_buffer = FrameBuffer(self.path / 'scratch' / 'image', window=window)
+        else:
+            buffer = []
+            image_buffer = []
 
         if self.ctrl.mode != 'diff':
             self.ctrl.mode.set('diff')
@@ -260,6 +278,24 @@ class Experiment:
         self.start_angle = self.start_rotation()
         self.ctrl.cam.block()
 
+        if self.track_stage_position:
+            self.path.mkdir(exist_ok=True, parents=True)
+            self.telemetry = TelemetrySampler({'stage': self.ctrl.stage.get},
+                                              rate=config.settings.cred_track_stage_positions_rate,
+                                              out=self.path / 'stage_positions.h5')
+            self.telemetry.start()
+
+        if self.online_conversion and (self.tiff_path or self.smv_path or self.mrc_path):
+            self.converter = OnlineConversion(tiff_path=self.tiff_path,
+                                              smv_path=self.smv_path,
+                                              mrc_path=self.mrc_path,
+                                              flatfield=self.flatfield)
+
+        if self.spot_finding or self.stop_on_dead_crystal:
+            from instamatic.processing.spot_finder import SpotFinder, SpotMonitor
+            finder = SpotFinder.for_camera_length(self.ctrl.magnification.get())
+            self.spot_monitor = SpotMonitor(finder, history=max(100, self.stop_on_dead_crystal))
+
         i = 1
 
         t0 = time.perf_counter()
@@ -285,9 +321,6 @@ class Experiment:
 
                 diff = next_interval - time.perf_counter()  # seconds
 
-                if self.track_stage_position and diff > 0.1:
-                    self.stage_positions.append((i, self.ctrl.stage.get()))
-
                 time.sleep(diff)
 
             else:
@@ -295,10 +328,32 @@ class Experiment:
                 # print(f"{i} Image!")
                 buffer.append((i, img, h))
 
+                if self.converter:
+                    self.converter.submit(i, img, h)
+
+                if self.spot_monitor:
+                    self.spot_monitor.submit(i, img)
+                    if self.stop_on_dead_crystal and self.spot_monitor.is_dead(window=self.stop_on_dead_crystal):
+                        print_and_log(f'No diffraction spots in the last {self.stop_on_dead_crystal} frames, stopping data collection', logger=self.logger)
+                        self.stopEvent.set()
+
             i += 1
 
         t1 = time.perf_counter()
 
+        if self.telemetry:
+            self.telemetry.stop()
+
+        if self.spot_monitor:
+            self.spot_monitor.stop()
+
+        if self.spill_to_disk:
+            buffer.close()
+            image_buffer.close()
+
+        if self.converter:
+            self.converter.join()
+
         if self.mode == 'footfree':
             self.ctrl.stage.stop()
 
@@ -316,7 +371,6 @@ class Experiment:
         self.end_position = self.ctrl.stage.get()
         self.end_angle = self.end_position[3]
         self.camera_length = int(self.ctrl.magnification.get())
-        self.stage_positions.append((99999, self.end_position))
 
         is_moving = bool(self.ctrl.stage.is_moving())
         self.logger.info(f'Experiment finished, stage is moving: {is_moving}')
@@ -328,6 +382,9 @@ class Experiment:
         # in case something went wrong starting data collection, return gracefully
         if i == 1:
             print_and_log(f'Data collection interrupted', logger=self.logger)
+            self.delete_scratch(buffer, image_buffer)
+            if self.converter:
+                self.converter.discard()
             return False
 
         self.spotsize = self.ctrl.spotsize
@@ -353,10 +410,17 @@ class Experiment:
 
         if self.nframes <= 3:
             print_and_log(f'Not enough frames collected. Data will not be written (nframes={self.nframes})', logger=self.logger)
+            self.delete_scratch(buffer, image_buffer)
+            if self.converter:
+                self.converter.discard()
             return False
 
         self.write_data(buffer)
         self.write_image_data(image_buffer)
+        self.delete_scratch(buffer, image_buffer)
+
+        if self.spot_monitor:
+            self.spot_monitor.write(self.path / 'spot_statistics.txt')
 
         print('Data Collection and Conversion Done.')
 
@@ -373,6 +437,17 @@ class Experiment:
 
         return True
 
+    def delete_scratch(self, *buffers) -> None:
+        """Remove the scratch files of the frame buffers, lists are
+        ignored."""
+        for buffer in buffers:
+            if isinstance(buffer, FrameBuffer):
+                buffer.delete()
+        try:
+            (self.path / 'scratch').rmdir()
+        except OSError:
+            pass
+
     def write_data(self, buffer: list):
         """Write diffraction data in the buffer.
 
@@ -394,13 +469,23 @@ class Experiment:
                                  wavelength=self.wavelength,
                                  stretch_amplitude=self.stretch_amplitude,
                                  stretch_azimuth=self.stretch_azimuth,
+                                 beam_centers=self.converter.beam_centers if self.converter else None,
                                  )
 
-        print('Writing data files...')
-        img_conv.threadpoolwriter(tiff_path=self.tiff_path,
-                                  mrc_path=self.mrc_path,
-                                  smv_path=self.smv_path,
-                                  workers=8)
+        if self.converter:
+            # the data files were written during the data collection
+            if self.smv_path:
+                img_conv.update_smv_headers(self.smv_path)
+        else:
+            print('Writing data files...')
+            img_conv.threadpoolwriter(tiff_path=self.tiff_path,
+                                      mrc_path=self.mrc_path,
+                                      smv_path=self.smv_path,
+                                      workers=8)
+
+        if self.track_beamstop:
+            print('Tracking the beamstop...')
+            img_conv.track_beamstop()
 
         print('Writing input files...')
         if self.write_dials:
@@ -419,12 +504,11 @@ class Experiment:
 
         The image buffer is passed as a list of tuples, where each tuple
         contains the index (int), image data (2D numpy array),
-        metadata/header (dict).
+        metadata/header (dict), or as a `FrameBuffer`.
         """
         if buffer:
             drc = self.path / 'tiff_image'
             drc.mkdir(exist_ok=True)
-            while len(buffer) != 0:
-                i, img, h = buffer.pop(0)
+            for i, img, h in buffer:
                 fn = drc / f'{i:05d}.tiff'
                 write_tiff(fn, img, header=h)
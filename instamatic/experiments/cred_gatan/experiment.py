@@ -9,6 +9,7 @@ from scipy.interpolate import interp1d
 
 import instamatic
 from instamatic import config
+from instamatic.calibrate.height_map import get_height_map
 from instamatic.formats import write_tiff
 
 
@@ -412,6 +413,11 @@ class Experiment:
 
                 print(f'Wrote file {fn.name}')
 
+                height_map = get_height_map()
+                if height_map is not None:
+                    height_map.add(x_center, y_center, z_pos, angles=pos[:, 3], offsets=pos[:, 1] - y_center)
+                    print(f'Added the track to {height_map}')
+
 
 if __name__ == '__main__':
     from instamatic import TEMController
@@ -10,6 +10,7 @@ from scipy.interpolate import interp1d
 
 import instamatic
 from instamatic import config
+from instamatic.calibrate.height_map import get_height_map
 from instamatic.formats import write_tiff
 from instamatic.tools import get_acquisition_time
 
@@ -90,7 +91,10 @@ class SerialExperiment:
         self.ctrl.acquire_at_items(self.nav_items,
                                    acquire=acquire_cred_data,
                                    pre_acquire=go_to_first_position,
-                                   post_acquire=stop_liveview)
+                                   post_acquire=stop_liveview,
+                                   optimize_route=config.settings.cred_tvips_optimize_route)
+
+        self.ctrl.cam.wait_export()
 
         if self.rotation_speed:
             self.ctrl.stage.set_rotation_speed(12)
@@ -136,6 +140,8 @@ class SerialExperiment:
 
             time.sleep(3)
 
+        self.ctrl.cam.wait_export()
+
         t1 = time.perf_counter()
         dt = t1 - t0
         print(f'Serial experiment finished -> {n_measured} crystals measured')
@@ -432,7 +438,11 @@ class Experiment:
         path_data = self.path / 'tiff'
         path_data.mkdir(exist_ok=True, parents=True)
 
-        self.emmenu.writeTiffs(start_index, end_index, path=path_data)
+        # the files are written while the next crystal is set up, the camera
+        # waits for the export to finish before the buffers are used again
+        self.emmenu.writeTiffs(start_index, end_index, path=path_data,
+                               workers=config.settings.emmenu_export_workers,
+                               wait=not config.settings.emmenu_export_background)
 
         if self.track:
             # Center crystal position
@@ -447,7 +457,7 @@ class Experiment:
             if self.mode == 'diff':
                 self.ctrl.difffocus.refocus()
 
-        print(f'Wrote {nframes} images (#{start_index}->#{end_index}) to {path_data}')
+        print(f'Writing {nframes} images (#{start_index}->#{end_index}) to {path_data}')
 
         if self.track:
             print(f'Done with this crystal (number #{self.crystal_number})!')
@@ -560,6 +570,11 @@ class Experiment:
 
                 print(f'Wrote file {fn.name}')
 
+                height_map = get_height_map()
+                if height_map is not None:
+                    height_map.add(x_center, y_center, z_pos, angles=pos[:, 3], offsets=pos[:, 1] - y_center)
+                    print(f'Added the track to {height_map}')
+
 
 if __name__ == '__main__':
     from instamatic.io import get_new_work_subdirectory
@@ -9,6 +9,7 @@ from tqdm.auto import tqdm
 from instamatic import config
 from instamatic.formats import write_tiff
 from instamatic.processing.ImgConversionTPX import ImgConversionTPX as ImgConversion
+from instamatic.processing.online_conversion import OnlineConversion
 
 
 class Experiment:
@@ -46,6 +47,12 @@ class Experiment:
         self.current_angle = None
         self.buffer = []
 
+        self.converter = None
+        if config.settings.cred_online_conversion:
+            self.converter = OnlineConversion(tiff_path=self.tiff_path,
+                                              mrc_path=self.mrc_path,
+                                              flatfield=self.flatfield)
+
     def start_collection(self, exposure_time: float, tilt_range: float, stepsize: float):
         """Start or continue data collection for `tilt_range` degrees with
         steps given by `stepsize`, To finalize data collection and write data
@@ -102,6 +109,9 @@ class Experiment:
 
             self.buffer.append((j, img, h))
 
+            if self.converter:
+                self.converter.submit(j, img, h)
+
         self.offset += len(tilt_positions)
         self.nframes = j
 
@@ -132,6 +142,8 @@ class Experiment:
         Write data in `self.buffer` to path given by `self.path`.
         """
         self.logger.info(f'Data saving path: {self.path}')
+        if self.converter:
+            self.converter.join()
         self.rotation_axis = config.camera.camera_rotation_vs_stage_xy
 
         self.pixelsize = config.calibration['diff']['pixelsize'][self.camera_length]  # px / Angstrom
@@ -166,12 +178,14 @@ class Experiment:
                                  wavelength=self.wavelength,
                                  stretch_amplitude=self.stretch_amplitude,
                                  stretch_azimuth=self.stretch_azimuth,
+                                 beam_centers=self.converter.beam_centers if self.converter else None,
                                  )
 
-        print('Writing data files...')
-        img_conv.threadpoolwriter(tiff_path=self.tiff_path,
-                                  mrc_path=self.mrc_path,
-                                  workers=8)
+        if not self.converter:
+            print('Writing data files...')
+            img_conv.threadpoolwriter(tiff_path=self.tiff_path,
+                                      mrc_path=self.mrc_path,
+                                      workers=8)
 
         print('Writing input files...')
         img_conv.write_ed3d(self.mrc_path)
@@ -1,9 +1,9 @@
+import concurrent.futures
 import json
 import logging
 import time
 from pathlib import Path
 
-import matplotlib.pyplot as plt
 import numpy as np
 from tqdm.auto import tqdm
 
@@ -11,10 +11,9 @@ from instamatic import config
 from instamatic.calibrate import CalibBeamShift
 from instamatic.calibrate import CalibDirectBeam
 from instamatic.formats import *
-from instamatic.processing.find_crystals import find_crystals
-from instamatic.processing.find_crystals import find_crystals_timepix
+from instamatic.processing.bad_pixels import BadPixelMap
+from instamatic.processing.find_crystals import CrystalFinder
 from instamatic.processing.flatfield import apply_flatfield_correction
-from instamatic.processing.flatfield import remove_deadpixels
 
 
 def make_grid_on_stage(startpoint, endpoint, padding=2.0):
@@ -75,7 +74,6 @@ def get_offsets_in_scan_area(box_x, box_y=0, radius=75, padding=2, k=1.0, angle=
     k: float,
         scaling factor for the borderwidth
     """
-
     nx = 1 + int(2.0 * radius / (box_x + padding))
     if box_y:
         ny = 1 + int(2.0 * radius / (box_y + padding))
@@ -97,6 +95,7 @@ def get_offsets_in_scan_area(box_x, box_y=0, radius=75, padding=2, k=1.0, angle=
         x_offsets, y_offsets = np.dot(np.vstack([x_offsets, y_offsets]).T, r).T
 
     if plot:
+        import matplotlib.pyplot as plt
         from matplotlib import patches
 
         num = len(x_offsets)
@@ -243,15 +242,14 @@ class Experiment:
         self.crystal_spread = kwargs.get('crystal_spread', 0.6)
 
         if self.ctrl.cam.name == 'timepix':
-            self.find_crystals = find_crystals_timepix
+            self.crystal_finder = CrystalFinder.timepix(spread=self.crystal_spread)
             self.flatfield = kwargs.get('flatfield', 'flatfield.tiff')
         else:
-            self.find_crystals = find_crystals
+            self.crystal_finder = CrystalFinder(spread=self.crystal_spread)
             self.flatfield = None
 
         if self.flatfield is not None:
-            self.flatfield, h_flatfield = read_tiff(self.flatfield)
-            self.deadpixels = h_flatfield['deadpixels']
+            self.load_flatfield(self.flatfield)
 
         # self.sample_rotation_angles = ( -10, -5, 5, 10 )
         # self.sample_rotation_angles = (-5, 5)
@@ -402,7 +400,8 @@ class Experiment:
         if ncrystals == 0:
             raise StopIteration('No crystals found.')
 
-        self.diffraction_mode()
+        if self.ctrl.mode != 'diff':
+            self.diffraction_mode()
         beamshift_coords = self.calib_beamshift.pixelcoord_to_beamshift(crystal_coords)
 
         t = tqdm(beamshift_coords, desc='                           ')
@@ -431,14 +430,30 @@ class Experiment:
 
             yield dct
 
+    def load_flatfield(self, fn: str) -> None:
+        """Load the flatfield and the bad pixel map used by
+        `apply_corrections`."""
+        self.flatfield, h_flatfield = read_tiff(fn)
+        self.bad_pixels = BadPixelMap.for_flatfield(fn, header=h_flatfield, shape=self.flatfield.shape, timepix=False)
+        # the division by the flatfield already compensates the enlarged
+        # center pixels, so they must not be scaled as well
+        self.bad_pixels.clear_gaps()
+
     def apply_corrections(self, img, h):
         if self.flatfield is not None:
-            img = remove_deadpixels(img, deadpixels=self.deadpixels)
+            img = self.bad_pixels.correct(img, out=img)
             h['DeadPixelCorrection'] = True
             img = apply_flatfield_correction(img, flatfield=self.flatfield)
             h['FlatfieldCorrection'] = True
         return img, h
 
+    def write_image(self, outfile, img, h, correct: bool = True):
+        """Apply the corrections to `img` and write it to `outfile`, runs
+        on the writer thread."""
+        if correct:
+            img, h = self.apply_corrections(img, h)
+        write_hdf5(outfile, img, header=h)
+
     def run(self, ctrl=None, **kwargs):
         """Run serial electron diffraction experiment."""
 
@@ -468,79 +483,108 @@ class Experiment:
 
         input("\nPress <ENTER> to start experiment ('Ctrl-C' to interrupt)\n")
 
-        for i, d_pos in enumerate(self.loop_positions()):
-
-            outfile = self.imagedir / f'image_{i:04d}'
+        # The overview image of every position is segmented in a worker
+        # process, while the acquisition thread switches to diffraction mode.
+        # Images are corrected and written on a separate thread.
+        finder = self.crystal_finder
+        writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        writes = []
 
-            if self.change_spotsize:
-                self.ctrl.tem.setSpotSize(self.image_spotsize)
+        def write(outfile, img, h, correct=True):
+            for future in [future for future in writes if future.done()]:
+                future.result()  # raise errors from the writer
+                writes.remove(future)
+            writes.append(writer.submit(self.write_image, outfile, img, h, correct=correct))
 
-            img, h = self.ctrl.get_image(exposure=self.image_exposure, binsize=self.image_binsize, header_keys=header_keys)
+        # switch to diffraction mode during segmentation only if crystals were
+        # found at the previous position, switching back costs time otherwise
+        prepare_diffraction = True
 
-            if self.change_spotsize:
-                self.ctrl.tem.setSpotSize(self.image_spotsize)
+        try:
+            for i, d_pos in enumerate(self.loop_positions()):
 
-            self.ctrl.tem.setSpotSize(self.diff_spotsize)
+                outfile = self.imagedir / f'image_{i:04d}'
 
-            im_mean = img.mean()
-            if im_mean < self.image_threshold:
-                # self.log.debug("Dark image detected (mean=%f)", im_mean)
-                continue
+                if self.change_spotsize:
+                    self.ctrl.tem.setSpotSize(self.image_spotsize)
 
-            img, h = self.apply_corrections(img, h)
+                img, h = self.ctrl.get_image(exposure=self.image_exposure, binsize=self.image_binsize, header_keys=header_keys)
 
-            crystal_positions = self.find_crystals(img, self.magnification, spread=self.crystal_spread) * self.image_binsize
-            crystal_coords = [(crystal.x, crystal.y) for crystal in crystal_positions]
+                if self.change_spotsize:
+                    self.ctrl.tem.setSpotSize(self.image_spotsize)
 
-            for d in (d_image, d_pos):
-                h.update(d)
-            h['exp_crystal_coords'] = crystal_coords
+                self.ctrl.tem.setSpotSize(self.diff_spotsize)
 
-            write_hdf5(outfile, img, header=h)
+                im_mean = img.mean()
+                if im_mean < self.image_threshold:
+                    # self.log.debug("Dark image detected (mean=%f)", im_mean)
+                    continue
 
-            ncrystals = len(crystal_coords)
-            if ncrystals == 0:
-                continue
+                img, h = self.apply_corrections(img, h)
 
-            self.log.info('%d crystals found in %s', ncrystals, outfile)
+                future = finder.submit(img, self.magnification)
+                if prepare_diffraction:
+                    self.diffraction_mode()
+                crystal_positions = future.result()
 
-            for k, d_cryst in enumerate(self.loop_crystals(crystal_coords)):
-                outfile = self.datadir / f'image_{i:04d}_{k:04d}'
-                comment = f'Image {i} Crystal {k}'
-                img, h = self.ctrl.get_image(binsize=self.diff_binsize, exposure=self.diff_exposure, comment=comment, header_keys=header_keys)
-                img, h = self.apply_corrections(img, h)
+                crystal_coords = [(crystal.x * self.image_binsize, crystal.y * self.image_binsize) for crystal in crystal_positions]
 
-                for d in (d_diff, d_pos, d_cryst):
+                for d in (d_image, d_pos):
                     h.update(d)
+                h['exp_crystal_coords'] = crystal_coords
+
+                write(outfile, img, h, correct=False)
+
+                ncrystals = len(crystal_coords)
+                prepare_diffraction = ncrystals > 0
+                if ncrystals == 0:
+                    if self.ctrl.mode == 'diff':
+                        self.image_mode()
+                    continue
+
+                self.log.info('%d crystals found in %s', ncrystals, outfile)
+
+                for k, d_cryst in enumerate(self.loop_crystals(crystal_coords)):
+                    outfile = self.datadir / f'image_{i:04d}_{k:04d}'
+                    comment = f'Image {i} Crystal {k}'
+                    img, h = self.ctrl.get_image(binsize=self.diff_binsize, exposure=self.diff_exposure, comment=comment, header_keys=header_keys)
+
+                    for d in (d_diff, d_pos, d_cryst):
+                        h.update(d)
+
+                    h['crystal_is_isolated'] = crystal_positions[k].isolated
+                    h['crystal_clusters'] = crystal_positions[k].n_clusters
+                    h['total_area_micrometer'] = crystal_positions[k].area_micrometer
+                    h['total_area_pixel'] = crystal_positions[k].area_pixel
 
-                h['crystal_is_isolated'] = crystal_positions[k].isolated
-                h['crystal_clusters'] = crystal_positions[k].n_clusters
-                h['total_area_micrometer'] = crystal_positions[k].area_micrometer
-                h['total_area_pixel'] = crystal_positions[k].area_pixel
+                    # img_processed = neural_network.preprocess(img.astype(np.float))
+                    # quality = neural_network.predict(img_processed)
+                    # h["crystal_quality"] = quality
 
-                # img_processed = neural_network.preprocess(img.astype(np.float))
-                # quality = neural_network.predict(img_processed)
-                # h["crystal_quality"] = quality
+                    write(outfile, img, h)
 
-                write_hdf5(outfile, img, header=h)
+                    if self.sample_rotation_angles:
+                        for rotation_angle in self.sample_rotation_angles:
+                            self.log.debug('Rotation angle = %f', rotation_angle)
+                            self.ctrl.stage.a = rotation_angle
 
-                if self.sample_rotation_angles:
-                    for rotation_angle in self.sample_rotation_angles:
-                        self.log.debug('Rotation angle = %f', rotation_angle)
-                        self.ctrl.stage.a = rotation_angle
+                            outfile = self.datadir / f'image_{i:04d}_{k:04d}_{rotation_angle}'
+                            img, h = self.ctrl.get_image(exposure=self.diff_exposure, binsize=self.diff_binsize, comment=comment, header_keys=header_keys)
 
-                        outfile = self.datadir / f'image_{i:04d}_{k:04d}_{rotation_angle}'
-                        img, h = self.ctrl.get_image(exposure=self.diff_exposure, binsize=self.diff_binsize, comment=comment, header_keys=header_keys)
-                        img, h = self.apply_corrections(img, h)
+                            for d in (d_diff, d_pos, d_cryst):
+                                h.update(d)
 
-                        for d in (d_diff, d_pos, d_cryst):
-                            h.update(d)
+                            write(outfile, img, h)
 
-                        write_hdf5(outfile, img, header=h)
+                        self.ctrl.stage.a = 0
 
-                    self.ctrl.stage.a = 0
+                self.image_mode()
+        finally:
+            writer.shutdown(wait=True)
+            finder.close()
 
-            self.image_mode()
+        for future in writes:
+            future.result()
 
         print('\n\nData collection finished.')
 
@@ -0,0 +1,272 @@
+"""Adaptive scan planning for serial ED.
+
+`ScanPlanner` takes the scan positions of a serial ED experiment (see
+`get_offsets_in_scan_area`) and decides in which order to visit them.
+It does not walk the grid blindly. The number of crystals per scan cell
+is first estimated from a low-magnification overview image or a
+montage, using a cheap detector (the threshold backend of
+`CrystalFinder`). Cells where no crystals are expected are skipped. The
+next cell is the one with the highest expected number of crystals per
+second, which includes the stage travel time (see
+`instamatic.utils.stage_route.StageCostModel`). Dense regions are
+therefore visited first.
+
+As the experiment runs, the number of crystals actually found at each
+cell is passed to `update`. The estimates of the remaining cells are
+then recalibrated:
+- the detector counts are scaled by the ratio of found to predicted
+  crystals over all visited cells
+- the remaining error of the visited neighbours is added
+
+The route is re-planned every time `next` is called.
+
+Usage:
+    planner = ScanPlanner(center + offsets, box=(box_x, box_y))
+    planner.estimate([img], stagecoords=[center], stagematrix=stagematrix)
+    print(planner.report(start=center))
+    j = planner.next(ctrl.stage.xy)
+    while j is not None:
+        ...
+        planner.update(j, n_crystals)
+        j = planner.next(ctrl.stage.xy)
+"""
+import numpy as np
+
+from instamatic.processing.find_crystals import CrystalFinder
+from instamatic.utils.stage_route import StageCostModel
+
+
+def take_overview(ctrl, magnification: int, exposure: float = None, mode: str = 'lowmag') -> tuple:
+    """Take an overview image at `magnification` in `mode`, and restore the
+    current alignment afterwards.
+
+    Returns the image, the stage coordinates (nm) of the image center, and
+    the stagematrix of the image (see `TEMController.get_stagematrix`).
+    """
+    ctrl.store('scan_planner')
+    try:
+        ctrl.mode.set(mode)
+        ctrl.magnification.value = magnification
+        img, h = ctrl.get_image(exposure=exposure, header_keys=None)
+        binning = h.get('ImageBinsize', ctrl.cam.getBinning())
+        stagematrix = ctrl.get_stagematrix(binning=binning, mag=magnification, mode=mode)
+        stagecoord = np.array(ctrl.stage.xy, dtype=float)
+    finally:
+        ctrl.restore('scan_planner')
+    return img, stagecoord, stagematrix
+
+
+class ScanPlanner:
+    """Plans the visiting order of the scan positions by the expected number
+    of crystals.
+
+    positions: np.ndarray (N, 2)
+        Stage coordinates (nm) of the centers of the scan cells
+    box: tuple
+        Size (nm) of a scan cell, i.e. the area covered by one image
+    cost_model: StageCostModel
+        Model for the stage travel time, uses the default if None
+    t_image: float
+        Time in seconds to image a cell and find the crystals
+    t_crystal: float
+        Time in seconds to collect data on one crystal
+    min_expected: float
+        Cells with fewer expected crystals are skipped
+    radius: float
+        Distance (nm) within which observed counts inform the estimate of
+        the neighbouring cells, defaults to 1.5 times the cell size
+    """
+
+    def __init__(self,
+                 positions,
+                 box: tuple,
+                 cost_model: StageCostModel = None,
+                 t_image: float = 10.0,
+                 t_crystal: float = 60.0,
+                 min_expected: float = 0.25,
+                 radius: float = None,
+                 ):
+        super().__init__()
+        from scipy.spatial import cKDTree
+
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.box = np.array(box, dtype=float)
+        self.cost_model = cost_model or StageCostModel()
+        self.t_image = t_image
+        self.t_crystal = t_crystal
+        self.min_expected = min_expected
+        if radius is None:
+            radius = 1.5 * self.box.max()
+
+        n = len(self.positions)
+        self.prior = np.full(n, np.nan)  # detector counts, nan if not covered by an overview
+        self.observed = np.full(n, np.nan)  # crystals found, nan if not visited
+        self.scale = 1.0
+
+        self._tree = cKDTree(self.positions)
+        self._neighbours = [np.array(sorted(set(nb) - {i}), dtype=int)
+                            for i, nb in enumerate(self._tree.query_ball_point(self.positions, r=radius))]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(positions={len(self.positions)}, visited={self.n_visited})'
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    @property
+    def visited(self) -> np.ndarray:
+        return ~np.isnan(self.observed)
+
+    @property
+    def n_visited(self) -> int:
+        return int(self.visited.sum())
+
+    def add_particles(self, coords, covered=None) -> None:
+        """Add particles at stage coordinates `coords` (nm) to the
+        detector counts of the cell they fall in.
+
+        `covered` is a boolean array marking the cells covered by the
+        overview, all cells with particles are covered. Cells not covered
+        by any overview get the mean density of the covered cells.
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if covered is None:
+            covered = np.zeros(len(self), dtype=bool)
+
+        dist, idx = self._tree.query(coords) if len(coords) else (np.array([]), np.array([], dtype=int))
+        inside = dist <= 0.5 * np.hypot(*self.box)
+        counts = np.bincount(idx[inside], minlength=len(self))
+
+        covered = covered | (counts > 0)
+        self.prior[covered] = np.nan_to_num(self.prior[covered]) + counts[covered]
+
+    def estimate(self, images, stagecoords, stagematrix, finder: CrystalFinder = None, processes: int = None) -> None:
+        """Estimate the number of crystals per cell from overview images
+        or montage tiles.
+
+        images: list of 2d np.ndarray
+            Overview images
+        stagecoords: np.ndarray (N, 2)
+            Stage coordinates (nm) of the center of every image
+        stagematrix: np.ndarray (2, 2)
+            Matrix that converts pixel coordinates to stage coordinates, or
+            a list with one matrix per image
+        finder: CrystalFinder
+            Detector, defaults to the threshold backend of `CrystalFinder`,
+            which counts every particle once
+        processes: int
+            Number of worker processes for the detector
+        """
+        images = list(images)
+        stagecoords = np.asarray(stagecoords, dtype=float).reshape(-1, 2)
+        stagematrices = np.broadcast_to(np.asarray(stagematrix, dtype=float).reshape(-1, 2, 2), (len(images), 2, 2))
+        pixelsizes = np.sqrt(np.abs(np.linalg.det(stagematrices))) / 1000  # nm -> um
+
+        if finder is None:
+            # count the particles, do not split them up in crystals
+            finder = CrystalFinder(method='threshold', spread=np.inf, footprint=1, remove_carbon_lacing=False, maxdim=512)
+        with finder:
+            results = finder.find_batch(images, pixelsize=list(pixelsizes), processes=processes)
+
+        covered = np.zeros(len(self), dtype=bool)
+        coords = []
+        for img, stagecoord, stagematrix, crystals in zip(images, stagecoords, stagematrices, results):
+            center = np.array(img.shape) / 2
+
+            # cells with their center inside the image
+            px = np.dot(self.positions - stagecoord, np.linalg.inv(stagematrix)) + center
+            covered |= np.all((px >= 0) & (px < img.shape), axis=1)
+
+            px = np.array([(crystal.x, crystal.y) for crystal in crystals]).reshape(-1, 2)
+            coords.append(np.dot(px - center, stagematrix) + stagecoord)
+
+        self.add_particles(np.concatenate(coords), covered=covered)
+
+    def estimate_montage(self, montage, finder: CrystalFinder = None, processes: int = None) -> None:
+        """Estimate the number of crystals per cell from the tiles of a
+        `Montage` (pyserialem) or `InstamaticMontage`."""
+        self.estimate(montage.images, stagecoords=montage.stagecoords, stagematrix=montage.stagematrix,
+                      finder=finder, processes=processes)
+
+    @property
+    def expected(self) -> np.ndarray:
+        """Expected number of crystals per cell, the observed number for
+        visited cells."""
+        prior = self.prior.copy()
+        covered = ~np.isnan(prior)
+        prior[~covered] = prior[covered].mean() if covered.any() else self.min_expected
+        expected = prior * self.scale
+
+        visited = self.visited
+        if visited.any():
+            residual = np.where(visited, self.observed - expected, 0.0)
+            for i in np.flatnonzero(~visited):
+                nb = self._neighbours[i]
+                nb = nb[visited[nb]]
+                if len(nb):
+                    expected[i] += residual[nb].mean()
+            expected[visited] = self.observed[visited]
+
+        return np.clip(expected, 0, None)
+
+    def update(self, index: int, n_crystals: int) -> None:
+        """Record that `n_crystals` crystals were found in cell `index`, and
+        recalibrate the estimates of the remaining cells."""
+        self.observed[index] = n_crystals
+
+        visited = self.visited & ~np.isnan(self.prior)
+        if visited.any():
+            # add one pseudo-count so that a few empty cells do not zero the scale
+            self.scale = (self.observed[visited].sum() + 1) / (self.prior[visited].sum() + 1)
+
+    def _next(self, position, expected: np.ndarray, todo: np.ndarray):
+        candidates = np.flatnonzero(todo & (expected >= self.min_expected))
+        if not len(candidates):
+            return None
+        travel = self.cost_model.cost_matrix(np.asarray(position, dtype=float)[:2], self.positions[candidates])[0]
+        rate = expected[candidates] / (travel + self.t_image + self.t_crystal * expected[candidates])
+        return int(candidates[np.argmax(rate)])
+
+    def next(self, position):
+        """Index of the next cell to visit from the stage `position` (nm), or
+        None if no cells with crystals are left."""
+        return self._next(position, self.expected, ~self.visited)
+
+    def plan(self, start) -> list:
+        """Visiting order of the remaining cells from `start` with the
+        current estimates."""
+        expected = self.expected
+        todo = ~self.visited
+        order = []
+        position = start
+        while True:
+            j = self._next(position, expected, todo)
+            if j is None:
+                break
+            order.append(j)
+            todo[j] = False
+            position = self.positions[j]
+        return order
+
+    def route_time(self, order, start, expected: np.ndarray = None) -> float:
+        """Estimated time in seconds to visit the cells in `order`"""
+        if expected is None:
+            expected = self.expected
+        order = np.asarray(order, dtype=int)
+        travel = self.cost_model.route_time(self.positions, order, start=np.asarray(start, dtype=float)[:2])
+        return travel + len(order) * self.t_image + self.t_crystal * expected[order].sum()
+
+    def report(self, start) -> str:
+        """Expected number of crystals per hour of the adaptive plan versus
+        the uniform grid (all cells in the given order)."""
+        expected = self.expected
+        uniform = np.arange(len(self))
+        adaptive = self.plan(start)
+
+        lines = []
+        for name, order in ('Uniform grid', uniform), ('Adaptive', adaptive):
+            t = self.route_time(order, start, expected)
+            n = expected[order].sum()
+            rate = 3600 * n / t if t > 0 else 0.0
+            lines.append(f'{name:12s}: {len(order):5d} cells, {n:7.1f} crystals in {t / 3600:6.2f} h -> {rate:6.1f} crystals/h')
+        return '\n'.join(lines)
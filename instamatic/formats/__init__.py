@@ -1,13 +1,13 @@
 import os
 import warnings
+from collections.abc import Mapping
 from pathlib import Path
 
-import h5py
 import numpy as np
-import tifffile
 import yaml
 
 from .adscimage import read_adsc
+from .adscimage import update_adsc_header
 from .adscimage import write_adsc
 from .csvIO import read_csv
 from .csvIO import read_ycsv
@@ -47,11 +47,13 @@ def write_tiff(fname: str, data, header: dict = None):
         dictionary containing the metadata that should be saved
         key/value pairs are stored as yaml in the TIFF ImageDescription tag
     """
-    if isinstance(header, dict):
-        header = yaml.dump(header)
+    if isinstance(header, Mapping):
+        header = yaml.dump(dict(header))
     if not header:
         header = ''
 
+    import tifffile
+
     fname = Path(fname).with_suffix('.tiff')
 
     with tifffile.TiffWriter(fname) as f:
@@ -68,6 +70,8 @@ def read_tiff(fname: str) -> (np.array, dict):
         image: np.ndarray, header: dict
             a tuple of the image as numpy array and dictionary with all the tem parameters and image attributes
     """
+    import tifffile
+
     tiff = tifffile.TiffFile(fname)
 
     page = tiff.pages[0]
@@ -94,6 +98,8 @@ def write_hdf5(fname: str, data, header: dict = None):
         dictionary containing the metadata that should be saved
         key/value pairs are stored as attributes on the data
     """
+    import h5py
+
     fname = Path(fname).with_suffix('.h5')
 
     f = h5py.File(fname, 'w')
@@ -116,6 +122,8 @@ def read_hdf5(fname: str) -> (np.array, dict):
     if not os.path.exists(fname):
         raise FileNotFoundError(f"No such file: '{fname}'")
 
+    import h5py
+
     f = h5py.File(fname, 'r')
     return np.array(f['data']), dict(f['data'].attrs)
 
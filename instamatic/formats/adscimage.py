@@ -19,13 +19,8 @@ def swap_needed(header: dict) -> bool:
         return True
 
 
-def write_adsc(fname: str, data: np.array, header: dict = {}):
-    """Write adsc format."""
-    if 'SIZE1' not in header and 'SIZE2' not in header:
-        dim2, dim1 = data.shape
-        header['SIZE1'] = dim1
-        header['SIZE2'] = dim2
-
+def format_adsc_header(header: dict) -> bytes:
+    """Format the adsc header, padded to a multiple of 512 bytes."""
     out = b'{\n'
     for key in header:
         out += '{:}={:};\n'.format(key, header[key]).encode()
@@ -38,6 +33,17 @@ def write_adsc(fname: str, data: np.array, header: dict = {}):
         pad = hsize - len(out) - 2
     out += b'}' + (pad + 1) * b'\x00'
     assert len(out) % 512 == 0, 'Header is not multiple of 512'
+    return out
+
+
+def write_adsc(fname: str, data: np.array, header: dict = {}):
+    """Write adsc format."""
+    if 'SIZE1' not in header and 'SIZE2' not in header:
+        dim2, dim1 = data.shape
+        header['SIZE1'] = dim1
+        header['SIZE2'] = dim2
+
+    out = format_adsc_header(header)
 
     # NOTE: XDS can handle only "SMV" images of TYPE=unsigned_short.
     dtype = np.uint16
@@ -50,6 +56,22 @@ def write_adsc(fname: str, data: np.array, header: dict = {}):
         outf.write(data.tostring())
 
 
+def update_adsc_header(fname: str, header: dict):
+    """Replace the header of adsc file `fname` in place, without rewriting
+    the image data.
+
+    The new header must have the same size as the old one, so
+    `HEADER_BYTES` should be given explicitly.
+    """
+    out = format_adsc_header(header)
+    with open(fname, 'r+b') as f:
+        old = readheader(f)
+        if int(old['HEADER_BYTES']) != len(out):
+            raise ValueError(f'{fname}: header size changed from {old["HEADER_BYTES"]} to {len(out)} bytes')
+        f.seek(0)
+        f.write(out)
+
+
 def readheader(infile):
     """read an adsc header."""
     header = {}
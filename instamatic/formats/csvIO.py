@@ -1,7 +1,6 @@
 import io
 from collections import OrderedDict
 
-import pandas as pd
 import yaml
 
 
@@ -24,6 +23,8 @@ def write_csv(f, results):
 
 def read_csv(f):
     """Read a csv file into a pandas DataFrame."""
+    import pandas as pd
+
     if isinstance(f, (list, tuple)):
         return pd.concat(read_csv(csv) for csv in f)
     else:
@@ -40,6 +41,7 @@ def read_ycsv(f):
         ---
         $CSV_BLOCK
     """
+    import pandas as pd
 
     if isinstance(f, str):
         f = open(f, 'r')
@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import numpy as np
 from pyserialem.montage import make_grid
 from pyserialem.montage import sorted_grid_indices
@@ -185,6 +184,7 @@ class GridMontage:
 
     def plot(self):
         """Simple plot of the stage coordinates."""
+        import matplotlib.pyplot as plt
         coords = self.stagecoords / 1000  # nm -> μm
         plt.scatter(*coords.T, marker='.', color='red')
         for i, coord in enumerate(coords):
@@ -1,6 +1,6 @@
+from functools import lru_cache
+
 import numpy as np
-from scipy import ndimage
-from skimage import exposure
 
 from instamatic import config
 
@@ -8,16 +8,27 @@ from instamatic import config
 def autoscale(img: np.ndarray, maxdim: int = 512) -> (np.ndarray, float):
     """Scale the image to fit the maximum dimension given by `maxdim` Returns
     the scaled image, and the image scale."""
+    from scipy import ndimage
+
     if maxdim:
         scale = float(maxdim) / max(img.shape)
 
     return ndimage.zoom(img, scale, order=1), scale
 
 
+@lru_cache(maxsize=None)
+def disk(radius: int) -> np.ndarray:
+    """Disk-shaped structuring element (`skimage.morphology.disk`), cached
+    so that it is only created once."""
+    from skimage import morphology
+    return morphology.disk(radius)
+
+
 def imgscale(img: np.ndarray, scale: float) -> np.ndarray:
     """Scale the image by the given scale."""
     if scale == 1:
         return img
+    from scipy import ndimage
     return ndimage.zoom(img, scale, order=1)
 
 
@@ -39,10 +50,7 @@ def rotate_image(arr, mode: str, mag: int) -> np.array:
     arr : np.array
         Flipped and rotated image array
     """
-    try:
-        k = config.calibration[mode]['rot90'][mag]
-    except KeyError:
-        k = 0
+    k = config.calibration_tables.get(mode, 'rot90', mag, 0)
 
     flipud = config.calibration[mode].get('flipud', False)
     fliplr = config.calibration[mode].get('fliplr', False)
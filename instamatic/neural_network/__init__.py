@@ -1,2 +1,4 @@
 from .neural_network import predict
+from .neural_network import predict_batch
 from .preprocess import preprocess
+from .preprocess import preprocess_batch
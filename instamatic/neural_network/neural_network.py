@@ -7,49 +7,91 @@ with open(Path(__file__).parent / 'weights-py3.p', 'rb') as p_file:
     weights = pickle.load(p_file)
 
 
+def _patches(in_layer):
+    """Return a view of all 3x3 patches of `in_layer` with shape (N, H-2,
+    W-2, 3, 3, C)"""
+    n, h, w, c = in_layer.shape
+    sn, sh, sw, sc = in_layer.strides
+    return np.lib.stride_tricks.as_strided(in_layer,
+                                           shape=(n, h - 2, w - 2, 3, 3, c),
+                                           strides=(sn, sh, sw, sh, sw, sc),
+                                           writeable=False)
+
+
 def conv_layer(in_layer, weight, offset):
-    first_layer = np.ones([(in_layer.shape[0] - 2) * (in_layer.shape[1] - 2), in_layer.shape[2], 3, 3])
-    q = 0
-    for n in range(in_layer.shape[0] - 2):
-        for p in range(in_layer.shape[1] - 2):
-            first_layer[q] = np.transpose(in_layer[n:n + 3, p:p + 3], [2, 0, 1])
-            q += 1
-    convoluted = np.tensordot(first_layer, weight, axes=(((2, 3, 1), (0, 1, 2))))
-    convoluted_reshaped = convoluted.reshape([in_layer.shape[0] - 2, in_layer.shape[1] - 2, 64])
+    """3x3 convolution (valid padding) of `in_layer` with shape (H, W, C),
+    or (N, H, W, C) for a batch of images, using im2col and a single
+    matrix product."""
+    batch = in_layer.ndim == 4
+    if not batch:
+        in_layer = in_layer[np.newaxis]
+    n, h, w, c = in_layer.shape
+
+    # im2col, the patch matrix has the same layout that `np.tensordot` creates internally
+    cols = np.empty((n, h - 2, w - 2, 3, 3, c))
+    cols[...] = _patches(in_layer)
+    cols = cols.reshape(-1, 9 * c)
+
+    convoluted = np.dot(cols, weight.reshape(9 * c, -1).astype(cols.dtype))
+    convoluted_reshaped = convoluted.reshape([n, h - 2, w - 2, -1])
     convoluted_reshaped += offset
 
+    if not batch:
+        convoluted_reshaped = convoluted_reshaped[0]
     return convoluted_reshaped
 
 
 def relu(convoluted):
-    convoluted[convoluted < 0] = 0
-    return convoluted
+    return np.maximum(convoluted, 0, out=convoluted)
 
 
 def max_pooling(convoluted):
-    pooled = np.ones((convoluted.shape[0] // 2, convoluted.shape[1] // 2, convoluted.shape[2]))
-    for n in range(convoluted.shape[0] // 2):
-        for p in range(convoluted.shape[1] // 2):
-            pooled[n, p] = np.amax(convoluted[n * 2:n * 2 + 2, p * 2:p * 2 + 2], axis=(0, 1))
-    return pooled
+    """2x2 max pooling over the two spatial axes of (H, W, C) or (N, H, W,
+    C) arrays, odd rows/columns are dropped."""
+    *lead, h, w, c = convoluted.shape
+    h, w = h // 2, w // 2
+    blocks = convoluted[..., :h * 2, :w * 2, :].reshape(*lead, h, 2, w, 2, c)
+    return blocks.max(axis=(-4, -2))
 
 
 def logistic(x):
     return 1 / (1 + np.exp(-x))
 
 
-def predict(image, weights=weights):
-    convoluted1 = relu(conv_layer(image, weights[0], weights[1]))
-    pooled1 = max_pooling(convoluted1)
-    convoluted2 = relu(conv_layer(pooled1, weights[2], weights[3]))
-    pooled2 = max_pooling(convoluted2)
-    convoluted3 = relu(conv_layer(pooled2, weights[4], weights[5]))
-    pooled3 = max_pooling(convoluted3)
-    convoluted4 = relu(conv_layer(pooled3, weights[6], weights[7]))
-    pooled4 = max_pooling(convoluted4)
+def forward(images, weights=weights):
+    """Run a batch of preprocessed images with shape (N, 150, 150, 1)
+    through the network, every layer processes all N images in a single
+    matrix product. Returns an array with N scores."""
+    n = len(images)
+    # max pooling and relu commute, pooling first means less work for relu
+    pooled1 = relu(max_pooling(conv_layer(images, weights[0], weights[1])))
+    pooled2 = relu(max_pooling(conv_layer(pooled1, weights[2], weights[3])))
+    pooled3 = relu(max_pooling(conv_layer(pooled2, weights[4], weights[5])))
+    pooled4 = relu(max_pooling(conv_layer(pooled3, weights[6], weights[7])))
     convoluted5 = relu(conv_layer(pooled4, weights[8], weights[9]))
-    flattened = convoluted5.reshape((1, 1600))
+    flattened = convoluted5.reshape((n, 1600))
     dense1 = relu(np.tensordot(flattened, weights[10], axes=(1, 0)) + weights[11])
     dense2 = relu(np.tensordot(dense1, weights[12], axes=(1, 0)) + weights[13])
     dense3 = np.tensordot(dense2, weights[14], axes=(1, 0)) + weights[15]
-    return logistic(dense3)[0][0]
+    return logistic(dense3)[:, 0]
+
+
+def predict(image, weights=weights):
+    """Predict the quality score of a preprocessed image (150, 150, 1)"""
+    return forward(image[np.newaxis], weights=weights)[0]
+
+
+def predict_batch(images, weights=weights, chunksize: int = 8):
+    """Predict the quality scores of a batch of preprocessed images with
+    shape (N, 150, 150, 1), returns an array with N scores.
+
+    The images are passed through the network `chunksize` at a time (see
+    `forward`), the im2col matrix of the second layer takes about 24 MB
+    per image. The scores agree with `predict` to rounding, as the
+    stacked matrix products sum in a different order.
+    """
+    images = np.asarray(images)
+    if not len(images):
+        return np.empty(0)
+    return np.concatenate([forward(images[i:i + chunksize], weights=weights)
+                           for i in range(0, len(images), chunksize)])
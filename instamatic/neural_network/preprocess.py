@@ -1,5 +1,6 @@
+from functools import lru_cache
+
 import numpy as np
-from skimage.transform import resize
 
 
 def preprocess(image, n_std=4):
@@ -31,5 +32,112 @@ def preprocess(image, n_std=4):
     if div == 0:
         div = 1
     s_image = (s_image - np.min(s_image)) / div
+    from skimage.transform import resize
     red_s_image = resize(s_image, [150, 150], mode='constant')
     return red_s_image.reshape((150, 150, 1))
+
+
+@lru_cache(maxsize=16)
+def area_average_operator(n_in: int, n_out: int) -> np.ndarray:
+    """Return the (n_out, n_in) matrix that downsamples a signal of length
+    `n_in` to `n_out` by averaging over the area covered by every output
+    pixel (including fractional overlap at the borders).
+
+    An image is downsampled as `A @ image @ B.T`.
+    """
+    edges = np.linspace(0, n_in, n_out + 1)
+    lo = edges[:-1, np.newaxis]
+    hi = edges[1:, np.newaxis]
+    pixels = np.arange(n_in)
+    overlap = np.clip(np.minimum(hi, pixels + 1) - np.maximum(lo, pixels), 0, None)
+    operator = overlap / overlap.sum(axis=1, keepdims=True)
+    operator.setflags(write=False)
+    return operator
+
+
+def find_beam_centers(stack: np.ndarray, threshold: float = 0.99) -> np.ndarray:
+    """Find the center of the brightest region (pixels above `threshold` *
+    max) for every frame in `stack` from the row and column profiles of
+    the thresholded frames.
+
+    Returns an (N, 2) integer array with the centers.
+    """
+    n, h, w = stack.shape
+    maxima = stack.reshape(n, -1).max(axis=1)
+    mask = stack > (maxima * threshold)[:, np.newaxis, np.newaxis]
+    rows = mask.sum(axis=2)
+    cols = mask.sum(axis=1)
+    count = rows.sum(axis=1)
+    c_x = rows @ np.arange(h) / count
+    c_y = cols @ np.arange(w) / count
+    return np.stack((c_x, c_y), axis=1).astype(int)
+
+
+def _preprocess_chunk(stack: np.ndarray, out: np.ndarray, n_std: float, size: int) -> None:
+    n, h, w = stack.shape
+    size_x = min(size, h // 2)
+    size_y = min(size, w // 2)
+
+    centers = find_beam_centers(stack)
+    x_min = np.clip(centers[:, 0] - size_x, 0, h - 2 * size_x)
+    y_min = np.clip(centers[:, 1] - size_y, 0, w - 2 * size_y)
+
+    crops = np.empty((n, 2 * size_x, 2 * size_y))
+    for i in range(n):
+        crops[i] = stack[i, x_min[i]:x_min[i] + 2 * size_x, y_min[i]:y_min[i] + 2 * size_y]
+
+    mean = crops.mean(axis=(1, 2))
+    std = crops.std(axis=(1, 2))
+    np.minimum(crops, (mean + n_std * std)[:, np.newaxis, np.newaxis], out=crops)
+
+    vmin = crops.min(axis=(1, 2))
+    div = crops.max(axis=(1, 2)) - vmin
+    div[div == 0] = 1
+    crops -= vmin[:, np.newaxis, np.newaxis]
+    crops /= div[:, np.newaxis, np.newaxis]
+
+    out_x, out_y = out.shape[1:3]
+    op_x = area_average_operator(2 * size_x, out_x)
+    op_y = area_average_operator(2 * size_y, out_y)
+    out[..., 0] = op_x @ crops @ op_y.T
+
+
+def preprocess_batch(images, n_std: float = 4, size: int = 200, shape: tuple = (150, 150),
+                     chunksize: int = 32) -> np.ndarray:
+    """Batch version of `preprocess` for frames of any detector size.
+
+    For every frame, a window of 2*`size` pixels around the brightest
+    region is cropped, the intensities are clipped at mean + `n_std` * std
+    and normalized to 0-1, and the crop is downsampled to `shape` by area
+    averaging.
+
+    images: np.ndarray or iterable
+        3D stack of frames, or an iterable (i.e. a generator) of 2D frames
+        of the same shape
+    chunksize: int
+        Number of frames processed at once, limits the size of the
+        intermediate arrays
+
+    Returns a contiguous float32 array with shape (N, 150, 150, 1) that can
+    be passed to `predict_batch`.
+    """
+    if isinstance(images, np.ndarray):
+        if images.ndim == 2:
+            images = images[np.newaxis]
+        out = np.empty((len(images), *shape, 1), dtype=np.float32)
+        for i in range(0, len(images), chunksize):
+            _preprocess_chunk(images[i:i + chunksize], out[i:i + chunksize], n_std=n_std, size=size)
+        return out
+
+    batches = []
+    chunk = []
+    for frame in images:
+        chunk.append(frame)
+        if len(chunk) == chunksize:
+            batches.append(preprocess_batch(np.array(chunk), n_std=n_std, size=size, shape=shape, chunksize=chunksize))
+            chunk = []
+    if chunk:
+        batches.append(preprocess_batch(np.array(chunk), n_std=n_std, size=size, shape=shape, chunksize=chunksize))
+    if not batches:
+        return np.empty((0, *shape, 1), dtype=np.float32)
+    return np.concatenate(batches)
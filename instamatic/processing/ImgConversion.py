@@ -2,12 +2,14 @@ import collections
 import logging
 import time
 from datetime import datetime
+from functools import partial
 from math import cos
 
 import numpy as np
 
 from instamatic import config
 from instamatic.formats import read_tiff
+from instamatic.formats import update_adsc_header
 from instamatic.formats import write_adsc
 from instamatic.formats import write_mrc
 from instamatic.formats import write_tiff
@@ -17,10 +19,28 @@ from instamatic.tools import find_beam_center
 from instamatic.tools import find_beam_center_with_beamstop
 from instamatic.tools import find_subranges
 from instamatic.tools import to_xds_untrusted_area
+from instamatic.utils.framebuffer import FrameBuffer
+from instamatic.utils.metadata import FrameMetadata
 
 logger = logging.getLogger(__name__)
 
 
+class _FrameSequence:
+    """Sequence view of the frames `indices` in `data`, the frames are only
+    read (and corrected) when they are accessed."""
+
+    def __init__(self, data, indices: list):
+        super().__init__()
+        self.data = data
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.data[self.indices[i]]
+
+
 def rotation_axis_to_xyz(rotation_axis, invert=False, setting='xds'):
     """Convert rotation axis angle to XYZ vector compatible with 'xds', or
     'dials' Set invert to 'True' for anti-clockwise rotation."""
@@ -107,7 +127,9 @@ class ImgConversion:
 
     The image buffer is passed as a list of tuples, where each tuple
     contains the index (int), image data (2D numpy array),
-    metadata/header (dict). The buffer index must start at 1.
+    metadata/header (dict). The buffer index must start at 1. A
+    `FrameBuffer` can be passed instead, its frames are then read
+    lazily from disk.
     """
 
     def __init__(self,
@@ -119,25 +141,16 @@ class ImgConversion:
                  rotation_axis: float,           # radians, specifies the position of the rotation axis
                  acquisition_time: float,        # seconds, acquisition time (exposure time + overhead)
                  flatfield: str = 'flatfield.tiff',
+                 beam_centers: dict = None,      # beam centers by frame number, e.g. from `OnlineConversion`
                  ):
         if flatfield is not None:
             flatfield, h = read_tiff(flatfield)
         self.flatfield = flatfield
 
-        self.headers = {}
-        self.data = {}
-
         self.smv_subdrc = 'data'
 
-        while len(buffer) != 0:
-            i, img, h = buffer.pop(0)
-
-            self.headers[i] = h
-
-            if self.flatfield is not None:
-                self.data[i] = apply_flatfield_correction(img, self.flatfield)
-            else:
-                self.data[i] = img
+        self.read_buffer(buffer)
+        self.known_beam_centers = beam_centers or {}
 
         self.untrusted_areas = []
 
@@ -145,7 +158,6 @@ class ImgConversion:
         self.complete_range = set(range(min(self.observed_range), max(self.observed_range) + 1))
         self.missing_range = self.observed_range ^ self.complete_range
 
-        self.data_shape = img.shape
         try:
             self.pixelsize = config.calibration['diff']['pixelsize'][camera_length]  # px / Angstrom
         except KeyError:
@@ -179,6 +191,47 @@ class ImgConversion:
         self.mean_beam_center, self.beam_center_std = self.get_beam_centers()
         logger.debug(f'Primary beam at: {self.mean_beam_center}')
 
+    def read_buffer(self, buffer) -> None:
+        """Fill `self.data` and `self.headers` from the image buffer, the
+        flatfield correction is applied to the frames.
+
+        The headers are stored in a columnar `FrameMetadata` table,
+        `self.headers` maps the frame number to a view on its row.
+        """
+        if isinstance(buffer, FrameBuffer):
+            # frames are read from the scratch files only when they are used
+            self._metadata = buffer.metadata
+            self.headers = buffer.headers
+            transform = None if self.flatfield is None else partial(apply_flatfield_correction, flatfield=self.flatfield)
+            self.data = buffer.frames(transform=transform)
+            self.data_shape = buffer.shape
+            return
+
+        self._metadata = FrameMetadata(capacity=max(len(buffer), 1))
+        self.headers = self._metadata.headers
+        self.data = {}
+
+        while len(buffer) != 0:
+            i, img, h = buffer.pop(0)
+
+            self._metadata.append(i, h)
+
+            if self.flatfield is not None:
+                self.data[i] = apply_flatfield_correction(img, self.flatfield)
+            else:
+                self.data[i] = img
+
+        self.data_shape = img.shape
+
+    @property
+    def metadata(self) -> FrameMetadata:
+        """Headers of all frames as a columnar `FrameMetadata` table."""
+        meta = getattr(self, '_metadata', None)
+        if meta is None:
+            # subclasses that fill `self.headers` with plain dicts
+            meta = FrameMetadata.from_headers(self.headers)
+        return meta
+
     def check_settings(self) -> None:
         """Check for the presence of all required attributes.
 
@@ -230,11 +283,17 @@ class ImgConversion:
 
     def get_beam_centers(self, invert_x: bool = False, invert_y: bool = False) -> (float, float):
         """Obtain beam centers from the diffraction data Returns a tuple with
-        the median beam center and its standard deviation."""
+        the median beam center and its standard deviation.
+
+        Frames with a beam center in `self.known_beam_centers` are not
+        searched again."""
         shape_x, shape_y = self.data_shape
         centers = []
+        known_beam_centers = getattr(self, 'known_beam_centers', {})
         for i, h in self.headers.items():
-            if self.use_beamstop:
+            if i in known_beam_centers:
+                cx, cy = known_beam_centers[i]
+            elif self.use_beamstop:
                 cx, cy = find_beam_center_with_beamstop(self.data[i], z=99)
             else:
                 cx, cy = find_beam_center(self.data[i], sigma=10)
@@ -380,6 +439,7 @@ class ImgConversion:
         rotation_xyz = rotation_axis_to_xyz(self.rotation_axis, invert=invert_rotation_axis, setting='dials')
 
         export_dials_variables(smv_path, sequence=observed_range, missing=self.missing_range, rotation_xyz=rotation_xyz)
+        self.write_dials_untrusted(smv_path)
 
         path = smv_path / self.smv_subdrc
 
@@ -389,18 +449,10 @@ class ImgConversion:
         h = self.headers[i].copy()
         h['ImageGetTime'] = time.time()
 
-        # add data to self.data/self.headers so that existing functions can be used
-        # make sure to remove them afterwards, not to interfere with other data writing
         logger.debug(f'Writing missing files for DIALS: {self.missing_range}')
 
         for n in self.missing_range:
-            self.data[n] = empty
-            self.headers[n] = h
-
-            self.write_smv(path, n)
-
-            del self.data[n]
-            del self.headers[n]
+            write_adsc(path / f'{n:05d}.img', empty, header=self.smv_header(n, empty.shape, h=h))
 
     def write_tiff(self, path: str, i: int) -> str:
         """Write the image+header with sequence number `i` to the directory
@@ -418,17 +470,12 @@ class ImgConversion:
         write_tiff(fn, img, header=h)
         return fn
 
-    def write_smv(self, path: str, i: int) -> str:
-        """Write the image+header with sequence number `i` to the directory
-        `path` in SMV format.
-
-        Returns the path to the written image.
-        """
-        img = self.data[i]
-        h = self.headers[i]
-
-        img = np.ushort(img)
-        shape_x, shape_y = img.shape
+    def smv_header(self, i: int, shape: tuple, h: dict = None) -> dict:
+        """Return the SMV header for the frame with sequence number `i`,
+        `h` overrides the header of the frame."""
+        if h is None:
+            h = self.headers[i]
+        shape_x, shape_y = shape
 
         phi = self.start_angle + self.osc_angle * (i - 1)
 
@@ -468,10 +515,30 @@ class ImgConversion:
         header['BEAM_CENTER_Y'] = f'{mean_beam_center[0]:.4f}'
         header['DENZO_X_BEAM'] = f'{mean_beam_center[0]*self.physical_pixelsize:.4f}'
         header['DENZO_Y_BEAM'] = f'{mean_beam_center[1]*self.physical_pixelsize:.4f}'
+        return header
+
+    def write_smv(self, path: str, i: int) -> str:
+        """Write the image+header with sequence number `i` to the directory
+        `path` in SMV format.
+
+        Returns the path to the written image.
+        """
+        img = np.ushort(self.data[i])
+        header = self.smv_header(i, img.shape)
         fn = path / f'{i:05d}.img'
         write_adsc(fn, img, header=header)
         return fn
 
+    def update_smv_headers(self, path: str) -> None:
+        """Rewrite the headers of the SMV files in `path` (written during the
+        data collection, see `OnlineConversion`) with the final geometry,
+        the image data are left untouched."""
+        path = path / self.smv_subdrc
+        for i in self.observed_range:
+            update_adsc_header(path / f'{i:05d}.img', self.smv_header(i, self.data_shape))
+
+        logger.debug(f'SMV headers updated in folder: {path}')
+
     def write_mrc(self, path: str, i: int) -> str:
         """Write the image+header with sequence number `i` to the directory
         `path` in TIFF format.
@@ -597,13 +664,20 @@ class ImgConversion:
 
     def write_beam_centers(self, path: str) -> None:
         """Write list of beam centers to file `beam_centers.txt` in `path`"""
-        centers = np.zeros((max(self.observed_range), 2), dtype=np.float)
-        for i, h in self.headers.items():
-            centers[i - 1] = h['beam_center']
+        meta = self.metadata
+        centers = np.zeros((max(self.observed_range), 2), dtype=float)
+        centers[meta.frames - 1] = meta['beam_center']
         for i in self.missing_range:
             centers[i - 1] = [np.NaN, np.NaN]
 
         np.savetxt(path / 'beam_centers.txt', centers, fmt='%10.4f')
+        self.write_beamstop(path)
+        self.write_metadata(path)
+
+    def write_metadata(self, path: str) -> None:
+        """Write the headers of all frames to `frame_metadata.npz` in `path`,
+        see `FrameMetadata.load`"""
+        self.metadata.save(path / 'frame_metadata.npz')
 
     def write_pets_inp(self, path: str, tiff_path: str = 'tiff') -> None:
         """Write PETS input file `pets.pts` in directory `path`"""
@@ -661,3 +735,48 @@ class ImgConversion:
     def add_beamstop(self, rect):
         """rect must be a 2x4 coordinate array."""
         self.untrusted_areas.append(('quadrilateral', rect))
+
+    def track_beamstop(self, tolerance: float = 2.0, **kwargs):
+        """Track the beamstop over the sweep (see `BeamstopTracker`), and add
+        an untrusted quadrilateral for every block of frames in which the
+        beamstop moves less than `tolerance` pixels.
+
+        **kwargs are passed to `BeamstopTracker`
+        """
+        from instamatic.utils.beamstop import BeamstopTracker
+
+        indices = sorted(self.observed_range)
+        # only the frames around the sample positions are read
+        images = _FrameSequence(self.data, indices)
+        centers = [self.headers[i]['beam_center'] for i in indices]
+
+        self.beamstop_track = track = BeamstopTracker(**kwargs).track(images, indices=indices, centers=centers)
+        self.untrusted_areas.extend(track.untrusted_areas(tolerance))
+        logger.debug(f'Beamstop tracked over {len(track)} frames ({len(track.sample_indices)} detections)')
+        return track
+
+    def write_beamstop(self, path: str) -> None:
+        """Write the beamstop rectangle for every frame to `beamstop.txt` in
+        `path`, see `track_beamstop`"""
+        track = getattr(self, 'beamstop_track', None)
+        if track is None:
+            return
+        table = np.hstack((track.indices[:, None], track.rects.reshape(-1, 8)))
+        header = 'frame' + ''.join(f' x{i} y{i}' for i in range(1, 5))
+        np.savetxt(path / 'beamstop.txt', table, fmt=['%6d'] + ['%10.2f'] * 8, header=header)
+
+    def write_dials_untrusted(self, path: str) -> None:
+        """Write the untrusted areas to `untrusted.phil` in `path`, for use
+        with `dials.generate_mask untrusted.phil`"""
+        if not self.untrusted_areas:
+            return
+        with open(path / 'untrusted.phil', 'w', newline='\n') as f:
+            for kind, coords in self.untrusted_areas:
+                coords = np.round(coords).astype(int)
+                if kind == 'rectangle':
+                    (x1, y1), (x2, y2) = coords
+                    coords = ((x1, y1), (x1, y2), (x2, y2), (x2, y1))
+                elif kind != 'quadrilateral':
+                    continue
+                polygon = ' '.join(f'{y} {x}' for x, y in coords)  # coords are flipped in DIALS
+                print(f'untrusted {{\n  polygon = {polygon}\n}}', file=f)
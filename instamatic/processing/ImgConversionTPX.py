@@ -7,7 +7,9 @@ class ImgConversionTPX(ImgConversion):
 
     The image buffer is passed as a list of tuples, where each tuple
     contains the index (int), image data (2D numpy array),
-    metadata/header (dict). The buffer index must start at 1.
+    metadata/header (dict). The buffer index must start at 1. A
+    `FrameBuffer` can be passed instead, its frames are then read
+    lazily from disk.
     """
 
     def __init__(self,
@@ -23,35 +25,24 @@ class ImgConversionTPX(ImgConversion):
                  wavelength: float = None,          # Angstrom, relativistic wavelength of the electron beam
                  stretch_amplitude=0.0,             # Stretch correction amplitude, %
                  stretch_azimuth=0.0,               # Stretch correction azimuth, degrees
+                 beam_centers: dict = None,         # beam centers by frame number, e.g. from `OnlineConversion`
                  ):
         if flatfield is not None:
             flatfield, h = read_tiff(flatfield)
         self.flatfield = flatfield
 
-        self.headers = {}
-        self.data = {}
-
         self.smv_subdrc = 'data'
 
         self.untrusted_areas = [('rectangle', ((0, 255), (517, 262))),
                                 ('rectangle', ((255, 0), (262, 517)))]
 
-        while len(buffer) != 0:
-            i, img, h = buffer.pop(0)
-
-            self.headers[i] = h
-
-            if self.flatfield is not None:
-                self.data[i] = apply_flatfield_correction(img, self.flatfield)
-            else:
-                self.data[i] = img
+        self.read_buffer(buffer)
+        self.known_beam_centers = beam_centers or {}
 
         self.observed_range = set(self.data.keys())
         self.complete_range = set(range(min(self.observed_range), max(self.observed_range) + 1))
         self.missing_range = self.observed_range ^ self.complete_range
 
-        self.data_shape = img.shape
-
         self.pixelsize = pixelsize
         self.physical_pixelsize = physical_pixelsize
         self.wavelength = wavelength
@@ -1,3 +1,4 @@
 """General purpose processing goes here."""
 from .flatfield import apply_flatfield_correction
 from .stretch_correction import apply_stretch_correction
+from .stretch_correction import StretchCorrector
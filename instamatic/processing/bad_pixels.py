@@ -0,0 +1,362 @@
+"""Bad pixel maps for camera images.
+
+`BadPixelMap` keeps track of the dead, hot, and gap pixels of a camera.
+Dead and hot pixels are replaced by the average of their good neighbours,
+gap pixels (i.e. the enlarged pixels in the cross between the Timepix
+chips) are scaled by a fixed factor. Both corrections are linear, and are
+precomputed as a sparse operator that maps the frame onto the values of
+the bad pixels, so repairing a frame or a stack is a single gather.
+
+The map is stored next to the flatfield, i.e. `flatfield.tiff` ->
+`flatfield.badpixels.npz`.
+
+Usage:
+    bad_pixels = BadPixelMap.from_flatfield(flatfield, darkfield)
+    bad_pixels.add_timepix_cross()
+    bad_pixels.save(BadPixelMap.sidecar('flatfield.tiff'))
+
+    bad_pixels = BadPixelMap.for_flatfield('flatfield.tiff')
+    img = bad_pixels.correct(img)
+    bad_pixels.correct_stack(stack, out=stack)
+"""
+import logging
+from pathlib import Path
+
+import numpy as np
+logger = logging.getLogger(__name__)
+
+DEAD = 1
+HOT = 2
+GAP = 4
+
+BAD_PIXEL_MAP_VERSION = 1
+
+TIMEPIX_CROSS = (slice(255, 261), slice(255, 261))
+TIMEPIX_CROSS_FACTOR = 1.19870594245
+
+
+def _robust_sigma(x: np.ndarray) -> float:
+    """Standard deviation estimated from the median absolute deviation."""
+    sigma = 1.4826 * np.median(np.abs(x - np.median(x)))
+    if sigma == 0:
+        sigma = np.std(x)
+    return sigma
+
+
+def find_outliers(img: np.ndarray, n_sigma: float = 8.0, size: int = 5, ignore: np.ndarray = None) -> np.ndarray:
+    """Find pixels that are more than `n_sigma` above their local median.
+
+    img: np.ndarray
+        Averaged flatfield or darkfield image
+    n_sigma: float
+        Threshold in units of the (robust) standard deviation of the
+        difference with the local median
+    size: int
+        Size of the median filter
+    ignore: np.ndarray
+        Boolean mask of pixels that are excluded from the statistics
+
+    Returns a boolean mask of the outliers.
+    """
+    from scipy import ndimage
+
+    img = np.asarray(img, dtype=float)
+    residual = img - ndimage.median_filter(img, size=size, mode='reflect')
+    sample = residual if ignore is None else residual[~ignore]
+    return residual > n_sigma * _robust_sigma(sample)
+
+
+class BadPixelMap:
+    """Map of the bad pixels of a camera.
+
+    shape: tuple
+        Shape of the camera frames
+    dead: np.ndarray
+        Coordinates (N, 2) or boolean mask of the dead pixels
+    hot: np.ndarray
+        Coordinates (N, 2) or boolean mask of the hot pixels
+    max_radius: int
+        Bad pixels are replaced by the average of the good pixels in the
+        surrounding 3x3 window, which is grown up to a (2 * max_radius + 1)
+        window for clusters of bad pixels. Pixels without any good
+        neighbour within this window are left as they are.
+    """
+
+    def __init__(self, shape: tuple, dead: np.ndarray = None, hot: np.ndarray = None, max_radius: int = 3):
+        super().__init__()
+        self.shape = tuple(shape)
+        self.max_radius = max_radius
+        self.flags = np.zeros(self.shape, dtype=np.uint8)
+        self.gap_index = np.array([], dtype=np.intp)
+        self.gap_factor = np.array([], dtype=float)
+        self._operator = None
+
+        if dead is not None:
+            self.add(dead, DEAD)
+        if hot is not None:
+            self.add(hot, HOT)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(shape={self.shape}, dead={len(self.dead)}, '
+                f'hot={len(self.hot)}, gap={len(self.gap_index)})')
+
+    def __len__(self) -> int:
+        """Number of pixels that are modified by the correction."""
+        return len(self.operator[0])
+
+    @property
+    def dead(self) -> np.ndarray:
+        """Coordinates of the dead pixels."""
+        return np.argwhere(self.flags & DEAD)
+
+    @property
+    def hot(self) -> np.ndarray:
+        """Coordinates of the hot pixels."""
+        return np.argwhere(self.flags & HOT)
+
+    @property
+    def gap(self) -> np.ndarray:
+        """Coordinates of the gap pixels."""
+        return np.argwhere(self.flags & GAP)
+
+    @property
+    def bad(self) -> np.ndarray:
+        """Boolean mask of the pixels that are interpolated (dead or
+        hot)."""
+        return (self.flags & (DEAD | HOT)) != 0
+
+    def _to_mask(self, pixels) -> np.ndarray:
+        if isinstance(pixels, tuple):  # tuple of slices
+            mask = np.zeros(self.shape, dtype=bool)
+            mask[pixels] = True
+            return mask
+        pixels = np.asarray(pixels)
+        if pixels.dtype == bool:
+            if pixels.shape != self.shape:
+                raise ValueError(f'Mask with shape {pixels.shape} does not match the map shape {self.shape}')
+            return pixels
+        mask = np.zeros(self.shape, dtype=bool)
+        if pixels.size:
+            mask[tuple(pixels.reshape(-1, 2).T)] = True
+        return mask
+
+    def add(self, pixels, kind: int = DEAD) -> None:
+        """Mark `pixels` as `kind` (DEAD or HOT), `pixels` are coordinates
+        (N, 2), a boolean mask, or a tuple of slices."""
+        if kind not in (DEAD, HOT):
+            raise ValueError(f'Use `add_gap` for gap pixels, got kind={kind}')
+        self.flags[self._to_mask(pixels)] |= kind
+        self._operator = None
+
+    def add_gap(self, pixels, factor: float) -> None:
+        """Mark `pixels` as gap pixels, their intensities are multiplied by
+        `factor`."""
+        mask = self._to_mask(pixels)
+        self.flags[mask] |= GAP
+        index = np.flatnonzero(mask)
+        keep = ~np.isin(self.gap_index, index)
+        self.gap_index = np.concatenate((self.gap_index[keep], index))
+        self.gap_factor = np.concatenate((self.gap_factor[keep], np.full(len(index), factor, dtype=float)))
+        order = np.argsort(self.gap_index)
+        self.gap_index = self.gap_index[order]
+        self.gap_factor = self.gap_factor[order]
+        self._operator = None
+
+    def clear_gaps(self) -> None:
+        """Remove all gap pixels, e.g. when the images are divided by the
+        flatfield, which already compensates the enlarged pixels."""
+        self.flags &= ~np.uint8(GAP)
+        self.gap_index = np.array([], dtype=np.intp)
+        self.gap_factor = np.array([], dtype=float)
+        self._operator = None
+
+    def add_timepix_cross(self, factor: float = TIMEPIX_CROSS_FACTOR) -> None:
+        """Mark the enlarged pixels at the center of the Timepix quad as gap
+        pixels, see `flatfield.apply_center_pixel_correction`."""
+        self.add_gap(TIMEPIX_CROSS, factor)
+
+    @classmethod
+    def from_flatfield(cls, flatfield: np.ndarray, darkfield: np.ndarray = None, noise: np.ndarray = None,
+                       n_sigma: float = 8.0, size: int = 5, **kwargs):
+        """Detect the bad pixels from an averaged flatfield and darkfield.
+
+        Dead pixels are the pixels without any counts in the flatfield. Hot
+        pixels are the pixels that are more than `n_sigma` above the local
+        median in the flatfield or darkfield (see `find_outliers`). If a
+        noise map (per-pixel standard deviation of the flatfield frames) is
+        given, unusually noisy pixels are marked as hot as well.
+        """
+        dead = flatfield <= 0
+        hot = find_outliers(flatfield, n_sigma=n_sigma, size=size, ignore=dead)
+        for img in (darkfield, noise):
+            if img is not None:
+                hot |= find_outliers(img, n_sigma=n_sigma, size=size, ignore=dead)
+        hot &= ~dead
+        logger.info('Found %d dead and %d hot pixels', dead.sum(), hot.sum())
+        return cls(flatfield.shape, dead=dead, hot=hot, **kwargs)
+
+    def _gap_scale(self, index: np.ndarray) -> np.ndarray:
+        """Scale factors of the pixels at flat `index` (1 for non-gap
+        pixels)."""
+        scale = np.ones(index.shape)
+        if len(self.gap_index):
+            i = np.searchsorted(self.gap_index, index).clip(max=len(self.gap_index) - 1)
+            is_gap = self.gap_index[i] == index
+            scale[is_gap] = self.gap_factor[i[is_gap]]
+        return scale
+
+    def _build_operator(self) -> tuple:
+        from scipy import sparse
+
+        ny, nx = self.shape
+        bad = self.bad.ravel()
+
+        rows = []
+        cols = []
+        weights = []
+
+        remaining = np.flatnonzero(bad)
+        for d in range(1, self.max_radius + 1):
+            if not len(remaining):
+                break
+            dy, dx = np.mgrid[-d:d + 1, -d:d + 1].reshape(2, -1)
+            iy, ix = np.divmod(remaining, nx)
+            y = iy[:, None] + dy
+            x = ix[:, None] + dx
+            valid = (y >= 0) & (y < ny) & (x >= 0) & (x < nx)
+            neighbours = np.where(valid, y * nx + x, 0)
+            valid &= ~bad[neighbours]
+            count = valid.sum(axis=1)
+
+            i, j = np.nonzero(valid)
+            rows.append(remaining[i])
+            cols.append(neighbours[i, j])
+            weights.append(1.0 / count[i])
+            remaining = remaining[count == 0]
+
+        if len(remaining):
+            logger.warning('%d bad pixels have no good neighbours within %d pixels', len(remaining), self.max_radius)
+            rows.append(remaining)
+            cols.append(remaining)
+            weights.append(np.ones(len(remaining)))
+
+        gap = ~bad[self.gap_index]
+        rows.append(self.gap_index[gap])
+        cols.append(self.gap_index[gap])
+        weights.append(np.ones(gap.sum()))
+
+        rows = np.concatenate(rows).astype(np.intp)
+        cols = np.concatenate(cols).astype(np.intp)
+        weights = np.concatenate(weights) * self._gap_scale(cols)
+
+        index, rows = np.unique(rows, return_inverse=True)
+        operator = sparse.csr_matrix((weights, (rows, cols)), shape=(len(index), ny * nx))
+        return index, operator
+
+    @property
+    def operator(self) -> tuple:
+        """Flat indices of the corrected pixels, and the sparse matrix that
+        maps a flattened frame onto their corrected values."""
+        if self._operator is None:
+            self._operator = self._build_operator()
+        return self._operator
+
+    def values(self, data: np.ndarray) -> np.ndarray:
+        """Corrected values of the bad pixels for a frame (M,) or a stack
+        (N, M)."""
+        index, operator = self.operator
+        if data.shape[-2:] != self.shape:
+            raise ValueError(f'Image shape {data.shape[-2:]} does not match the bad pixel map {self.shape}')
+        flat = data.reshape(-1, operator.shape[1])
+        if not operator.nnz:
+            return np.empty((len(flat), 0))
+        products = flat[:, operator.indices] * operator.data
+        values = np.add.reduceat(products, operator.indptr[:-1], axis=1)
+        return values[0] if data.ndim == 2 else values
+
+    def correct(self, img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Repair the bad pixels in `img`
+
+        out: np.ndarray
+            Array to write the result to, can be `img` itself
+
+        returns:
+            ndarray with the same shape and dtype as `img`
+        """
+        values = self.values(img)
+        if out is None:
+            out = img.copy()
+        elif out is not img:
+            out[...] = img
+        if np.issubdtype(out.dtype, np.integer):
+            info = np.iinfo(out.dtype)
+            np.clip(np.round(values, out=values), info.min, info.max, out=values)
+
+        index = self.operator[0]
+        if out.ndim == 2:
+            out.flat[index] = values
+        else:
+            for frame, frame_values in zip(out, values):
+                frame.flat[index] = frame_values
+        return out
+
+    def correct_stack(self, stack: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Repair the bad pixels in every frame of a 3D stack, `out` can be
+        `stack` itself."""
+        return self.correct(stack, out=out)
+
+    @staticmethod
+    def sidecar(flatfield: str) -> Path:
+        """Return the path of the bad pixel map that belongs to
+        `flatfield`"""
+        return Path(flatfield).with_suffix('.badpixels.npz')
+
+    def save(self, fn: str) -> None:
+        """Save the bad pixel map to `fn` (npz)."""
+        with open(fn, 'wb') as f:
+            np.savez_compressed(f,
+                                version=BAD_PIXEL_MAP_VERSION,
+                                flags=self.flags,
+                                gap_index=self.gap_index,
+                                gap_factor=self.gap_factor,
+                                max_radius=self.max_radius)
+
+    @classmethod
+    def load(cls, fn: str):
+        """Load a bad pixel map saved with `BadPixelMap.save`"""
+        with np.load(fn) as data:
+            version = int(data['version'])
+            if version != BAD_PIXEL_MAP_VERSION:
+                raise ValueError(f'Unsupported bad pixel map version: {version}')
+            flags = data['flags']
+            new = cls(flags.shape, max_radius=int(data['max_radius']))
+            new.flags[:] = flags
+            new.gap_index = data['gap_index'].astype(np.intp)
+            new.gap_factor = data['gap_factor'].astype(float)
+        return new
+
+    @classmethod
+    def for_flatfield(cls, flatfield: str, header: dict = None, shape: tuple = None, timepix: bool = None):
+        """Return the bad pixel map that belongs to `flatfield`
+
+        If there is no map stored next to the flatfield, it is created
+        from the dead pixels stored in the flatfield header. For a Timepix
+        camera (`timepix`, defaults to the camera in the config), the
+        cross at the center is added as well, as `collect_flatfield` does.
+        """
+        fn = cls.sidecar(flatfield)
+        if fn.exists():
+            return cls.load(fn)
+
+        if header is None or shape is None:
+            from instamatic.formats import read_tiff
+            img, header = read_tiff(flatfield)
+            shape = img.shape
+        if timepix is None:
+            from instamatic import config
+            timepix = config.camera.name == 'timepix'
+
+        new = cls(shape, dead=header.get('deadpixels'))
+        if timepix:
+            new.add_timepix_cross()
+        return new
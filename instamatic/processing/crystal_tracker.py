@@ -0,0 +1,252 @@
+"""Lightweight crystal tracking for continuous rotation experiments.
+
+`CrystalTracker` follows a crystal in the defocused images that are
+taken during the rotation (autocRED). Full particle recognition is not
+run on every tracking image. Instead, a region of interest (ROI) is cut
+out around the predicted crystal position and registered against a
+template by FFT cross-correlation, which takes a few milliseconds. The
+template is the ROI of the first image, and it is updated slowly so
+that it follows the changing appearance of the rotating crystal.
+
+The crystal moves approximately at a constant velocity with the rotation
+angle (e.g. because it is not exactly at the eucentric height). The
+tracker therefore fits the velocity of the crystal (pixels per degree)
+to the last few updates, and predicts where the crystal will be at the
+next image. The prediction can be applied before the image is taken,
+and it positions the ROI.
+
+If the height of the correlation peak (1 for a perfect match) drops
+below `min_confidence`, the tracker calls the `fallback` function on the
+full image, e.g. the particle recognition of the autocRED experiment,
+and takes a new template at the position it returns.
+
+Positions and offsets are (row, column) in pixels. An offset is the
+position of the crystal relative to the beam center, which is found
+with `find_defocused_image_center`.
+
+Usage:
+    tracker = CrystalTracker(img0, angle=a0, fallback=locate)
+    result = tracker.update(img, angle=a)
+    beamshift += result.offset @ transform
+    tracker.predict(next_angle)
+"""
+import time
+from collections import deque
+from collections import namedtuple
+
+import numpy as np
+
+from instamatic.tools import find_defocused_image_center
+
+TrackResult = namedtuple('TrackResult', ['offset', 'confidence', 'fallback', 'duration'])
+
+
+def beam_center(img: np.ndarray) -> np.ndarray:
+    """Center (row, column) of the defocused beam in `img`"""
+    center, radius = find_defocused_image_center(img)
+    return center[::-1]
+
+
+def _interpolate_gap(arr: np.ndarray, start: int, stop: int) -> None:
+    """Replace rows `start:stop` of `arr` in place by linear interpolation
+    between the neighbouring rows. A gap with a constant fill would be a
+    static feature that pins the correlation at zero displacement."""
+    n = len(arr)
+    start, stop = max(start, 0), min(stop, n)
+    if start >= stop:
+        return
+    before = arr[start - 1] if start > 0 else None
+    after = arr[stop] if stop < n else None
+    if before is None and after is None:
+        return
+    if before is None:
+        before = after
+    if after is None:
+        after = before
+    t = np.linspace(0, 1, stop - start + 2)[1:-1, None]
+    arr[start:stop] = (1 - t) * before + t * after
+
+
+def correlate(template: np.ndarray, img: np.ndarray, window: np.ndarray = None, whiten: float = 0.0) -> tuple:
+    """Find the displacement (row, column) of the contents of `img` with
+    respect to `template` (both the same shape) by FFT cross-correlation.
+
+    `whiten` sets the normalization of the cross power spectrum: 0 gives
+    the plain cross-correlation, 1 the phase correlation. Partial whitening
+    sharpens the peak without amplifying the noise as much.
+
+    Returns the displacement with subpixel precision (parabolic fit), and
+    the normalized cross-correlation at the peak as the confidence (at
+    most 1).
+    """
+    template = template - template.mean()
+    img = img - img.mean()
+    if window is not None:
+        # only the template is windowed, windowing the image as well would
+        # pull the displacement of smooth features towards zero
+        template = template * window
+    f = np.fft.rfft2(img)
+    g = np.fft.rfft2(template)
+    r = f * np.conj(g)
+    plain = np.fft.irfft2(r, s=img.shape)
+    if whiten:
+        corr = np.fft.irfft2(r / (np.abs(r) + 1e-12) ** whiten, s=img.shape)
+    else:
+        corr = plain
+
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    shift = np.array(peak, dtype=float)
+    for axis, n in enumerate(corr.shape):
+        # subpixel refinement with the neighbours along this axis (periodic)
+        idx = list(peak)
+        idx[axis] = (peak[axis] - 1) % n
+        c_min = corr[tuple(idx)]
+        idx[axis] = (peak[axis] + 1) % n
+        c_plus = corr[tuple(idx)]
+        denom = c_min - 2 * corr[peak] + c_plus
+        if denom < 0:
+            shift[axis] += 0.5 * (c_min - c_plus) / denom
+    shift = (shift + np.array(corr.shape) / 2) % corr.shape - np.array(corr.shape) / 2
+
+    confidence = plain[peak] / (np.linalg.norm(img) * np.linalg.norm(template) + 1e-12)
+    return shift, float(confidence)
+
+
+class CrystalTracker:
+    """Follow a crystal in a series of defocused images.
+
+    img: np.ndarray
+        First image, the crystal is taken to be at `offset`
+    angle: float
+        Rotation angle of the first image, any quantity proportional to the
+        angle can be used (e.g. the frame number at constant speed)
+    offset: tuple
+        Position of the crystal relative to the beam center in `img`
+    roi: int
+        Size of the region of interest in pixels, defaults to the diameter
+        of the beam in the first image (up to 256)
+    min_confidence: float
+        Call `fallback` if the correlation peak is lower than this
+    fallback: callable
+        Function that takes the full image and the beam center, and returns
+        the offset of the crystal, or None if it was not found
+    history: int
+        Number of updates used to fit the velocity
+    learning_rate: float
+        Weight of the new ROI when the template is updated
+    whiten: float
+        Whitening of the correlation, between 0 (cross-correlation) and 1
+        (phase correlation), see `correlate`
+    cross: tuple
+        First and last + 1 row/column of the cross between the chips of
+        a Timepix detector, these pixels are interpolated from the
+        neighbouring pixels
+    """
+
+    def __init__(self,
+                 img: np.ndarray,
+                 angle: float = 0.0,
+                 offset: tuple = (0, 0),
+                 roi: int = None,
+                 min_confidence: float = 0.15,
+                 fallback=None,
+                 history: int = 5,
+                 learning_rate: float = 0.2,
+                 whiten: float = 0.0,
+                 cross: tuple = None,
+                 ):
+        super().__init__()
+        if roi is None:
+            center, radius = find_defocused_image_center(img)
+            roi = int(min(2 * radius.min() / 1.414, 256))
+        self.roi = max(roi - roi % 2, 16)
+        self.min_confidence = min_confidence
+        self.fallback = fallback
+        self.learning_rate = learning_rate
+        self.whiten = whiten
+        self.cross = cross
+
+        self.angle = angle
+        self.offset = np.array(offset, dtype=float)
+        self.velocity = np.zeros(2)
+        self._history = deque(maxlen=history)
+        self.n_fallback = 0
+
+        self._window = np.outer(np.hanning(self.roi), np.hanning(self.roi))
+        self.template, _ = self.crop(img, beam_center(img) + self.offset)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(roi={self.roi}, offset={tuple(self.offset)}, velocity={tuple(self.velocity)})'
+
+    def crop(self, img: np.ndarray, position) -> tuple:
+        """Cut out the ROI centered at `position`, it is moved to stay
+        inside the image.
+
+        Returns the ROI and the position of its center.
+        """
+        half = self.roi // 2
+        r0, c0 = np.round(position).astype(int) - half
+        r0 = int(np.clip(r0, 0, img.shape[0] - self.roi))
+        c0 = int(np.clip(c0, 0, img.shape[1] - self.roi))
+        out = np.array(img[r0:r0 + self.roi, c0:c0 + self.roi], dtype=float)
+
+        if self.cross is not None:
+            start, stop = self.cross
+            _interpolate_gap(out, start - r0, stop - r0)
+            _interpolate_gap(out.T, start - c0, stop - c0)
+
+        return out, np.array((r0 + half, c0 + half), dtype=float)
+
+    def predict(self, angle: float) -> np.ndarray:
+        """Offset of the crystal expected at `angle`, assuming it moves at a
+        constant velocity with the rotation angle."""
+        return self.offset + self.velocity * (angle - self.angle)
+
+    def correct(self, delta) -> None:
+        """Tell the tracker that the beam was moved by `delta` (pixels) to
+        follow the crystal, e.g. after applying the offset with the beam
+        shift, the crystal is then expected at `offset - delta`."""
+        self.offset = self.offset - np.asarray(delta, dtype=float)
+
+    def update(self, img: np.ndarray, angle: float, center=None) -> TrackResult:
+        """Locate the crystal in `img` taken at `angle`, `center` is the
+        beam center if already known.
+
+        Returns the offset of the crystal relative to the beam center, the
+        confidence, and whether the fallback was used.
+        """
+        t0 = time.perf_counter()
+        if center is None:
+            center = beam_center(img)
+        center = np.asarray(center, dtype=float)
+
+        predicted = self.predict(angle)
+        roi, roi_center = self.crop(img, center + predicted)
+        shift, confidence = correlate(self.template, roi, window=self._window, whiten=self.whiten)
+        offset = roi_center + shift - center
+
+        fallback = confidence < self.min_confidence and self.fallback is not None
+        if fallback:
+            found = self.fallback(img, center)
+            self.n_fallback += 1
+            if found is None:
+                return TrackResult(None, confidence, True, time.perf_counter() - t0)
+            offset = np.asarray(found, dtype=float)
+            self.template, _ = self.crop(img, center + offset)
+        elif confidence >= self.min_confidence:
+            a = self.learning_rate
+            self.template = (1 - a) * self.template + a * self.crop(img, center + offset)[0]
+
+        self._add(angle, offset)
+        return TrackResult(offset, confidence, fallback, time.perf_counter() - t0)
+
+    def _add(self, angle: float, offset: np.ndarray) -> None:
+        # displacement since the last update, independent of the beam
+        # corrections in between
+        if angle != self.angle:
+            self._history.append((angle - self.angle, offset - self.offset))
+            da = np.array([d for d, _ in self._history])
+            dp = np.array([p for _, p in self._history])
+            self.velocity = (dp * da[:, None]).sum(axis=0) / (da ** 2).sum()
+        self.angle = angle
+        self.offset = offset
@@ -1,7 +1,7 @@
 import sys
+import threading
 from collections import namedtuple
 
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy import ndimage
 from scipy._lib._util import _asarray_validated
@@ -11,12 +11,27 @@ from skimage import measure
 from skimage import morphology
 from skimage import segmentation
 
-from instamatic.config import calibration
+from instamatic import config
 from instamatic.image_utils import autoscale
+from instamatic.image_utils import disk
+from instamatic.utils.process_pool import ProcessPoolMixin
 
 
 CrystalPosition = namedtuple('CrystalPosition', ['x', 'y', 'isolated', 'n_clusters', 'area_micrometer', 'area_pixel'])
 
+SEGMENTATION_METHODS = ('bf', 'cg_j', 'watershed', 'threshold')
+
+_local = threading.local()
+
+
+def _work_arrays(shape: tuple) -> tuple:
+    """Return two boolean scratch arrays of `shape`, reused across calls in
+    the same thread."""
+    arrays = getattr(_local, 'work_arrays', None)
+    if arrays is None or arrays[0].shape != shape:
+        arrays = _local.work_arrays = (np.empty(shape, dtype=bool), np.empty(shape, dtype=bool))
+    return arrays
+
 
 def isedge(prop):
     """Simple edge detection routine.
@@ -49,7 +64,7 @@ def whiten(obs, check_finite=False):
     return obs / std_dev, std_dev
 
 
-def segment_crystals(img, r=101, offset=5, footprint=5, remove_carbon_lacing=True):
+def segment_crystals(img, r=101, offset=5, footprint=5, remove_carbon_lacing=True, method='bf'):
     """
     r: `int`
        blocksize to calculate local threshold value
@@ -58,40 +73,64 @@ def segment_crystals(img, r=101, offset=5, footprint=5, remove_carbon_lacing=Tru
     offset: `int`
     Constant subtracted from weighted mean of neighborhood to calculate
         the local threshold value
+    method: `str`
+        Segmentation backend to assign the unlabeled pixels between features
+        and background:
+        'bf': random walker with the brute-force solver (reference)
+        'cg_j': random walker with the Jacobi-preconditioned conjugate gradient solver
+        'watershed': watershed on the gradient of the image
+        'threshold': no refinement, use the thresholded features directly (fastest)
     """
+    if method not in SEGMENTATION_METHODS:
+        raise ValueError(f'Unknown segmentation method: `{method}`, must be one of {SEGMENTATION_METHODS}')
+
     # workaround, because segmentation.random_walker no longer accepts floats from 0-255.0
     offset = offset / 255.0
 
     # normalize
     img = img * (1.0 / img.max())
 
+    selem = disk(footprint)
+    tmp, bkg = _work_arrays(img.shape)
+
     # adaptive thresholding, because contrast is not equal over image
-    arr = img > filters.threshold_local(img, r, method='mean', offset=offset)
-    arr = np.invert(arr)
+    # same as `filters.threshold_local(img, r, method='mean', offset=offset)`,
+    # which has a large per-call overhead in some versions of scikit-image
+    if r % 2 == 0:
+        raise ValueError('The kwarg `r` (block size) must be odd.')
+    arr = img <= ndimage.uniform_filter(img, r, mode='reflect') - offset
     # arr = morphology.binary_opening(arr, morphology.disk(3))
 
     arr = morphology.remove_small_objects(arr, min_size=4 * 4, connectivity=0)  # remove noise
 
     # magic
-    arr = morphology.binary_closing(arr, morphology.disk(footprint))  # dilation + erosion
-    arr = morphology.binary_erosion(arr, morphology.disk(footprint))  # erosion
+    morphology.binary_closing(arr, selem, out=tmp)  # dilation + erosion
+    morphology.binary_erosion(tmp, selem, out=arr)  # erosion
 
     # remove carbon lines
     if remove_carbon_lacing:
         arr = morphology.remove_small_objects(arr, min_size=8 * 8, connectivity=0)
-        arr = morphology.remove_small_holes(arr, min_size=32 * 32, connectivity=0)
-    arr = morphology.binary_dilation(arr, morphology.disk(footprint))  # dilation
+        arr = morphology.remove_small_holes(arr, 32 * 32, connectivity=0)
+    arr = morphology.binary_dilation(arr, selem)  # dilation
+
+    if method == 'threshold':
+        return arr, arr.astype(int)
 
     # get background pixels
-    bkg = np.invert(morphology.binary_dilation(arr, morphology.disk(footprint * 2)) | arr)
+    morphology.binary_dilation(arr, disk(footprint * 2), out=bkg)
+    bkg |= arr
+    np.invert(bkg, out=bkg)
 
     # 2: features
     # 1: background
     # 0: unlabeled
     markers = arr * 2 + bkg
 
-    # segment using random_walker
-    segmented = segmentation.random_walker(img, markers, beta=50, spacing=(5, 5), mode='bf')
+    if method == 'watershed':
+        segmented = segmentation.watershed(filters.sobel(img), markers)
+    else:
+        # segment using random_walker
+        segmented = segmentation.random_walker(img, markers, beta=50, spacing=(5, 5), mode=method)
     segmented = segmented.astype(int) - 1
 
     return arr, segmented
@@ -106,6 +145,7 @@ def find_crystals_timepix(img, magnification, spread=0.6, plot=False, **kwargs):
     #   lower = more sensitive to noise
     offset = kwargs.get('offset', 15)
     footprint = kwargs.get('footprint', 3)
+    method = kwargs.get('method', 'bf')
 
     return find_crystals(img=img,
                          magnification=magnification,
@@ -114,6 +154,7 @@ def find_crystals_timepix(img, magnification, spread=0.6, plot=False, **kwargs):
                          footprint=footprint,
                          offset=offset,
                          r=r,
+                         method=method,
                          remove_carbon_lacing=False)
 
 
@@ -134,7 +175,33 @@ def find_crystals(img, magnification, spread=2.0, plot=False, **kwargs):
     **kwargs:
     keywords to pass to segment_crystals
     """
-    img, scale = autoscale(img, maxdim=256)  # scale down for faster
+    # calculate the pixel dimensions in micrometer
+    pixelsize = config.calibration['mag1']['pixelsize'][magnification] / 1000  # nm -> um
+
+    crystals, img, seg, scale = _locate_crystals(img, pixelsize, spread=spread, **kwargs)
+
+    if plot:
+        import matplotlib.pyplot as plt
+        plt.imshow(img)
+        plt.contour(seg, [0.5], linewidths=1.2, colors='yellow')
+        if len(crystals) > 0:
+            x, y = np.array([(crystal.x * scale, crystal.y * scale) for crystal in crystals]).T
+            plt.scatter(y, x, color='red')
+        ax = plt.axes()
+        ax.set_axis_off()
+        plt.show()
+
+    return crystals
+
+
+def _locate_crystals(img, pixelsize, spread=2.0, maxdim=256, **kwargs):
+    """Segment `img` and place the crystal positions, `pixelsize` is given
+    in micrometer.
+
+    Returns the crystal positions, the scaled image, the segmented image
+    and the scale factor.
+    """
+    img, scale = autoscale(img, maxdim=maxdim)  # scale down for faster
 
     # segment the image, and find objects
     arr, seg = segment_crystals(img, **kwargs)
@@ -142,8 +209,7 @@ def find_crystals(img, magnification, spread=2.0, plot=False, **kwargs):
     labels, numlabels = ndimage.label(seg)
     props = measure.regionprops(labels, img)
 
-    # calculate the pixel dimensions in micrometer
-    px = py = calibration['mag1']['pixelsize'][magnification] / 1000  # nm -> um
+    px = py = pixelsize
 
     iters = 20
 
@@ -179,17 +245,121 @@ def find_crystals(img, magnification, spread=2.0, plot=False, **kwargs):
             x, y = prop.centroid
             crystals.append(CrystalPosition(x / scale, y / scale, True, nclust, area, prop.area))
 
-    if plot:
-        plt.imshow(img)
-        plt.contour(seg, [0.5], linewidths=1.2, colors='yellow')
-        if len(crystals) > 0:
-            x, y = np.array([(crystal.x * scale, crystal.y * scale) for crystal in crystals]).T
-            plt.scatter(y, x, color='red')
-        ax = plt.axes()
-        ax.set_axis_off()
-        plt.show()
+    return crystals, img, seg, scale
 
-    return crystals
+
+def _locate_crystals_worker(args):
+    img, pixelsize, kwargs = args
+    return _locate_crystals(img, pixelsize, **kwargs)[0]
+
+
+class CrystalFinder(ProcessPoolMixin):
+    """Crystal finding engine, wraps `find_crystals` with a fixed set of
+    parameters and a selectable segmentation backend (see
+    `segment_crystals`), and adds a batch API that distributes images over
+    a process pool.
+
+    Usage:
+        finder = CrystalFinder.timepix(method='cg_j')
+        crystals = finder(img, magnification)
+        results = finder.find_batch(images, magnification, processes=4)
+        future = finder.submit(img, magnification)  # crystals = future.result()
+
+    method: str
+        Segmentation backend, one of 'bf', 'cg_j', 'watershed', 'threshold'
+    spread: float
+        Value in micrometer to roughly indicate the desired spread of centroids over individual regions
+    maxdim: int
+        Images are scaled down so that the largest dimension is at most `maxdim`
+    **kwargs:
+        keywords to pass to segment_crystals
+    """
+
+    def __init__(self, method: str = 'bf', spread: float = 2.0, maxdim: int = 256, **kwargs):
+        super().__init__()
+        if method not in SEGMENTATION_METHODS:
+            raise ValueError(f'Unknown segmentation method: `{method}`, must be one of {SEGMENTATION_METHODS}')
+        self.method = method
+        self.spread = spread
+        self.maxdim = maxdim
+        self.kwargs = kwargs
+
+    @classmethod
+    def timepix(cls, method: str = 'bf', spread: float = 0.6, **kwargs):
+        """Finder with the defaults of `find_crystals_timepix`"""
+        params = {'r': 75, 'offset': 15, 'footprint': 3, 'remove_carbon_lacing': False}
+        params.update(kwargs)
+        return cls(method=method, spread=spread, **params)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(method={self.method!r}, spread={self.spread})'
+
+    @property
+    def params(self) -> dict:
+        """Keyword arguments for `_locate_crystals`"""
+        return {'spread': self.spread, 'maxdim': self.maxdim, 'method': self.method, **self.kwargs}
+
+    @staticmethod
+    def pixelsize(magnification) -> float:
+        """Pixel size in micrometer for `magnification`"""
+        return config.calibration['mag1']['pixelsize'][magnification] / 1000  # nm -> um
+
+    def __call__(self, img, magnification) -> list:
+        """Find crystals in `img`, see `find_crystals`"""
+        return self.locate(img, self.pixelsize(magnification))
+
+    def locate(self, img, pixelsize: float) -> list:
+        """Find crystals in `img` with the pixel size given in micrometer."""
+        return _locate_crystals(img, pixelsize, **self.params)[0]
+
+    def segment(self, img) -> tuple:
+        """Segment `img`, returns the thresholded and segmented images."""
+        img, scale = autoscale(img, maxdim=self.maxdim)
+        return segment_crystals(img, method=self.method, **self.kwargs)
+
+    def find_batch(self, images, magnification=None, processes: int = None, pixelsize=None) -> list:
+        """Find crystals in a sequence of images.
+
+        images: list of 2d np.ndarray
+            Input images to locate crystals on
+        magnification: float or list of float
+            Magnification for all images, or one per image
+        processes: int
+            Number of worker processes, defaults to the number of CPUs. With
+            `processes=1`, the images are processed in this process. The pool
+            is kept alive for subsequent calls until `close` is called.
+        pixelsize: float or list of float
+            Pixel size in micrometer, can be given instead of `magnification`
+
+        Returns a list with the crystal positions for each image.
+        """
+        images = list(images)
+        if pixelsize is None:
+            if np.isscalar(magnification):
+                magnification = [magnification] * len(images)
+            pixelsize = [self.pixelsize(mag) for mag in magnification]
+        elif np.isscalar(pixelsize):
+            pixelsize = [pixelsize] * len(images)
+        pixelsizes = list(pixelsize)
+        if len(pixelsizes) != len(images):
+            raise ValueError(f'Got {len(images)} images but {len(pixelsizes)} magnifications/pixel sizes')
+
+        params = self.params
+        tasks = [(img, pixelsize, params) for img, pixelsize in zip(images, pixelsizes)]
+
+        return self._map(_locate_crystals_worker, tasks, processes)
+
+    def submit(self, img, magnification=None, pixelsize=None, processes: int = 1):
+        """Find crystals in `img` in a worker process, so that the caller
+        can continue (e.g. with the data collection) in the meantime.
+
+        Returns a `concurrent.futures.Future` with the crystal positions. The
+        process pool is shared with `find_batch`.
+        """
+        if pixelsize is None:
+            pixelsize = self.pixelsize(magnification)
+        pool = self._get_pool(processes)
+        return pool.submit(_locate_crystals_worker, (img, pixelsize, self.params))
 
 
 def main_entry():
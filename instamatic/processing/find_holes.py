@@ -1,6 +1,5 @@
 import sys
 
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy import ndimage
 from skimage import color
@@ -11,12 +10,15 @@ from skimage import segmentation
 
 from instamatic.config import calibration
 from instamatic.image_utils import autoscale
-
-plt.rcParams['image.cmap'] = 'gray'
+from instamatic.image_utils import disk
+from instamatic.utils.process_pool import ProcessPoolMixin
 
 
 def plot_features(img, segmented):
     """Take image and plot segments on top of them."""
+    import matplotlib.pyplot as plt
+    plt.rcParams['image.cmap'] = 'gray'
+
     labels, numlabels = ndimage.label(segmented)
     image_label_overlay = color.label2rgb(labels, image=img, bg_label=0)
 
@@ -42,7 +44,9 @@ def plot_features(img, segmented):
 
 def plot_props(img, props, fname=None, scale=1):
     """Take image and plot props on top of them."""
+    import matplotlib.pyplot as plt
     from matplotlib.patches import Rectangle
+    plt.rcParams['image.cmap'] = 'gray'
 
     fig = plt.figure(figsize=(15, 10))
     ax = fig.add_subplot(111)
@@ -148,7 +152,7 @@ def find_holes(img, area=0, plot=True, fname=None, verbose=True, max_eccentricit
     upper = otsu + (np.max(img) - otsu) * n
     if verbose:
         print(f'img range: {img.min()} - {img.max()}')
-        print(f'otsu: {otsu:.0f} ({lower:.0f} - {i:.0f})')
+        print(f'otsu: {otsu:.0f} ({lower:.0f} - {upper:.0f})')
 
     markers = get_markers_bounds(img, lower=lower, upper=upper, dark_on_bright=False, verbose=verbose)
     segmented = segmentation.random_walker(img, markers, beta=10, mode='bf')
@@ -158,7 +162,7 @@ def find_holes(img, area=0, plot=True, fname=None, verbose=True, max_eccentricit
 
     # segmented = ndimage.binary_fill_holes(segmented - 1)
 
-    segmentation.clear_border(segmented, buffer_size=0, bgval=0, in_place=True)
+    segmented = segmentation.clear_border(segmented, buffer_size=0, bgval=0)
 
     labels, numlabels = ndimage.label(segmented)
     props = measure.regionprops(labels, img)
@@ -174,7 +178,8 @@ def find_holes(img, area=0, plot=True, fname=None, verbose=True, max_eccentricit
 
         newprops.append(prop)
 
-    print(f' >> {len(newprops)} holes found in {numlabels} objects.')
+    if verbose:
+        print(f' >> {len(newprops)} holes found in {numlabels} objects.')
 
     if plot:
         plot_props(img, newprops)
@@ -184,6 +189,262 @@ def find_holes(img, area=0, plot=True, fname=None, verbose=True, max_eccentricit
     return newprops
 
 
+HOLE_DTYPE = np.dtype([
+    ('x', float),             # centroid, row in the tile/image
+    ('y', float),             # centroid, column in the tile/image
+    ('diameter', float),      # equivalent diameter in pixels
+    ('eccentricity', float),
+    ('area', float),          # pixels
+    ('stage_x', float),       # stage coordinate of the centroid, nan if unknown
+    ('stage_y', float),
+    ('tile', np.int32),       # index of the tile/image the hole was found in
+])
+
+
+def downsample(img: np.ndarray, factor: int) -> np.ndarray:
+    """Downsample `img` by averaging blocks of `factor` x `factor` pixels,
+    trailing rows/columns that do not fill a block are dropped."""
+    img = np.asarray(img, dtype=float)
+    if factor <= 1:
+        return img
+    ny, nx = (np.array(img.shape) // factor) * factor
+    blocks = img[:ny, :nx].reshape(ny // factor, factor, nx // factor, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def _segment_region(crop: np.ndarray, lower: float, upper: float, threshold: float) -> np.ndarray:
+    """Segment the holes in `crop` with the random walker, seeded using the
+    bounds of the whole image as in `find_holes`."""
+    markers = get_markers_bounds(crop, lower=lower, upper=upper, dark_on_bright=False, verbose=False)
+    if np.all(markers) or not (np.any(markers == 1) and np.any(markers == 2)):
+        segmented = crop > threshold
+    else:
+        segmented = segmentation.random_walker(crop, markers, beta=10, mode='bf') == 2
+    return morphology.binary_closing(segmented, disk(4))
+
+
+def find_holes_multiscale(img: np.ndarray, area: float = 0, max_eccentricity: float = 0.4,
+                          min_area_fraction: float = 0.75, coarse_maxdim: int = 256) -> np.ndarray:
+    """Find holes in two passes. The coarse pass thresholds a downsampled
+    copy of the image to find candidate regions, which are then segmented
+    at full resolution as in `find_holes`. Holes touching the image border
+    are rejected.
+
+    img: np.ndarray,
+        image as 2d numpy array
+    area: int or float,
+        approximate size in pixels of the feature to locate
+    max_eccentricity: float,
+        the maximum allowed eccentricity for hole detection (0.0: perfect circle to 1.0: prefect eccentric)
+    min_area_fraction: float,
+        holes smaller than `min_area_fraction * area` are rejected
+    coarse_maxdim: int,
+        the image is downsampled by an integer factor so that the largest dimension is at most `coarse_maxdim`
+
+    Returns:
+        holes: np.ndarray,
+            structured array with dtype `HOLE_DTYPE` (without stage coordinates)
+    """
+    img = np.asarray(img, dtype=float)
+    factor = max(1, int(np.ceil(max(img.shape) / coarse_maxdim)))
+    coarse = downsample(img, factor)
+
+    otsu = filters.threshold_otsu(coarse)
+    n = 0.25
+    lower = otsu - (otsu - np.min(coarse)) * n
+    upper = otsu + (np.max(coarse) - otsu) * n
+
+    candidates, _ = ndimage.label(coarse > otsu)
+    min_coarse_area = max(4, 0.5 * min_area_fraction * area / factor**2)
+    margin = 2 * factor + 4
+    ny, nx = img.shape
+
+    holes = []
+    for i, region in enumerate(ndimage.find_objects(candidates)):
+        candidate = candidates[region] == i + 1
+        if candidate.sum() < min_coarse_area:
+            continue
+
+        y0 = max(region[0].start * factor - margin, 0)
+        y1 = min(region[0].stop * factor + margin, ny)
+        x0 = max(region[1].start * factor - margin, 0)
+        x1 = min(region[1].stop * factor + margin, nx)
+
+        labels, numlabels = ndimage.label(_segment_region(img[y0:y1, x0:x1], lower, upper, otsu))
+        if not numlabels:
+            continue
+
+        # keep the object that overlaps most with the coarse candidate
+        cy, cx = np.nonzero(candidate)
+        cy = (cy + region[0].start) * factor + factor // 2 - y0
+        cx = (cx + region[1].start) * factor + factor // 2 - x0
+        inside = (cy < labels.shape[0]) & (cx < labels.shape[1])
+        counts = np.bincount(labels[cy[inside], cx[inside]], minlength=numlabels + 1)
+        counts[0] = 0
+        if not counts.any():
+            continue
+        mask = labels == counts.argmax()
+
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if ((y0 == 0 and rows[0] == 0) or (x0 == 0 and cols[0] == 0)
+                or (y1 == ny and rows[-1] == mask.shape[0] - 1) or (x1 == nx and cols[-1] == mask.shape[1] - 1)):
+            continue  # touches the image border, see `clear_border`
+
+        prop = measure.regionprops(mask.astype(np.uint8))[0]
+        if prop.eccentricity > max_eccentricity:
+            continue
+        if prop.area < area * min_area_fraction:
+            continue
+
+        py, px = prop.centroid
+        holes.append((py + y0, px + x0, prop.equivalent_diameter, prop.eccentricity, prop.area, np.nan, np.nan, 0))
+
+    return np.array(holes, dtype=HOLE_DTYPE)
+
+
+def _find_holes_worker(task: tuple) -> np.ndarray:
+    img, params = task
+    return find_holes_multiscale(img, **params)
+
+
+def merge_holes(holes: np.ndarray, radius: float) -> np.ndarray:
+    """Merge holes that were found in more than one (overlapping) tile.
+
+    Holes with stage coordinates closer than `radius` are considered the
+    same, of these the largest one is kept. Holes are only accepted if they
+    are completely inside a tile, so the copies are normally identical.
+    """
+    if len(holes) < 2:
+        return holes
+
+    from scipy.spatial import cKDTree
+
+    holes = holes[np.argsort(-holes['diameter'], kind='stable')]
+    tree = cKDTree(np.stack((holes['stage_x'], holes['stage_y']), axis=1))
+
+    keep = np.ones(len(holes), dtype=bool)
+    for i, neighbours in enumerate(tree.query_ball_point(tree.data, r=radius)):
+        if keep[i]:
+            keep[[j for j in neighbours if j > i]] = False
+
+    holes = holes[keep]
+    return holes[np.lexsort((holes['y'], holes['x'], holes['tile']))]
+
+
+class HoleFinder(ProcessPoolMixin):
+    """Hole finding engine for grid atlases, i.e. montage tiles or the
+    images of navigator map items.
+
+    Every tile is processed with `find_holes_multiscale`, distributed over
+    a process pool. The holes are converted to stage coordinates and the
+    holes found in the overlap between tiles are merged.
+
+    Usage:
+        finder = HoleFinder(area=calculate_hole_area(150, magnification))
+        holes = finder.find(img)
+        holes = finder.find_batch(images, stagecoords, stagematrix, processes=4)
+        holes = finder.find_montage(montage)
+        holes[['stage_x', 'stage_y']]
+
+    area: float
+        Approximate size in pixels of the holes to locate
+    max_eccentricity: float
+        The maximum allowed eccentricity of the holes
+    min_area_fraction: float
+        Holes smaller than `min_area_fraction * area` are rejected
+    coarse_maxdim: int
+        Maximum dimension of the image for the coarse pass
+    """
+
+    def __init__(self, area: float = 0, max_eccentricity: float = 0.4, min_area_fraction: float = 0.75, coarse_maxdim: int = 256):
+        super().__init__()
+        self.area = area
+        self.max_eccentricity = max_eccentricity
+        self.min_area_fraction = min_area_fraction
+        self.coarse_maxdim = coarse_maxdim
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(area={self.area}, max_eccentricity={self.max_eccentricity})'
+
+    @property
+    def params(self) -> dict:
+        """Keyword arguments for `find_holes_multiscale`"""
+        return {
+            'area': self.area,
+            'max_eccentricity': self.max_eccentricity,
+            'min_area_fraction': self.min_area_fraction,
+            'coarse_maxdim': self.coarse_maxdim,
+        }
+
+    def find(self, img: np.ndarray) -> np.ndarray:
+        """Find the holes in a single image."""
+        return find_holes_multiscale(img, **self.params)
+
+    def find_batch(self, images, stagecoords=None, stagematrix=None, processes: int = None, merge: float = 0.5) -> np.ndarray:
+        """Find the holes in a sequence of tiles.
+
+        images: list of 2d np.ndarray
+            Tiles or map item images
+        stagecoords: np.ndarray (N, 2)
+            Stage coordinates of the center of every tile
+        stagematrix: np.ndarray (2, 2)
+            Matrix that converts pixel coordinates to stage coordinates (as
+            in `InstamaticMontage`), a list with one matrix per tile is also
+            accepted
+        processes: int
+            Number of worker processes, defaults to the number of CPUs. With
+            `processes=1`, the tiles are processed in this process. The pool
+            is kept alive for subsequent calls until `close` is called.
+        merge: float
+            Holes closer than `merge` times the median hole diameter are
+            merged, only if stage coordinates are given
+
+        Returns a structured array with dtype `HOLE_DTYPE`, the `tile` field
+        gives the index of the tile in `images`.
+        """
+        images = list(images)
+        params = self.params
+        tasks = [(img, params) for img in images]
+
+        results = self._map(_find_holes_worker, tasks, processes)
+
+        for i, holes in enumerate(results):
+            holes['tile'] = i
+
+        holes = np.concatenate(results) if results else np.array([], dtype=HOLE_DTYPE)
+
+        if stagecoords is None or stagematrix is None:
+            return holes
+
+        stagecoords = np.asarray(stagecoords, dtype=float).reshape(-1, 2)
+        if len(stagecoords) != len(images):
+            raise ValueError(f'Got {len(images)} images but {len(stagecoords)} stage coordinates')
+        stagematrices = np.broadcast_to(np.asarray(stagematrix, dtype=float).reshape(-1, 2, 2), (len(images), 2, 2))
+        centers = np.array([np.array(img.shape) / 2 for img in images])
+
+        tile = holes['tile']
+        px = np.stack((holes['x'], holes['y']), axis=1) - centers[tile]
+        stage = np.einsum('ni,nij->nj', px, stagematrices[tile]) + stagecoords[tile]
+        holes['stage_x'] = stage[:, 0]
+        holes['stage_y'] = stage[:, 1]
+
+        if merge and len(holes):
+            pixelsize = np.sqrt(np.abs(np.linalg.det(stagematrices)))[tile]
+            radius = merge * np.median(holes['diameter'] * pixelsize)
+            holes = merge_holes(holes, radius)
+
+        return holes
+
+    def find_montage(self, montage, processes: int = None, merge: float = 0.5) -> np.ndarray:
+        """Find the holes in all tiles of a `Montage` (pyserialem) or
+        `InstamaticMontage`, the stage coordinates of the holes are
+        calculated from the stage coordinates of the tiles and the
+        montage stagematrix."""
+        return self.find_batch(montage.images, stagecoords=montage.stagecoords, stagematrix=montage.stagematrix,
+                               processes=processes, merge=merge)
+
+
 def find_holes_entry():
     from formats import read_image
 
@@ -10,10 +10,18 @@ from tqdm.auto import tqdm
 from instamatic import config
 from instamatic import TEMController
 from instamatic.formats import *
+from instamatic.image_utils import rotate_image
+from instamatic.processing.bad_pixels import BadPixelMap
 
 
-def apply_corrections(img, deadpixels=None):
-    """Apply image corrections."""
+def apply_corrections(img, deadpixels=None, bad_pixels=None):
+    """Apply image corrections.
+
+    If a `BadPixelMap` is given, it is used instead of the dead pixels
+    and the hardcoded center pixel correction.
+    """
+    if bad_pixels is not None:
+        return bad_pixels.correct(img, out=img)
     if deadpixels is None:
         deadpixels = get_deadpixels(img)
     img = remove_deadpixels(img, deadpixels)
@@ -23,12 +31,13 @@ def apply_corrections(img, deadpixels=None):
 
 def remove_deadpixels(img, deadpixels, d=1):
     """Remove dead pixels from the images by replacing them with the average of
-    neighbouring pixels."""
-    d = 1
-    for (i, j) in deadpixels:
-        neighbours = img[i - d:i + d + 1, j - d:j + d + 1].flatten()
-        img[i, j] = np.mean(neighbours)
-    return img
+    the good neighbouring pixels (in place).
+
+    For repeated use, create a `BadPixelMap` once and use
+    `BadPixelMap.correct`.
+    """
+    bad_pixels = BadPixelMap(img.shape, dead=deadpixels, max_radius=d)
+    return bad_pixels.correct(img, out=img)
 
 
 def get_deadpixels(img):
@@ -76,6 +85,121 @@ def apply_flatfield_correction(img, flatfield, darkfield=None):
     return ret
 
 
+class FrameStatistics:
+    """Per-pixel running mean and variance of a series of frames.
+
+    The frames are accumulated in float64 as they arrive using Welford's
+    algorithm, so that the memory use does not depend on the number of
+    frames.
+
+    Usage:
+        stats = FrameStatistics()
+        for img in frames:
+            stats.add(img)
+        stats.mean, stats.variance, stats.std
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.n = 0
+        self.mean = None
+        self._m2 = None
+        self._delta = None
+        self._tmp = None
+
+    def __repr__(self):
+        shape = None if self.mean is None else self.mean.shape
+        return f'{self.__class__.__name__}(n={self.n}, shape={shape})'
+
+    def add(self, img: np.ndarray) -> None:
+        """Add frame `img` to the statistics."""
+        if self.mean is None:
+            self.mean = np.zeros(img.shape, dtype=np.float64)
+            self._m2 = np.zeros_like(self.mean)
+            self._delta = np.empty_like(self.mean)
+            self._tmp = np.empty_like(self.mean)
+        elif img.shape != self.mean.shape:
+            raise ValueError(f'Frame shape {img.shape} does not match {self.mean.shape}')
+
+        self.n += 1
+        np.subtract(img, self.mean, out=self._delta)
+        np.multiply(self._delta, 1.0 / self.n, out=self._tmp)
+        self.mean += self._tmp
+        np.subtract(img, self.mean, out=self._tmp)
+        self._tmp *= self._delta
+        self._m2 += self._tmp
+
+    def add_stack(self, stack: np.ndarray) -> None:
+        """Add all frames in a 3D stack."""
+        for img in stack:
+            self.add(img)
+
+    @property
+    def variance(self) -> np.ndarray:
+        """Per-pixel sample variance."""
+        if self.n < 2:
+            return np.zeros_like(self.mean)
+        return self._m2 / (self.n - 1)
+
+    @property
+    def std(self) -> np.ndarray:
+        """Per-pixel standard deviation, i.e. the noise map."""
+        return np.sqrt(self.variance)
+
+
+def accumulate_frames(ctrl, frames: int, exposure: float, binsize: int, stats: FrameStatistics = None,
+                      save_images: bool = False, drc='.', name: str = 'flatfield') -> FrameStatistics:
+    """Collect `frames` images and accumulate them into `stats`
+
+    If the images do not have to be saved, the frames are read using the
+    continuous collection of the camera stream (or `ctrl.get_raw_image`)
+    without collecting the image headers. These frames are rotated/flipped
+    in the same way as `ctrl.get_image` (see `rotate_image`), so that the
+    orientation does not depend on `save_images`.
+    """
+    if stats is None:
+        stats = FrameStatistics()
+    drc = Path(drc)
+    progress = tqdm(total=frames)
+
+    def add(img):
+        stats.add(img)
+        progress.update()
+        return progress.n < frames
+
+    if save_images:
+        for n in range(frames):
+            outfile = drc / f'{name}_{n:04d}.tiff'
+            img, h = ctrl.get_image(exposure=exposure, binsize=binsize, out=outfile,
+                                    comment=f'{name.capitalize()} #{n:04d}', header_keys=None)
+            add(img)
+    else:
+        mode = ctrl.mode.get()
+        mag = ctrl.magnification.value
+
+        def add_raw(img):
+            return add(rotate_image(img, mode=mode, mag=mag))
+
+        if hasattr(ctrl.cam, 'continuous_collection') and binsize == ctrl.cam.default_binsize:
+            ctrl.cam.continuous_collection(exposure=exposure, callback=add_raw)
+        else:
+            for n in range(frames):
+                add_raw(ctrl.get_raw_image(exposure=exposure, binsize=binsize))
+
+    progress.close()
+    return stats
+
+
+def get_gain(flatfield: np.ndarray, darkfield: np.ndarray = None) -> np.ndarray:
+    """Per-pixel gain, i.e. the factor that `apply_flatfield_correction`
+    multiplies the dark-subtracted image with."""
+    response = flatfield if darkfield is None else flatfield - darkfield
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gain = np.mean(response) / response
+    gain[~np.isfinite(gain)] = 0
+    return gain
+
+
 def collect_flatfield(ctrl=None, frames=100, save_images=False, collect_darkfield=True, drc='.', **kwargs):
     """Routine to collect flatfield correction files.
 
@@ -84,10 +208,16 @@ def collect_flatfield(ctrl=None, frames=100, save_images=False, collect_darkfiel
     The optimal exposure time for each image is calculated automatically so that the response is at approximately
         1/10 the dynamic range
 
+    The frames are accumulated as they arrive (see `FrameStatistics`), so the memory use does not depend on `frames`.
+    Besides the flatfield and darkfield, a noise map (per-pixel standard deviation of the flatfield frames) is saved,
+    and the bad pixel map is determined from the flatfield, darkfield, and noise map.
+
     `frames`: number of frames to average for correction image(s)
     `save_images`: save the collected images
     `collect_darkfield`: additionally collect darkfield correction (by blanking the beam)
     `drc`: output directory
+
+    Returns a dict with the `flatfield`, `darkfield`, `gain`, `noise` (2D arrays), and `bad_pixels` (`BadPixelMap`)
     """
     exposure = kwargs.get('exposure', ctrl.cam.default_exposure)
     binsize = kwargs.get('binsize', ctrl.cam.default_binsize)
@@ -107,20 +237,19 @@ def collect_flatfield(ctrl=None, frames=100, save_images=False, collect_darkfiel
 
     ctrl.cam.block()
 
-    buffer = []
-
     print('\nCollecting flatfield images')
-    for n in tqdm(range(frames)):
-        outfile = drc / f'flatfield_{n:04d}.tiff' if save_images else None
-        img, h = ctrl.get_image(exposure=exposure, binsize=binsize, out=outfile, comment=f'Flat field #{n:04d}', header_keys=None)
-        buffer.append(img)
-
-    f = np.mean(buffer, axis=0)
-    deadpixels = get_deadpixels(f)
-    get_center_pixel_correction(f)
-    f = remove_deadpixels(f, deadpixels=deadpixels)
+    flat = accumulate_frames(ctrl, frames, exposure, binsize, save_images=save_images, drc=drc, name='flatfield')
+
+    f_raw = flat.mean
+    noise = flat.std
+    deadpixels = get_deadpixels(f_raw)
+    get_center_pixel_correction(f_raw)
+    f = BadPixelMap(f_raw.shape, dead=deadpixels).correct(f_raw)
     ff = drc / f'flatfield_{ctrl.cam.name}_{date}.tiff'
-    write_tiff(ff, f, header={'deadpixels': deadpixels})
+    write_tiff(ff, f, header={'deadpixels': deadpixels, 'frames': flat.n})
+
+    fn = drc / f'noise_{ctrl.cam.name}_{date}.tiff'
+    write_tiff(fn, noise, header={'frames': flat.n})
 
     fp = drc / f'deadpixels_tpx_{date}.npy'
     np.save(fp, deadpixels)
@@ -128,26 +257,37 @@ def collect_flatfield(ctrl=None, frames=100, save_images=False, collect_darkfiel
     if collect_darkfield:
         ctrl.beam.blank()
 
-        buffer = []
-
         print('\nCollecting darkfield images')
-        for n in tqdm(range(frames)):
-            outfile = drc / f'darkfield_{n:04d}.tiff' if save_images else None
-            img, h = ctrl.get_image(exposure=exposure, binsize=binsize, out=outfile, comment=f'Dark field #{n:04d}', header_keys=None)
-            buffer.append(img)
+        dark = accumulate_frames(ctrl, frames, exposure, binsize, save_images=save_images, drc=drc, name='darkfield')
 
-        d = np.mean(buffer, axis=0)
-        d = remove_deadpixels(d, deadpixels=deadpixels)
+        d_raw = dark.mean
+        d = remove_deadpixels(d_raw.copy(), deadpixels=deadpixels)
 
         ctrl.beam.unblank()
 
         fd = drc / f'darkfield_{ctrl.cam.name}_{date}.tiff'
-        write_tiff(fd, d, header={'deadpixels': deadpixels})
+        write_tiff(fd, d, header={'deadpixels': deadpixels, 'frames': dark.n})
+    else:
+        d_raw = d = None
 
     ctrl.cam.unblock()
 
+    bad_pixels = BadPixelMap.from_flatfield(f_raw, darkfield=d_raw, noise=noise)
+    if ctrl.cam.name == 'timepix':
+        bad_pixels.add_timepix_cross()
+    bad_pixels.save(BadPixelMap.sidecar(ff))
+    print(f'Bad pixel map: {bad_pixels} -> {BadPixelMap.sidecar(ff)}')
+
     print(f'\nFlatfield collection finished ({drc}).')
 
+    return {
+        'flatfield': f,
+        'darkfield': d,
+        'gain': get_gain(f, d),
+        'noise': noise,
+        'bad_pixels': bad_pixels,
+    }
+
 
 def main_entry():
     import argparse
@@ -156,7 +296,7 @@ This is a program that can collect and apply flatfield/darkfield corrections [li
 
     instamatic.flatfield --collect
 
-This will collect 100 images and average them to determine the flatfield image. A darkfield image is also collected by applying the same routine with the beam blanked. Dead pixels are identified as pixels with 0 intensities. To apply these corrections:
+This will collect 100 images and average them to determine the flatfield image. A darkfield image is also collected by applying the same routine with the beam blanked. Dead pixels are identified as pixels with 0 intensities, and hot pixels as outliers in the flatfield/darkfield. They are stored in a bad pixel map next to the flatfield (`flatfield_*.badpixels.npz`). To apply these corrections:
 
     instamatic.flatfield image.tiff [image.tiff ..] -f flatfield.tiff [-d darkfield.tiff] [-o drc]
 
@@ -204,7 +344,7 @@ This will apply the flatfield correction (`-f`) and optionally the darkfield cor
 
     if options.flatfield:
         flatfield, h = read_tiff(options.flatfield)
-        deadpixels = h['deadpixels']
+        bad_pixels = BadPixelMap.for_flatfield(options.flatfield, header=h, shape=flatfield.shape)
     else:
         print('No flatfield file specified')
         exit()
@@ -225,7 +365,7 @@ This will apply the flatfield correction (`-f`) and optionally the darkfield cor
     for f in args:
         img, h = read_tiff(f)
 
-        img = apply_corrections(img, deadpixels=deadpixels)
+        img = apply_corrections(img, bad_pixels=bad_pixels)
         img = apply_flatfield_correction(img, flatfield, darkfield=darkfield)
 
         name = Path(f).name
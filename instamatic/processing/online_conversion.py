@@ -0,0 +1,159 @@
+"""Convert diffraction frames while they are being collected.
+
+`OnlineConversion` sits between the acquisition loop and a pool of
+worker threads. Every frame passed to `submit` is flatfield corrected,
+its beam center is determined, and it is written in the requested
+formats (TIFF/SMV/MRC) while the data collection continues. The number
+of frames waiting for conversion is bounded, `submit` blocks if the
+workers fall behind.
+
+The SMV header contains the rotation geometry, which is only known once
+the rotation has stopped. SMV files are therefore written with a
+provisional header of the same size, which is replaced by
+`ImgConversion.update_smv_headers` at the end. The geometry-dependent
+input files (`write_xds_inp`, `write_ed3d`, `write_pets_inp`) are written
+by `ImgConversion` as before.
+
+Usage:
+    conv = OnlineConversion(tiff_path=..., smv_path=..., flatfield=...)
+    conv.submit(i, img, h)
+    ...
+    conv.join()
+    img_conv = ImgConversion(buffer, ..., beam_centers=conv.beam_centers)
+    img_conv.update_smv_headers(smv_path)
+"""
+import concurrent.futures
+import logging
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from instamatic.formats import read_tiff
+from instamatic.formats import write_adsc
+from instamatic.formats import write_mrc
+from instamatic.formats import write_tiff
+from instamatic.processing.flatfield import apply_flatfield_correction
+from instamatic.tools import find_beam_center
+from instamatic.tools import find_beam_center_with_beamstop
+
+logger = logging.getLogger(__name__)
+
+# provisional header, replaced once the geometry is known
+SMV_HEADER = {
+    'HEADER_BYTES': 512,
+    'DIM': 2,
+    'BYTE_ORDER': 'little_endian',
+    'TYPE': 'unsigned_short',
+}
+
+
+class OnlineConversion:
+    """Write frames to TIFF/SMV/MRC as they are collected.
+
+    tiff_path, smv_path, mrc_path: pathlib.Path
+        If given, write the frames in the corresponding format to this
+        directory, SMV files go to the `smv_subdrc` subdirectory
+    flatfield: str
+        Path to the flatfield image, or None
+    use_beamstop: bool
+        Find the beam center with `find_beam_center_with_beamstop`
+    workers: int
+        Number of worker threads
+    maxsize: int
+        Maximum number of frames waiting for conversion
+    """
+
+    def __init__(self,
+                 tiff_path: Path = None,
+                 smv_path: Path = None,
+                 mrc_path: Path = None,
+                 flatfield: str = None,
+                 use_beamstop: bool = False,
+                 smv_subdrc: str = 'data',
+                 workers: int = 4,
+                 maxsize: int = 16,
+                 ):
+        super().__init__()
+        self.tiff_path = tiff_path
+        self.smv_path = smv_path / smv_subdrc if smv_path is not None else None
+        self.mrc_path = mrc_path
+        self.use_beamstop = use_beamstop
+
+        for path in (self.tiff_path, self.smv_path, self.mrc_path):
+            if path is not None:
+                path.mkdir(exist_ok=True, parents=True)
+
+        if flatfield is not None:
+            flatfield, h = read_tiff(flatfield)
+        self.flatfield = flatfield
+
+        self.beam_centers = {}
+        self.filenames = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._futures = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(frames={len(self.beam_centers)})'
+
+    def submit(self, i: int, img: np.ndarray, h: dict) -> None:
+        """Queue frame `img` with sequence number `i` and header `h` for
+        conversion."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._convert, i, img, h)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        self._futures.append(future)
+
+    def _convert(self, i: int, img: np.ndarray, h: dict) -> None:
+        if self.flatfield is not None:
+            img = apply_flatfield_correction(img, self.flatfield)
+
+        if self.use_beamstop:
+            beam_center = find_beam_center_with_beamstop(img, z=99)
+        else:
+            beam_center = find_beam_center(img, sigma=10)
+        h = dict(h, beam_center=beam_center)
+
+        filenames = []
+        if self.tiff_path is not None:
+            fn = self.tiff_path / f'{i:05d}.tiff'
+            # PETS reads only 16bit unsigned integer TIFF
+            write_tiff(fn, np.round(img, 0).astype(np.uint16), header=h)
+            filenames.append(fn)
+        if self.smv_path is not None:
+            fn = self.smv_path / f'{i:05d}.img'
+            write_adsc(fn, np.ushort(img), header=dict(SMV_HEADER))
+            filenames.append(fn)
+        if self.mrc_path is not None:
+            fn = self.mrc_path / f'{i:05d}.mrc'
+            # flip up/down because RED reads images from the bottom left corner
+            write_mrc(fn, np.flipud(np.round(img, 0).astype(np.uint16)))
+            filenames.append(fn)
+
+        with self._lock:
+            self.beam_centers[i] = beam_center
+            self.filenames.extend(filenames)
+
+    def join(self) -> None:
+        """Wait until all submitted frames have been converted, and stop the
+        workers."""
+        self._executor.shutdown(wait=True)
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def discard(self) -> None:
+        """Wait for the workers, and remove the files written so far."""
+        try:
+            self.join()
+        except Exception as e:
+            logger.warning('Conversion failed: %s', e)
+        for fn in self.filenames:
+            fn.unlink()
+        self.filenames = []
@@ -0,0 +1,356 @@
+"""Spot finding for live diffraction quality metrics.
+
+`SpotFinder` classifies the pixels of a diffraction pattern as strong
+using the dispersion criterion of the DIALS spot finder: a pixel is
+strong if the index of dispersion (variance / mean) of its local window
+is larger than expected for Poisson noise, and it is significantly above
+the local mean. The local sums are computed with box filters, so a frame
+is processed in a few milliseconds. Strong pixels are grouped into spots
+(connected components), which are summarized in a structured array, and
+binned in resolution shells using the camera length calibration.
+
+`SpotMonitor` runs the spot finder in a background thread on frames as
+they come in from the camera, and keeps the quality metrics per frame.
+
+Usage:
+    finder = SpotFinder.for_camera_length(camera_length)
+    quality = finder(img)  # FrameQuality(n_spots, d_min, i_sigma)
+
+    monitor = SpotMonitor(finder)
+    monitor.submit(i, img)
+    ...
+    monitor.is_dead(window=20)
+    monitor.stop()
+"""
+import logging
+import queue
+import threading
+from collections import deque
+from collections import namedtuple
+
+import numpy as np
+from scipy import ndimage
+
+logger = logging.getLogger(__name__)
+
+
+FrameQuality = namedtuple('FrameQuality', ['n_spots', 'd_min', 'i_sigma'])
+
+SPOT_DTYPE = np.dtype([
+    ('x', float),             # intensity weighted centroid, row
+    ('y', float),             # intensity weighted centroid, column
+    ('intensity', float),     # background subtracted intensity
+    ('background', float),    # summed background under the spot
+    ('npix', np.int32),
+    ('i_sigma', float),
+    ('d', float),             # resolution in Angstrom, nan if the pixel size is unknown
+])
+
+_STRUCTURE = np.ones((3, 3), dtype=bool)
+
+
+class SpotFinder:
+    """Find spots in diffraction patterns.
+
+    gain: float
+        Detector gain (counts per electron), used for the Poisson statistics
+    kernel_size: int
+        Half-width of the local window used to estimate the background
+    sigma_background: float
+        Threshold on the index of dispersion, in standard deviations
+    sigma_strong: float
+        Threshold on the pixel intensity above the local mean, in standard
+        deviations
+    min_spot_size, max_spot_size: int
+        Minimum/maximum number of pixels in a spot
+    pixelsize: float
+        Pixel size in reciprocal Angstrom (the `diff` pixelsize calibration),
+        if None, no resolution is calculated
+    center: tuple
+        Position of the direct beam, if None, the brightest spot is taken as
+        the direct beam
+    d_max: float
+        Spots at lower resolution (in Angstrom) are ignored
+    mask: np.ndarray
+        Boolean array, True for pixels that must be ignored
+    """
+
+    def __init__(self,
+                 gain: float = 1.0,
+                 kernel_size: int = 3,
+                 sigma_background: float = 6.0,
+                 sigma_strong: float = 3.0,
+                 min_spot_size: int = 2,
+                 max_spot_size: int = 1000,
+                 pixelsize: float = None,
+                 center: tuple = None,
+                 d_max: float = 20.0,
+                 mask: np.ndarray = None,
+                 ):
+        super().__init__()
+        self.gain = gain
+        self.kernel_size = kernel_size
+        self.sigma_background = sigma_background
+        self.sigma_strong = sigma_strong
+        self.min_spot_size = min_spot_size
+        self.max_spot_size = max_spot_size
+        self.pixelsize = pixelsize
+        self.center = center
+        self.d_max = d_max
+        self.mask = mask
+        self._cache = {}
+
+    @classmethod
+    def for_camera_length(cls, camera_length: int, **kwargs):
+        """Spot finder with the pixel size calibrated for `camera_length`"""
+        from instamatic import config
+        pixelsize = config.calibration_tables.get('diff', 'pixelsize', camera_length)
+        if pixelsize is None:
+            logger.warning('No calibrated pixelsize for camera length=%s, resolution is not available', camera_length)
+        return cls(pixelsize=pixelsize, **kwargs)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(gain={self.gain}, kernel_size={self.kernel_size}, pixelsize={self.pixelsize})'
+
+    def _filter(self, arr: np.ndarray, output=None) -> np.ndarray:
+        """Sum over the local window of every pixel."""
+        size = 2 * self.kernel_size + 1
+        return ndimage.uniform_filter(arr, size, output=output, mode='constant') * size**2
+
+    def _window_stats(self, shape: tuple) -> tuple:
+        """Weights (0 for masked pixels), number of unmasked pixels in the
+        window of every pixel, the dispersion threshold (times n - 1) for
+        every pixel, and the offsets of the window in the padded frame,
+        cached per frame shape."""
+        stats = self._cache.get(shape)
+        if stats is None:
+            k = self.kernel_size
+            weights = np.ones(shape) if self.mask is None else (~np.asarray(self.mask, dtype=bool)).astype(float)
+            n = np.rint(self._filter(weights))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                threshold = self.gain * (1 + self.sigma_background * np.sqrt(2 / (n - 1))) * (n - 1)
+            threshold[(n <= 2) | (weights == 0)] = np.inf
+            dy, dx = np.mgrid[-k:k + 1, -k:k + 1].reshape(2, -1)
+            offsets = dy * (shape[1] + 2 * k) + dx
+            stats = self._cache[shape] = (weights.astype(np.float32), n.astype(np.float32), threshold, offsets)
+        return stats
+
+    def _window_squares(self, img: np.ndarray, pixels: np.ndarray) -> np.ndarray:
+        """Sum of squares over the local window of `pixels` (flat indices),
+        only the windows of the given pixels are evaluated."""
+        k = self.kernel_size
+        offsets = self._window_stats(img.shape)[3]
+        padded = np.pad(img, k).ravel().astype(float)
+        rows, cols = np.divmod(pixels, img.shape[1])
+        centers = (rows + k) * (img.shape[1] + 2 * k) + cols + k
+        values = padded[centers[:, None] + offsets]
+        return np.einsum('ij,ij->i', values, values)
+
+    def threshold(self, img: np.ndarray) -> tuple:
+        """Classify the pixels of `img`
+
+        Returns the boolean mask of strong pixels and the local mean
+        (background).
+        """
+        img = np.asarray(img, dtype=np.float32)
+        weights, n, threshold = self._window_stats(img.shape)[:3]
+        if self.mask is not None:
+            img = img * weights
+
+        total = self._filter(img, output=np.float32)
+        mean = total / n
+
+        # pixels significantly above the local mean, this rejects most
+        # pixels, so the dispersion is only evaluated for the candidates
+        signal = img - mean
+        strong = signal > 0
+        strong &= signal * signal > (self.sigma_strong**2 * self.gain) * mean
+        strong &= mean > 0
+
+        # index of dispersion: variance / mean > threshold
+        candidates = np.flatnonzero(strong)
+        if len(candidates):
+            squares = self._window_squares(img, candidates)
+            total_c = total.ravel()[candidates].astype(float)
+            mean_c = mean.ravel()[candidates].astype(float)
+            dispersed = squares - total_c * mean_c > threshold.ravel()[candidates] * mean_c
+            strong.ravel()[candidates[~dispersed]] = False
+        return strong, mean
+
+    def find_spots(self, img: np.ndarray) -> np.ndarray:
+        """Find the spots in `img`
+
+        Returns a structured array with dtype `SPOT_DTYPE`, the direct beam
+        and spots below `d_max` are excluded.
+        """
+        strong, background = self.threshold(img)
+        labels, n = ndimage.label(strong, structure=_STRUCTURE)
+        if n == 0:
+            return np.array([], dtype=SPOT_DTYPE)
+
+        pixels = np.flatnonzero(labels)
+        index = labels.ravel()[pixels] - 1
+        counts = np.asarray(img, dtype=float).ravel()[pixels]
+        bg = background.ravel()[pixels]
+        signal = np.clip(counts - bg, 0, None)
+        rows, cols = np.divmod(pixels, strong.shape[1])
+
+        def total(weights=None):
+            return np.bincount(index, weights=weights, minlength=n)
+
+        npix = total()
+        counts = total(counts)
+        bg = total(bg)
+        weights = total(signal)
+
+        spots = np.empty(n, dtype=SPOT_DTYPE)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            spots['x'] = total(signal * rows) / weights
+            spots['y'] = total(signal * cols) / weights
+            spots['i_sigma'] = (counts - bg) / np.sqrt(self.gain * counts)
+        spots['intensity'] = counts - bg
+        spots['background'] = bg
+        spots['npix'] = npix
+
+        keep = (npix >= self.min_spot_size) & (npix <= self.max_spot_size) & (weights > 0)
+
+        center = self.center
+        if center is None:
+            direct_beam = np.argmax(spots['intensity'])
+            center = spots['x'][direct_beam], spots['y'][direct_beam]
+            keep[direct_beam] = False
+
+        if self.pixelsize:
+            with np.errstate(divide='ignore'):
+                spots['d'] = 1 / (np.hypot(spots['x'] - center[0], spots['y'] - center[1]) * self.pixelsize)
+            if self.d_max:
+                keep &= spots['d'] < self.d_max
+        else:
+            spots['d'] = np.nan
+
+        return spots[keep]
+
+    def resolution_shells(self, spots: np.ndarray, n_shells: int = 10) -> tuple:
+        """Bin `spots` in `n_shells` resolution shells of equal reciprocal
+        volume.
+
+        Returns the resolution (Angstrom) at the outer edge of every shell,
+        the number of spots, and the mean I/sigma per shell.
+        """
+        q = 1 / spots['d']
+        edges = np.linspace(0, np.max(q)**3, n_shells + 1) ** (1 / 3)
+        shell = np.clip(np.searchsorted(edges, q, side='right') - 1, 0, n_shells - 1)
+        counts = np.bincount(shell, minlength=n_shells)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            i_sigma = np.bincount(shell, weights=spots['i_sigma'], minlength=n_shells) / counts
+        return 1 / edges[1:], counts, i_sigma
+
+    def estimate_resolution(self, spots: np.ndarray, min_i_sigma: float = 2.0, n_shells: int = 10, min_spots: int = 2) -> float:
+        """Estimate the resolution (Angstrom) of a frame as the outer edge of
+        the highest resolution shell with at least `min_spots` spots and a
+        mean I/sigma of at least `min_i_sigma`"""
+        if not len(spots) or not self.pixelsize:
+            return np.nan
+        d, counts, i_sigma = self.resolution_shells(spots, n_shells=n_shells)
+        good = np.flatnonzero((counts >= min_spots) & (i_sigma >= min_i_sigma))
+        if not len(good):
+            return np.nan
+        return float(d[good[-1]])
+
+    def __call__(self, img: np.ndarray) -> FrameQuality:
+        """Return the number of spots, the resolution estimate, and the mean
+        I/sigma of the spots in `img`"""
+        spots = self.find_spots(img)
+        i_sigma = float(np.mean(spots['i_sigma'])) if len(spots) else 0.0
+        return FrameQuality(len(spots), self.estimate_resolution(spots), i_sigma)
+
+
+class SpotMonitor:
+    """Run a `SpotFinder` in a background thread on frames as they are
+    collected.
+
+    Frames are queued with `submit`. If the spot finder cannot keep up,
+    frames are dropped rather than slowing down the data collection.
+
+    finder: SpotFinder
+        The spot finder to use
+    maxsize: int
+        Maximum number of frames waiting in the queue
+    history: int
+        Number of most recent results kept for `latest` and `is_dead`
+    """
+
+    def __init__(self, finder: SpotFinder, maxsize: int = 4, history: int = 100):
+        super().__init__()
+        self.finder = finder
+        self.results = {}
+        self.n_dropped = 0
+        self._recent = deque(maxlen=history)
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='SpotMonitor', daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(frames={len(self.results)}, dropped={self.n_dropped})'
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            i, img = item
+            try:
+                quality = self.finder(img)
+            except Exception as e:
+                logger.warning('Spot finding failed on frame %s: %s', i, e)
+                continue
+            with self._lock:
+                self.results[i] = quality
+                self._recent.append((i, quality))
+
+    def submit(self, i: int, img: np.ndarray) -> bool:
+        """Queue frame `img` with number `i`, returns False if the frame was
+        dropped."""
+        try:
+            self._queue.put_nowait((i, img))
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+        return True
+
+    def latest(self, n: int = 1) -> list:
+        """Quality metrics of the last `n` analyzed frames (at most
+        `history`), as a list of (i, FrameQuality)"""
+        with self._lock:
+            recent = list(self._recent)
+        return recent[-n:]
+
+    def is_dead(self, window: int = 20, min_spots: int = 3) -> bool:
+        """True if none of the last `window` analyzed frames has at least
+        `min_spots` spots."""
+        if window > self._recent.maxlen:
+            raise ValueError(f'`window` ({window}) is larger than the history ({self._recent.maxlen})')
+        latest = self.latest(window)
+        if len(latest) < window:
+            return False
+        return all(quality.n_spots < min_spots for i, quality in latest)
+
+    def stop(self) -> dict:
+        """Process the remaining frames and stop the thread, returns the
+        results."""
+        self._queue.put(None)
+        self._thread.join()
+        return self.results
+
+    def to_array(self) -> np.ndarray:
+        """Results as a structured array with fields `frame`, `n_spots`,
+        `d_min`, and `i_sigma`"""
+        dtype = [('frame', np.int32), ('n_spots', np.int32), ('d_min', float), ('i_sigma', float)]
+        with self._lock:
+            return np.array([(i, *quality) for i, quality in sorted(self.results.items())], dtype=dtype)
+
+    def write(self, fn: str) -> None:
+        """Write the results to text file `fn`"""
+        arr = self.to_array()
+        np.savetxt(fn, arr, fmt=['%6d', '%8d', '%10.3f', '%10.3f'], header='frame  n_spots      d_min    i_sigma')
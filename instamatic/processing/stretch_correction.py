@@ -1,9 +1,8 @@
 import math
 import sys
+from collections import OrderedDict
 
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.widgets import Slider
 from scipy.ndimage import interpolation
 from scipy.ndimage import morphology
 from skimage.feature import canny
@@ -90,6 +89,166 @@ def apply_stretch_correction(z, center=None, azimuth: float = 0, amplitude: floa
     return z
 
 
+def bilinear_operator(shape: tuple, transform: np.ndarray, offset: np.ndarray):
+    """Return a sparse matrix that applies the affine transformation with
+    bilinear interpolation to a flattened image, so that `(M @
+    img.ravel()).reshape(shape)` is equal to `scipy.ndimage.affine_transform(img,
+    transform, offset=offset, order=1, mode='constant', cval=0.0)`"""
+    from scipy import sparse
+
+    nx, ny = shape
+    n = nx * ny
+
+    xi, yi = np.indices(shape)
+    sx = transform[0, 0] * xi + transform[0, 1] * yi + offset[0]
+    sy = transform[1, 0] * xi + transform[1, 1] * yi + offset[1]
+
+    # pixels that map outside the image are 0
+    inside = (sx >= 0) & (sx <= nx - 1) & (sy >= 0) & (sy <= ny - 1)
+    x0 = np.clip(np.floor(sx), 0, nx - 1).astype(np.intp)
+    y0 = np.clip(np.floor(sy), 0, ny - 1).astype(np.intp)
+    fx = np.where(inside, sx - x0, 0.0)
+    fy = np.where(inside, sy - y0, 0.0)
+
+    indices = np.empty((n, 4), dtype=np.intp)
+    weights = np.empty((n, 4))
+    i = 0
+    for dx, wx in ((0, 1 - fx), (1, fx)):
+        for dy, wy in ((0, 1 - fy), (1, fy)):
+            x = np.minimum(x0 + dx, nx - 1)
+            y = np.minimum(y0 + dy, ny - 1)
+            indices[:, i] = (x * ny + y).ravel()
+            weights[:, i] = np.where(inside, wx * wy, 0.0).ravel()
+            i += 1
+
+    indptr = np.arange(0, 4 * n + 1, 4)
+    return sparse.csr_matrix((weights.ravel(), indices.ravel(), indptr), shape=(n, n))
+
+
+class StretchCorrector:
+    """Stretch correction with a precomputed interpolation operator.
+
+    Gives the same result as `apply_stretch_correction` (bilinear
+    interpolation, 0 outside the image), but the source indices and
+    weights are computed once per image shape and center and stored as a
+    sparse matrix, so that correcting a frame is reduced to a single
+    sparse matrix-vector product.
+
+    The operator depends on the center only through a small shift
+    `(1 - T) * center`, so the center is rounded to a grid that is
+    chosen such that the error in the source coordinates stays below
+    `tolerance` pixels. Operators for the last `cache_size` (shape,
+    center) combinations are kept.
+
+    azimuth: float
+        Direction of the azimuth in degrees with respect to the vertical axis
+    amplitude: float
+        The difference in percent between the long and short axes
+    tolerance: float
+        Maximum error in pixels of the source coordinates due to the rounding
+        of the center, use 0 to use the exact center
+
+    Usage:
+        corrector = StretchCorrector(config.camera.stretch_azimuth, config.camera.stretch_amplitude)
+        img = corrector(img, center=beam_center)
+        stack = corrector.correct_stack(stack, centers=beam_centers)
+    """
+
+    def __init__(self, azimuth: float = 0, amplitude: float = 0, tolerance: float = 0.01, cache_size: int = 8):
+        super().__init__()
+        self.azimuth = azimuth
+        self.amplitude = amplitude
+        self.tolerance = tolerance
+        self.cache_size = cache_size
+
+        azimuth_rad = np.radians(azimuth)    # go to radians
+        amplitude_pc = amplitude / (2 * 100)   # as percentage
+        self.transform = affine_transform_ellipse_to_circle(azimuth_rad, amplitude_pc)
+
+        # the shift changes by (1 - T) * d when the center moves by d
+        norm = np.linalg.norm(np.eye(2) - self.transform, ord=2)
+        if norm == 0:
+            self.center_step = None  # identity, the center does not matter
+        elif tolerance == 0:
+            self.center_step = 0
+        else:
+            self.center_step = 2 * tolerance / norm
+
+        self._cache = OrderedDict()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(azimuth={self.azimuth}, amplitude={self.amplitude})'
+
+    def _round_center(self, center) -> tuple:
+        step = self.center_step
+        if step is None:
+            return (0.0, 0.0)
+        if step == 0:
+            return tuple(float(c) for c in center)
+        return tuple(float(np.round(c / step) * step) for c in center)
+
+    def get_operator(self, shape: tuple, center=None):
+        """Return the interpolation operator (sparse matrix) for `shape` and
+        `center`"""
+        if center is None:
+            center = (np.array(shape)[::-1] - 1) / 2.0  # as in `apply_transform_to_image`
+        center = self._round_center(center)
+        key = (tuple(shape), center)
+        try:
+            operator = self._cache[key]
+            self._cache.move_to_end(key)
+            return operator
+        except KeyError:
+            pass
+
+        center = np.array(center)
+        offset = center - np.dot(self.transform, center)
+        operator = bilinear_operator(shape, self.transform, offset)
+
+        self._cache[key] = operator
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return operator
+
+    def __call__(self, img: np.ndarray, center=None, out: np.ndarray = None) -> np.ndarray:
+        """Apply the stretch correction to `img`
+
+        center: list of floats
+            pixel coordinates of the center of the direct beam
+        out: np.ndarray
+            Array to write the result to, can be `img` itself
+
+        returns:
+            ndarray with the same shape and dtype as `img`
+        """
+        operator = self.get_operator(img.shape, center)
+        result = operator @ img.ravel()
+
+        if out is None:
+            out = np.empty(img.shape, dtype=img.dtype)
+        if np.issubdtype(out.dtype, np.integer):
+            info = np.iinfo(out.dtype)
+            np.clip(np.round(result, out=result), info.min, info.max, out=result)
+        out[...] = result.reshape(img.shape)
+        return out
+
+    def correct_stack(self, stack: np.ndarray, centers=None, out: np.ndarray = None) -> np.ndarray:
+        """Apply the stretch correction to every frame in a 3D stack.
+
+        centers: list of (float, float)
+            Beam center for every frame, or a single center for all frames
+        out: np.ndarray
+            Array to write the result to, can be `stack` itself
+        """
+        if out is None:
+            out = np.empty_like(stack)
+        if centers is None or np.ndim(centers) == 1:
+            centers = [centers] * len(stack)
+        for i, (frame, center) in enumerate(zip(stack, centers)):
+            self(frame, center=center, out=out[i])
+        return out
+
+
 def make_title(prop):
     """Make the title for the plot."""
     azimuth = np.degrees(prop.orientation)
@@ -102,6 +261,9 @@ def make_title(prop):
 def get_sigma_interactive(img, sigma=20):
     """Interactive function to get the sigma threshold value for the edge
     detection."""
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Slider
+
     edges = canny(img, sigma=sigma, low_threshold=None, high_threshold=None)
 
     fig, ax = plt.subplots()
@@ -147,6 +309,8 @@ def get_sigma_interactive(img, sigma=20):
 
 def plot_props(edges, props):
     """Plot the ring structures."""
+    import matplotlib.pyplot as plt
+
     plt.imshow(edges)
     for prop in props:
         print('centroid = ({:.2f}, {:.2f})'.format(*prop.centroid))
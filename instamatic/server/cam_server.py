@@ -13,6 +13,7 @@ from .serializer import loader
 from instamatic import config
 from instamatic.camera import Camera
 from instamatic.utils import high_precision_timers
+from instamatic.utils.instrumentation import track
 high_precision_timers.enable()
 
 if config.settings.cam_use_shared_memory:
@@ -94,7 +95,8 @@ class CamServer(threading.Thread):
                 kwargs = cmd.get('kwargs', {})
 
                 try:
-                    ret = self.evaluate(attr_name, args, kwargs)
+                    with track(f'CamServer.{attr_name}'):
+                        ret = self.evaluate(attr_name, args, kwargs)
                     status = 200
                 except Exception as e:
                     traceback.print_exc()
@@ -11,6 +11,7 @@ from .serializer import dumper
 from .serializer import loader
 from instamatic import config
 from instamatic.TEMController import Microscope
+from instamatic.utils.instrumentation import track
 
 condition = threading.Condition()
 box = []
@@ -57,7 +58,8 @@ class TemServer(threading.Thread):
                 kwargs = cmd.get('kwargs', {})
 
                 try:
-                    ret = self.evaluate(func_name, args, kwargs)
+                    with track(f'TemServer.{func_name}'):
+                        ret = self.evaluate(func_name, args, kwargs)
                     status = 200
                 except Exception as e:
                     traceback.print_exc()
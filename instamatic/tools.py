@@ -4,10 +4,6 @@ import sys
 from pathlib import Path
 
 import numpy as np
-from scipy import interpolate
-from scipy import ndimage
-from skimage import exposure
-from skimage.measure import regionprops
 
 
 def prepare_grid_coordinates(nx: int, ny: int, stepsize: float = 1.0) -> 'np.array':
@@ -91,6 +87,9 @@ def find_peak_max(arr: np.ndarray, sigma: int, m: int = 50, w: int = 10, kind: i
     interpolate the pattern to get the peak maximum position with
     subpixel precision.
     """
+    from scipy import interpolate
+    from scipy import ndimage
+
     y1 = ndimage.filters.gaussian_filter1d(arr, sigma)
     c1 = np.argmax(y1)  # initial guess for beam center
 
@@ -141,6 +140,8 @@ def find_beam_center_with_beamstop(img, z: int = None, method='thresh', plot=Fal
     z = thresh: percentile to segment the image at (99)
         gauss: standard deviation for the gaussian blurring (50)
     """
+    from scipy import ndimage
+    from skimage.measure import regionprops
 
     if method == 'gauss':
         if not z:
@@ -0,0 +1,179 @@
+"""Azimuthal integration of diffraction patterns.
+
+`AzimuthalIntegrator` computes radial profiles of single frames or whole
+stacks. The map of radial bin indices for every pixel is computed once
+per (frame shape, center, mask) and cached, so that integrating a frame
+is a single weighted `np.bincount`. The center is rounded to a sub-pixel
+grid, so that small fluctuations of the beam center reuse the same map.
+
+Usage:
+    integrator = AzimuthalIntegrator(binsize=1.0)
+    profile = integrator.integrate(img, center=(258, 258), mask=beamstop_mask)
+    profiles, variance = integrator.integrate(stack, center, variance=True)
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RadialBins:
+    """Radial bin map for a given frame shape, center and mask.
+
+    Masked pixels are assigned to an extra bin with index `n_bins`, which
+    is dropped from the results.
+    """
+
+    def __init__(self, shape: tuple, center: tuple, binsize: float = 1.0, mask: np.ndarray = None):
+        super().__init__()
+        self.shape = tuple(shape)
+        self.center = tuple(center)
+        self.binsize = binsize
+
+        y, x = np.ogrid[:shape[0], :shape[1]]
+        r = np.sqrt((x - center[1])**2 + (y - center[0])**2)
+        bins = (r / binsize).astype(np.intp).ravel()
+        self.n_bins = int(bins.max()) + 1
+
+        if mask is not None:
+            bins[np.asarray(mask, dtype=bool).ravel()] = self.n_bins
+
+        self.bins = bins
+        self.counts = np.bincount(bins, minlength=self.n_bins + 1)[:self.n_bins]
+
+    @property
+    def radii(self) -> np.ndarray:
+        """Radius (in pixels) of the lower edge of every bin."""
+        return np.arange(self.n_bins) * self.binsize
+
+    def _mean(self, sums: np.ndarray) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / self.counts
+
+    def sum(self, data: np.ndarray) -> np.ndarray:
+        """Sum the pixels in every bin, `data` is a frame or a stack."""
+        if data.ndim == 2:
+            return np.bincount(self.bins, weights=data.ravel(), minlength=self.n_bins + 1)[:self.n_bins]
+        # a bincount per frame is faster than a sparse matrix product over
+        # the stack, which has to walk the frames with a large stride
+        return np.array([self.sum(frame) for frame in data])
+
+    def mean(self, data: np.ndarray) -> np.ndarray:
+        """Average of the pixels in every bin (nan for empty bins)."""
+        return self._mean(self.sum(data))
+
+    def variance(self, data: np.ndarray, mean: np.ndarray = None) -> np.ndarray:
+        """Variance of the pixels in every bin, `mean` is the output of
+        `self.mean(data)`"""
+        if mean is None:
+            mean = self.mean(data)
+        if data.ndim == 3:
+            return np.array([self.variance(frame, frame_mean) for frame, frame_mean in zip(data, mean)])
+        deviation = data.ravel() - np.append(mean, 0)[self.bins]
+        return self._mean(self.sum((deviation**2).reshape(data.shape)))
+
+    def to_image(self, profile: np.ndarray, fill: float = np.nan) -> np.ndarray:
+        """Map the radial profile back onto the pixels of the frame, masked
+        pixels are set to `fill`"""
+        profile = np.append(profile, fill)
+        return profile[self.bins].reshape(self.shape)
+
+
+class AzimuthalIntegrator:
+    """Azimuthal integration with cached radial bin maps.
+
+    binsize: float
+        Width of the radial bins in pixels
+    subpixel: int
+        The center is rounded to 1/`subpixel` of a pixel, centers that round
+        to the same value share the cached bin map
+    cache_size: int
+        Maximum number of bin maps to keep
+    """
+
+    def __init__(self, binsize: float = 1.0, subpixel: int = 10, cache_size: int = 16):
+        super().__init__()
+        self.binsize = binsize
+        self.subpixel = subpixel
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(binsize={self.binsize}, subpixel={self.subpixel})'
+
+    @staticmethod
+    def _mask_key(mask: np.ndarray):
+        if mask is None:
+            return None
+        mask = np.asarray(mask, dtype=bool)
+        return hashlib.blake2b(np.packbits(mask).tobytes(), digest_size=16).digest()
+
+    def get_bins(self, shape: tuple, center: tuple, mask: np.ndarray = None) -> RadialBins:
+        """Return the (cached) bin map for `shape`, `center` and `mask`"""
+        center = tuple(round(float(c) * self.subpixel) / self.subpixel for c in center)
+        key = (tuple(shape), center, self._mask_key(mask))
+
+        with self._lock:
+            bins = self._cache.get(key)
+            if bins is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return bins
+
+        bins = RadialBins(shape, center, binsize=self.binsize, mask=mask)
+
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = bins
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return bins
+
+    def integrate(self, data: np.ndarray, center: tuple, mask: np.ndarray = None, variance: bool = False):
+        """Calculate the radial profile of a frame or a stack of frames.
+
+        data: np.ndarray
+            2D frame, or 3D stack of frames with the same center
+        center: tuple
+            Position (in array indices) of the direct beam
+        mask: np.ndarray
+            Boolean array with the shape of a frame, True for pixels that
+            must be ignored (beamstop, dead pixels)
+        variance: bool
+            Also return the variance of the pixels in every bin
+
+        Returns the radial profile with shape (n_bins,) for a frame, or
+        (N, n_bins) for a stack, and the variance with the same shape if
+        requested. Empty bins are nan.
+        """
+        data = np.asarray(data)
+        bins = self.get_bins(data.shape[-2:], center, mask=mask)
+        mean = bins.mean(data)
+        if variance:
+            return mean, bins.variance(data, mean)
+        return mean
+
+    def radial_map(self, data: np.ndarray, center: tuple, mask: np.ndarray = None) -> np.ndarray:
+        """Return the radial average of frame `data` mapped onto the pixels of
+        the frame."""
+        bins = self.get_bins(data.shape, center, mask=mask)
+        return bins.to_image(bins.mean(data))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+_integrator = None
+
+
+def get_integrator() -> AzimuthalIntegrator:
+    """Return a shared `AzimuthalIntegrator` with the default settings."""
+    global _integrator
+    if _integrator is None:
+        _integrator = AzimuthalIntegrator()
+    return _integrator
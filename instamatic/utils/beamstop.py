@@ -6,6 +6,7 @@ from skimage.measure import find_contours
 
 from instamatic.formats import read_tiff
 from instamatic.tools import find_beam_center_with_beamstop
+from instamatic.utils.azimuthal import get_integrator
 
 
 def minimum_bounding_rectangle(points):
@@ -88,17 +89,14 @@ def radial_average(z, center, as_radial_map=False):
     -------
     radial_profile : array
         Radial profile of the diffraction pattern.
-    """
-    y, x = np.indices(z.shape)
-    r = np.sqrt((x - center[1])**2 + (y - center[0])**2)
-    r = r.astype(np.int)
 
-    tbin = np.bincount(r.ravel(), z.ravel())
-    nr = np.bincount(r.ravel())
-    averaged = tbin / nr
+    The bin map is cached, see `instamatic.utils.azimuthal`.
+    """
+    bins = get_integrator().get_bins(z.shape, center)
+    averaged = bins.mean(z)
 
     if as_radial_map:
-        return averaged[r]
+        return bins.to_image(averaged)
     else:
         return averaged
 
@@ -141,12 +139,14 @@ def find_beamstop_rect(img, center=None, threshold=0.5, pad=1, minsize=500, save
 
     # pad the beamstop to make the outline a big bigger
     if pad:
-        seg = morphology.binary_dilation(seg, selem=morphology.disk(pad))
+        seg = morphology.binary_dilation(seg, morphology.disk(pad))
 
     arr = find_contours(seg, 0.5)
 
     if len(arr) > 1:
         rects = [minimum_bounding_rectangle(a) for a in arr if len(a) > minsize]
+        if not rects:
+            rects = [minimum_bounding_rectangle(max(arr, key=len))]
 
         a = [np.mean(rect, axis=0) for rect in rects]
         dists = [np.linalg.norm(b - center) for b in a]
@@ -192,6 +192,153 @@ def find_beamstop_rect(img, center=None, threshold=0.5, pad=1, minsize=500, save
     return rect
 
 
+def _match_corners(rect: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """Reorder the corners of `rect` so that they correspond to the corners
+    of `reference`, so that the rectangles can be interpolated."""
+    candidates = [np.roll(r, k, axis=0) for r in (rect, rect[::-1]) for k in range(4)]
+    return min(candidates, key=lambda c: np.sum(np.linalg.norm(c - reference, axis=1)))
+
+
+class BeamstopTrack:
+    """Position of the beamstop for every frame of a sweep, see
+    `BeamstopTracker`.
+
+    indices: np.ndarray (N,)
+        Frame numbers
+    rects: np.ndarray (N, 4, 2)
+        Corners of the beamstop rectangle for every frame
+    sample_indices: np.ndarray (M,)
+        Frame numbers at which the beamstop was detected
+    """
+
+    def __init__(self, indices: np.ndarray, rects: np.ndarray, sample_indices: np.ndarray):
+        super().__init__()
+        self.indices = np.asarray(indices)
+        self.rects = np.asarray(rects)
+        self.sample_indices = np.asarray(sample_indices)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(frames={len(self.indices)}, samples={len(self.sample_indices)})'
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def rect(self, index: int) -> np.ndarray:
+        """Corners of the beamstop rectangle for frame number `index`"""
+        i = np.searchsorted(self.indices, index)
+        if i == len(self.indices) or self.indices[i] != index:
+            raise KeyError(index)
+        return self.rects[i]
+
+    def blocks(self, tolerance: float = 2.0) -> list:
+        """Split the sweep in blocks of consecutive frames in which the
+        corners of the beamstop move less than `tolerance` pixels.
+
+        Returns a list of (first, last, rect), where `rect` is the minimum
+        bounding rectangle of the beamstop over the block.
+        """
+        blocks = []
+        start = 0
+        for i in range(1, len(self.indices) + 1):
+            if i < len(self.indices):
+                shift = np.linalg.norm(self.rects[i] - self.rects[start], axis=1).max()
+                if shift <= tolerance:
+                    continue
+            if i - start == 1:
+                rect = self.rects[start]
+            else:
+                rect = minimum_bounding_rectangle(self.rects[start:i].reshape(-1, 2))
+            blocks.append((int(self.indices[start]), int(self.indices[i - 1]), rect))
+            start = i
+        return blocks
+
+    def untrusted_areas(self, tolerance: float = 2.0) -> list:
+        """List of ('quadrilateral', rect) covering the beamstop over the
+        whole sweep, one for every block (see `blocks`)"""
+        return [('quadrilateral', rect) for first, last, rect in self.blocks(tolerance)]
+
+
+class BeamstopTracker:
+    """Track the beamstop over a sweep of diffraction patterns.
+
+    The beamstop is detected with `find_beamstop_rect` on the average of a
+    few frames at `n_samples` positions spread over the sweep, and its
+    position is linearly interpolated for the other frames. The radial
+    maps used by the detection are cached (see
+    `instamatic.utils.azimuthal`), so the cost of tracking a sweep is that
+    of a few single-frame detections.
+
+    Usage:
+        track = BeamstopTracker(n_samples=8).track(images, centers=centers)
+        track.rect(index)
+        track.blocks(tolerance=2.0)
+
+    n_samples: int
+        Number of positions in the sweep where the beamstop is detected
+    average: int
+        Number of consecutive frames averaged for every detection
+    **kwargs:
+        Keywords to pass to `find_beamstop_rect`
+    """
+
+    def __init__(self, n_samples: int = 8, average: int = 5, **kwargs):
+        super().__init__()
+        self.n_samples = n_samples
+        self.average = average
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(n_samples={self.n_samples}, average={self.average})'
+
+    def sample_positions(self, n_frames: int) -> np.ndarray:
+        """Positions (0-based) in a sweep of `n_frames` where the beamstop
+        is detected."""
+        n = min(self.n_samples, n_frames)
+        return np.unique(np.linspace(0, n_frames - 1, n).round().astype(int))
+
+    def detect(self, images, position: int, center=None) -> np.ndarray:
+        """Detect the beamstop on the average of `self.average` frames
+        around `position`"""
+        start = max(0, min(position - self.average // 2, len(images) - self.average))
+        stop = min(start + self.average, len(images))
+        img = np.mean([images[i] for i in range(start, stop)], axis=0)
+        if center is not None:
+            center = np.mean(center[start:stop], axis=0)
+        return find_beamstop_rect(img, center=center, **self.kwargs)
+
+    def track(self, images, indices=None, centers=None) -> BeamstopTrack:
+        """Track the beamstop over a sweep.
+
+        images: list of 2D np.ndarray
+            Frames of the sweep, in order
+        indices: list of int
+            Frame numbers, default: 1, 2, 3, ...
+        centers: np.ndarray (N, 2)
+            Beam center of every frame, if not given, it is determined for
+            the averaged frames only
+
+        Returns a `BeamstopTrack`
+        """
+        n_frames = len(images)
+        if indices is None:
+            indices = np.arange(1, n_frames + 1)
+        indices = np.asarray(indices)
+        if centers is not None:
+            centers = np.asarray(centers, dtype=float)
+
+        positions = self.sample_positions(n_frames)
+        rects = [self.detect(images, position, center=centers) for position in positions]
+        rects = np.array([_match_corners(rect, rects[0]) for rect in rects])
+
+        sample_indices = indices[positions]
+        interpolated = np.empty((n_frames, 4, 2))
+        for corner in range(4):
+            for axis in range(2):
+                interpolated[:, corner, axis] = np.interp(indices, sample_indices, rects[:, corner, axis])
+
+        return BeamstopTrack(indices, interpolated, sample_indices)
+
+
 if __name__ == '__main__':
     drc = '.'
     fns = list(Path(drc).glob('raw/*.tif'))
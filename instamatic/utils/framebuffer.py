@@ -0,0 +1,273 @@
+"""Disk-backed acquisition buffer for continuous data collection.
+
+`FrameBuffer` is a drop-in replacement for the list of `(i, img, h)`
+tuples used by the data collection loops. Frames passed to `append` go
+into a bounded in-memory queue, and are written by a background thread
+to preallocated memory-mapped scratch files, so that the memory use does
+not grow with the length of the sweep. At the end of the collection,
+`frames()` returns a lazy mapping of the frames that can be handed to
+`ImgConversion`, frames are only read from disk when they are used.
+
+Layout of the scratch directory:
+    frames_0000.npy, frames_0001.npy, ...
+        `.npy` files holding `segment_size` frames each, a new segment is
+        allocated when the previous one is full
+    index.bin
+        a magic string followed by records, each record is a
+        little-endian uint32 length followed by a pickled tuple
+        `(i, segment, slot, header)`
+
+The headers are kept in a columnar `FrameMetadata` table. The index is
+flushed after every frame, so the frames written before an
+interruption can be recovered with `FrameBuffer(path, mode='r')`.
+
+Usage:
+    buffer = FrameBuffer('scratch')
+    buffer.append((i, img, h))
+    ...
+    buffer.close()
+    img_conv = ImgConversion(buffer=buffer, ...)
+    buffer.delete()
+"""
+import pickle
+import queue
+import struct
+import threading
+from collections.abc import Mapping
+from collections.abc import MutableMapping
+from pathlib import Path
+
+import numpy as np
+
+from instamatic.utils.metadata import FrameMetadata
+
+MAGIC = b'INSTAMATIC-FRAMEBUFFER-1\n'
+_LENGTH = struct.Struct('<I')
+
+
+class LazyFrames(MutableMapping):
+    """Mapping of frame number to image data that reads the frames from a
+    `FrameBuffer` on access.
+
+    `transform` is applied to every frame as it is read (e.g. a flatfield
+    correction). Frames that are set explicitly are kept in memory, and
+    take precedence over the frames in the buffer.
+    """
+
+    def __init__(self, buffer: 'FrameBuffer', transform=None):
+        super().__init__()
+        self.buffer = buffer
+        self.transform = transform
+        self._extra = {}
+        self._hidden = set()
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        if i in self._extra:
+            return self._extra[i]
+        if i in self._hidden:
+            raise KeyError(i)
+        img = np.array(self.buffer[i])
+        if self.transform is not None:
+            img = self.transform(img)
+        return img
+
+    def __setitem__(self, i: int, img: np.ndarray) -> None:
+        self._extra[i] = img
+
+    def __delitem__(self, i: int) -> None:
+        if i in self._extra:
+            del self._extra[i]
+        elif i in self.buffer.indices and i not in self._hidden:
+            self._hidden.add(i)
+        else:
+            raise KeyError(i)
+
+    def __iter__(self):
+        keys = set(self.buffer.indices) - self._hidden
+        return iter(sorted(keys.union(self._extra)))
+
+    def __len__(self) -> int:
+        return sum(1 for i in self)
+
+
+class FrameBuffer:
+    """Acquisition buffer that spills frames to memory-mapped files.
+
+    path: str
+        Scratch directory for the frames and the index
+    window: int
+        Maximum number of frames kept in memory, `append` blocks if the
+        writer falls this far behind
+    segment_size: int
+        Number of frames per scratch file
+    mode: str
+        'w' to start a new buffer, 'r' to open an existing buffer (for
+        example to recover the data after an interruption)
+    """
+
+    def __init__(self, path: str, window: int = 32, segment_size: int = 256, mode: str = 'w'):
+        super().__init__()
+        self.path = Path(path)
+        self.window = window
+        self.segment_size = segment_size
+        self.shape = None
+        self.dtype = None
+
+        self._segments = []
+        self._index = {}
+        self.metadata = FrameMetadata()
+        self._lock = threading.Lock()
+        self._error = None
+
+        if mode == 'r':
+            self._read_index()
+            self._queue = None
+            self._thread = None
+        elif mode == 'w':
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._index_f = open(self.path / 'index.bin', 'wb')
+            self._index_f.write(MAGIC)
+            self._queue = queue.Queue(maxsize=window)
+            self._thread = threading.Thread(target=self._run, name='FrameBuffer', daemon=True)
+            self._thread.start()
+        else:
+            raise ValueError(f'Invalid mode: {mode!r}')
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.path)!r}, frames={len(self)}, shape={self.shape})'
+
+    def _segment_fn(self, segment: int) -> Path:
+        return self.path / f'frames_{segment:04d}.npy'
+
+    def _read_index(self) -> None:
+        with open(self.path / 'index.bin', 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise OSError(f'{self.path} is not a frame buffer')
+            while True:
+                length = f.read(_LENGTH.size)
+                if len(length) < _LENGTH.size:
+                    break
+                data = f.read(_LENGTH.unpack(length)[0])
+                try:
+                    i, segment, slot, h = pickle.loads(data)
+                except Exception:
+                    break  # truncated record
+                self._index[i] = segment, slot
+                self.metadata.append(i, h)
+
+        n_segments = max((segment for segment, slot in self._index.values()), default=-1) + 1
+        self._segments = [np.load(self._segment_fn(segment), mmap_mode='r') for segment in range(n_segments)]
+        if self._segments:
+            self.shape = self._segments[0].shape[1:]
+            self.dtype = self._segments[0].dtype
+
+    def _write(self, i: int, img: np.ndarray, h: dict) -> None:
+        if self.shape is None:
+            self.shape = img.shape
+            self.dtype = img.dtype
+        elif img.shape != self.shape:
+            raise ValueError(f'Frame {i} has shape {img.shape}, expected {self.shape}')
+
+        segment, slot = divmod(len(self._index), self.segment_size)
+        if segment == len(self._segments):
+            if self._segments:
+                self._segments[-1].flush()
+            self._segments.append(np.lib.format.open_memmap(self._segment_fn(segment), mode='w+',
+                                                            dtype=self.dtype, shape=(self.segment_size, *self.shape)))
+        self._segments[segment][slot] = img
+
+        data = pickle.dumps((i, segment, slot, h), protocol=4)
+        self._index_f.write(_LENGTH.pack(len(data)))
+        self._index_f.write(data)
+        self._index_f.flush()
+
+        with self._lock:
+            self._index[i] = segment, slot
+            self.metadata.append(i, h)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue  # keep draining, so that `append` does not block
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def append(self, item: tuple) -> None:
+        """Add frame `(i, img, h)` to the buffer, where `i` is the frame
+        number, `img` the image data, and `h` the header."""
+        if self._error is not None:
+            raise self._error
+        if self._thread is None:
+            raise OSError('Frame buffer is closed')
+        i, img, h = item
+        self._queue.put((i, np.asarray(img), h))
+
+    def close(self) -> None:
+        """Write the remaining frames and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        for segment in self._segments:
+            segment.flush()
+        self._index_f.close()
+        if self._error is not None:
+            raise self._error
+
+    def delete(self) -> None:
+        """Close the buffer and remove the scratch files."""
+        self.close()
+        self._segments = []
+        for fn in self.path.glob('frames_*.npy'):
+            fn.unlink()
+        (self.path / 'index.bin').unlink()
+        try:
+            self.path.rmdir()
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    @property
+    def indices(self) -> list:
+        """Sorted frame numbers of the frames written to disk."""
+        with self._lock:
+            return sorted(self._index)
+
+    @property
+    def headers(self) -> Mapping:
+        """Headers of the frames written to disk, by frame number, as views
+        on `self.metadata`"""
+        return self.metadata.headers
+
+    def __len__(self) -> int:
+        n = len(self._index)
+        if self._thread is not None:
+            n += self._queue.qsize()
+        return n
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """Return frame `i` as a read-only view on the scratch file."""
+        with self._lock:
+            segment, slot = self._index[i]
+        return self._segments[segment][slot]
+
+    def __iter__(self):
+        """Iterate over `(i, img, h)` in order of the frame number."""
+        for i in self.indices:
+            yield i, self[i], self.metadata.headers[i]
+
+    def frames(self, transform=None) -> LazyFrames:
+        """Lazy mapping of frame number to image data, `transform` is
+        applied to every frame when it is read."""
+        return LazyFrames(self, transform=transform)
@@ -0,0 +1,349 @@
+"""Opt-in latency instrumentation for the hardware interfaces.
+
+Enable with `instrumentation: True` in `settings.yaml`. Objects returned by
+`Microscope` and `Camera` are then wrapped in a proxy that records call
+counts, a latency histogram and the number of in-flight calls for every
+public method. The servers record their per-command latency in the same
+way. Statistics are written to the `logs` directory at exit as csv/json,
+together with a Chrome trace-event file (open in `chrome://tracing` or
+https://ui.perfetto.dev).
+
+Usage:
+    from instamatic.utils import instrumentation
+    print(instrumentation.get_recorder().stats_table())
+
+When instrumentation is disabled, `instrument` returns the object as-is
+and `track` returns a shared no-op context manager.
+"""
+import atexit
+import csv
+import datetime
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+import numpy as np
+
+# Logarithmic histogram bins from 1 us to 1000 s, ~6% relative width
+_BIN_EDGES = np.logspace(-6, 3, 361)
+_LOG_MIN = math.log10(_BIN_EDGES[0])
+_LOG_STEP = math.log10(_BIN_EDGES[1]) - _LOG_MIN
+_N_BINS = len(_BIN_EDGES) + 1  # + underflow/overflow
+
+
+class CallStats:
+    """Accumulate latency statistics for a single method."""
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.histogram = np.zeros(_N_BINS, dtype=np.int64)
+
+    def add(self, duration: float, error: bool = False) -> None:
+        self.count += 1
+        self.errors += error
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+        if duration > 0:
+            i = int((math.log10(duration) - _LOG_MIN) // _LOG_STEP) + 1
+            i = min(max(i, 0), _N_BINS - 1)
+        else:
+            i = 0
+        self.histogram[i] += 1
+
+    def percentile(self, q: float) -> float:
+        """Estimate the `q`th percentile (0-100) from the histogram, accurate
+        to about 3%."""
+        if not self.count:
+            return float('nan')
+        cumsum = np.cumsum(self.histogram)
+        i = int(np.searchsorted(cumsum, q / 100 * self.count))
+        if i == 0:
+            value = _BIN_EDGES[0]
+        elif i >= len(_BIN_EDGES):
+            value = _BIN_EDGES[-1]
+        else:
+            value = np.sqrt(_BIN_EDGES[i - 1] * _BIN_EDGES[i])  # geometric bin center
+        return float(min(max(value, self.min), self.max))
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else float('nan')
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'count': self.count,
+            'errors': self.errors,
+            'total_s': self.total,
+            'mean_ms': self.mean * 1000,
+            'min_ms': self.min * 1000 if self.count else float('nan'),
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000,
+            'max_in_flight': self.max_in_flight,
+        }
+
+
+class Recorder:
+    """Thread-safe collection of `CallStats` plus a bounded buffer of trace
+    events.
+
+    max_events : int
+        Maximum number of trace events to keep (oldest are dropped first)
+    """
+
+    def __init__(self, max_events: int = 1_000_000):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.events = deque(maxlen=max_events)
+        self.t0 = time.perf_counter()
+        self.pid = os.getpid()
+        self._live_thread = None
+        self._live_stop = threading.Event()
+
+    def _get(self, name: str) -> CallStats:
+        try:
+            return self.stats[name]
+        except KeyError:
+            return self.stats.setdefault(name, CallStats(name))
+
+    def begin(self, name: str) -> float:
+        """Mark the start of call `name`, returns the start time."""
+        with self.lock:
+            stats = self._get(name)
+            stats.in_flight += 1
+            stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        return time.perf_counter()
+
+    def end(self, name: str, t_start: float, error: bool = False) -> None:
+        """Mark the end of call `name` that started at `t_start`"""
+        t_end = time.perf_counter()
+        duration = t_end - t_start
+        with self.lock:
+            stats = self.stats[name]
+            stats.in_flight -= 1
+            stats.add(duration, error=error)
+            self.events.append((name, t_start, duration, threading.get_ident()))
+
+    @contextmanager
+    def track(self, name: str):
+        """Context manager that records the time spent in the block under
+        `name`"""
+        t_start = self.begin(name)
+        try:
+            yield
+        except BaseException:
+            self.end(name, t_start, error=True)
+            raise
+        else:
+            self.end(name, t_start)
+
+    def wrap(self, func, name: str):
+        """Return `func` wrapped so that every call is recorded as `name`"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            t_start = self.begin(name)
+            try:
+                ret = func(*args, **kwargs)
+            except BaseException:
+                self.end(name, t_start, error=True)
+                raise
+            self.end(name, t_start)
+            return ret
+
+        return wrapper
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stats.clear()
+            self.events.clear()
+            self.t0 = time.perf_counter()
+
+    def summary(self) -> list:
+        """Return list of dicts with the statistics of each method, sorted by
+        total time spent."""
+        with self.lock:
+            rows = [stats.to_dict() for stats in self.stats.values()]
+        return sorted(rows, key=lambda row: row['total_s'], reverse=True)
+
+    def stats_table(self) -> str:
+        """Format the statistics as a table."""
+        header = f"{'name':40s} {'count':>8s} {'err':>5s} {'total(s)':>9s} {'mean':>9s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'max':>9s} {'conc':>5s}"
+        lines = [header, '-' * len(header)]
+        for row in self.summary():
+            lines.append(f"{row['name'][:40]:40s} {row['count']:8d} {row['errors']:5d} {row['total_s']:9.3f} "
+                         f"{row['mean_ms']:9.3f} {row['p50_ms']:9.3f} {row['p95_ms']:9.3f} {row['p99_ms']:9.3f} "
+                         f"{row['max_ms']:9.3f} {row['max_in_flight']:5d}")
+        lines.append('(times in ms, conc = max calls in flight)')
+        return '\n'.join(lines)
+
+    def start_live(self, interval: float = 5.0, func=print) -> None:
+        """Print the stats table every `interval` seconds from a background
+        thread."""
+        if self._live_thread:
+            return
+
+        def loop():
+            while not self._live_stop.wait(interval):
+                func(self.stats_table())
+
+        self._live_stop.clear()
+        self._live_thread = threading.Thread(target=loop, daemon=True)
+        self._live_thread.start()
+
+    def stop_live(self) -> None:
+        if self._live_thread:
+            self._live_stop.set()
+            self._live_thread.join()
+            self._live_thread = None
+
+    def write_csv(self, fn: str) -> None:
+        rows = self.summary()
+        with open(fn, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(CallStats('').to_dict().keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def write_json(self, fn: str) -> None:
+        with open(fn, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_trace(self, fn: str) -> None:
+        """Write Chrome trace-event file (complete events, times in us)"""
+        with self.lock:
+            events = list(self.events)
+        trace = [{
+            'name': name,
+            'cat': name.split('.', 1)[0],
+            'ph': 'X',
+            'ts': (t_start - self.t0) * 1e6,
+            'dur': duration * 1e6,
+            'pid': self.pid,
+            'tid': tid,
+        } for name, t_start, duration, tid in events]
+        with open(fn, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def dump(self, drc: str = None, prefix: str = 'instamatic_calls') -> Path:
+        """Write csv/json statistics and the trace file to `drc` (default:
+        the instamatic logs directory)."""
+        if drc is None:
+            from instamatic import config
+            drc = config.locations['logs']
+        drc = Path(drc)
+        now = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        stem = drc / f'{prefix}_{now}_{self.pid}'
+        self.write_csv(stem.with_suffix('.csv'))
+        self.write_json(stem.with_suffix('.json'))
+        self.write_trace(stem.with_name(stem.name + '_trace.json'))
+        return stem
+
+
+class InstrumentedProxy:
+    """Wraps an object and records every call to its public methods under
+    `{name}.{method}`.
+
+    Attribute access and assignment are forwarded to the wrapped object.
+    """
+
+    def __init__(self, obj, name: str, recorder: Recorder):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_recorder', recorder)
+        object.__setattr__(self, '_wrapped', {})
+
+    def __getattr__(self, attr_name):
+        obj = self._obj
+        attr = getattr(obj, attr_name)
+        if attr_name.startswith('_') or not callable(attr):
+            return attr
+
+        try:
+            wrapped, orig = self._wrapped[attr_name]
+            if orig == attr:
+                return wrapped
+        except KeyError:
+            pass
+
+        wrapped = self._recorder.wrap(attr, f'{self._name}.{attr_name}')
+        self._wrapped[attr_name] = (wrapped, attr)
+        return wrapped
+
+    def __setattr__(self, attr_name, value):
+        setattr(self._obj, attr_name, value)
+
+    def __dir__(self):
+        return dir(self._obj)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self._obj!r})'
+
+
+class _NullContext:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_null_context = _NullContext()
+_recorder = None
+
+
+def get_recorder() -> Recorder:
+    """Return the global recorder, creating it on first use.
+
+    The statistics are written to the logs directory at exit.
+    """
+    global _recorder
+    if _recorder is None:
+        _recorder = Recorder()
+        atexit.register(_dump_at_exit)
+    return _recorder
+
+
+def _dump_at_exit():
+    if _recorder and _recorder.stats:
+        stem = _recorder.dump()
+        print(f'Instrumentation data written to {stem}.*')
+
+
+def is_enabled() -> bool:
+    from instamatic import config
+    return bool(config.settings.instrumentation)
+
+
+def instrument(obj, name: str = None):
+    """Return `obj` wrapped in an `InstrumentedProxy` if instrumentation is
+    enabled, else return `obj` unchanged."""
+    if not is_enabled():
+        return obj
+    if name is None:
+        name = obj.__class__.__name__
+    return InstrumentedProxy(obj, name=name, recorder=get_recorder())
+
+
+def track(name: str):
+    """Context manager recording the time spent in the block under `name`
+    (no-op if instrumentation is disabled)."""
+    if not is_enabled():
+        return _null_context
+    return get_recorder().track(name)
@@ -0,0 +1,276 @@
+"""Columnar store for per-frame metadata.
+
+`FrameMetadata` keeps the headers of a series of frames as typed NumPy
+columns (one column per header key) instead of a `dict` per frame.
+Appending a frame is amortized O(1): the columns are preallocated and
+grow geometrically. Columns can be queried as a whole (`meta['key']`),
+and the whole table is written to a single `.npz` file per dataset.
+
+The column type is inferred from the first value: booleans, integers,
+and floats get a numeric column, fixed-length tuples/lists of numbers a
+2D numeric column, strings and anything else an object column. Integer
+columns are promoted to float, and numeric columns to object, if a later
+value does not fit.
+
+For code that works with per-frame headers, `meta.headers` is a mapping
+of frame number to a dict-like view on a single row. Values are returned
+as Python types, so the views can be serialized like the original
+headers.
+
+Usage:
+    meta = FrameMetadata()
+    meta.append(i, h)
+    ...
+    meta['ImageGetTime']              # 1D array over all frames
+    meta.headers[i]['beam_center']    # per-frame access
+    meta.save('frame_metadata.npz')
+"""
+from collections.abc import Mapping
+from collections.abc import MutableMapping
+from pathlib import Path
+
+import numpy as np
+
+VERSION = 1
+
+
+def _infer(value) -> tuple:
+    """Return the kind, dtype, and shape of the column for `value`."""
+    if isinstance(value, (bool, np.bool_)):
+        return 'scalar', bool, ()
+    if isinstance(value, (int, np.integer)):
+        return 'scalar', np.int64, ()
+    if isinstance(value, (float, np.floating)):
+        return 'scalar', float, ()
+    if isinstance(value, (tuple, list, np.ndarray)):
+        arr = np.asarray(value)
+        if arr.ndim == 1 and arr.dtype.kind in 'biuf':
+            kind = 'list' if isinstance(value, list) else 'tuple'
+            return kind, (np.int64 if arr.dtype.kind in 'biu' else float), arr.shape
+    return 'object', object, ()
+
+
+class _Column:
+    __slots__ = ('kind', 'data', 'present')
+
+    def __init__(self, kind: str, dtype, shape: tuple, capacity: int):
+        self.kind = kind
+        self.data = self._allocate(capacity, dtype, shape)
+        self.present = np.zeros(capacity, dtype=bool)
+
+    @staticmethod
+    def _allocate(capacity: int, dtype, shape: tuple = ()) -> np.ndarray:
+        # object columns are filled with None
+        if np.dtype(dtype) == object:
+            return np.empty(capacity, dtype=object)
+        return np.zeros((capacity, *shape), dtype=dtype)
+
+    def resize(self, capacity: int) -> None:
+        data = self._allocate(capacity, self.data.dtype, self.data.shape[1:])
+        data[:len(self.data)] = self.data
+        present = np.zeros(capacity, dtype=bool)
+        present[:len(self.present)] = self.present
+        self.data, self.present = data, present
+
+    def to_object(self) -> None:
+        data = self._allocate(len(self.data), object)
+        for row, value in enumerate(self.data):
+            data[row] = self._to_python(value)
+        self.data = data
+        self.kind = 'object'
+
+    def _to_python(self, value):
+        if self.kind == 'object':
+            return value
+        value = value.tolist()
+        return tuple(value) if self.kind == 'tuple' else value
+
+    def get(self, row: int):
+        return self._to_python(self.data[row])
+
+    def set(self, row: int, value) -> None:
+        if self.kind != 'object':
+            kind, dtype, shape = _infer(value)
+            if kind == 'object' or shape != self.data.shape[1:]:
+                self.to_object()
+            elif self.data.dtype == np.int64 and dtype is float:
+                self.data = self.data.astype(float)
+            elif self.data.dtype == bool and dtype is not bool:
+                self.data = self.data.astype(dtype)
+        self.data[row] = value
+        self.present[row] = True
+
+
+class FrameHeader(MutableMapping):
+    """Dict-like view on the metadata of a single frame."""
+
+    def __init__(self, meta: 'FrameMetadata', row: int):
+        super().__init__()
+        self._meta = meta
+        self._row = row
+
+    def __getitem__(self, key: str):
+        column = self._meta._columns.get(key)
+        if column is None or not column.present[self._row]:
+            raise KeyError(key)
+        return column.get(self._row)
+
+    def __setitem__(self, key: str, value) -> None:
+        self._meta._set(self._row, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        column = self._meta._columns.get(key)
+        if column is None or not column.present[self._row]:
+            raise KeyError(key)
+        column.present[self._row] = False
+
+    def __iter__(self):
+        return (key for key, column in self._meta._columns.items() if column.present[self._row])
+
+    def __len__(self) -> int:
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self) -> dict:
+        return dict(self)
+
+
+class _Headers(Mapping):
+    """Mapping of frame number to `FrameHeader`."""
+
+    def __init__(self, meta: 'FrameMetadata'):
+        super().__init__()
+        self._meta = meta
+
+    def __getitem__(self, i: int) -> FrameHeader:
+        return FrameHeader(self._meta, self._meta._rows[i])
+
+    def __iter__(self):
+        return iter(self._meta._rows)
+
+    def __len__(self) -> int:
+        return len(self._meta)
+
+
+class FrameMetadata:
+    """Columnar table of per-frame metadata.
+
+    capacity: int
+        Initial number of rows to allocate
+    """
+
+    def __init__(self, capacity: int = 256):
+        super().__init__()
+        self._capacity = capacity
+        self._n = 0
+        self._frames = np.zeros(capacity, dtype=np.int64)
+        self._rows = {}
+        self._columns = {}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(frames={len(self)}, columns={len(self._columns)})'
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._columns
+
+    @classmethod
+    def from_headers(cls, headers: dict):
+        """Create a table from a dict of frame number to header."""
+        meta = cls(capacity=max(len(headers), 1))
+        for i, h in headers.items():
+            meta.append(i, h)
+        return meta
+
+    def _set(self, row: int, key: str, value) -> None:
+        column = self._columns.get(key)
+        if column is None:
+            column = self._columns[key] = _Column(*_infer(value), capacity=self._capacity)
+        column.set(row, value)
+
+    def append(self, i: int, h: dict) -> None:
+        """Add the header `h` of frame `i`."""
+        if i in self._rows:
+            raise ValueError(f'Frame {i} is already in the table')
+        if self._n == self._capacity:
+            self._capacity *= 2
+            self._frames = np.resize(self._frames, self._capacity)
+            for column in self._columns.values():
+                column.resize(self._capacity)
+        row = self._n
+        self._frames[row] = i
+        self._rows[i] = row
+        self._n += 1
+        for key, value in h.items():
+            self._set(row, key, value)
+
+    @property
+    def frames(self) -> np.ndarray:
+        """Frame numbers, in order of insertion."""
+        return self._frames[:self._n]
+
+    @property
+    def columns(self) -> list:
+        return list(self._columns)
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        """Return column `key` for all frames, frames without a value are
+        0 (numeric columns) or None (object columns)."""
+        return self._columns[key].data[:self._n]
+
+    def __setitem__(self, key: str, values) -> None:
+        """Set column `key` for all frames."""
+        values = np.asarray(values)
+        if len(values) != self._n:
+            raise ValueError(f'Expected {self._n} values for column `{key}`, got {len(values)}')
+        if values.dtype.kind in 'biuf' and values.ndim <= 2:
+            kind = 'tuple' if values.ndim == 2 else 'scalar'
+            column = _Column(kind, values.dtype, values.shape[1:], self._capacity)
+        else:
+            column = _Column('object', object, (), self._capacity)
+            values = list(values)
+        column.data[:self._n] = values
+        column.present[:self._n] = True
+        self._columns[key] = column
+
+    def present(self, key: str) -> np.ndarray:
+        """Boolean array, True for the frames that have a value for `key`"""
+        return self._columns[key].present[:self._n]
+
+    @property
+    def headers(self) -> _Headers:
+        """Mapping of frame number to a dict-like view on its header."""
+        return _Headers(self)
+
+    def save(self, fn: str) -> None:
+        """Write the table to a single `.npz` file."""
+        arrays = {'__version__': np.array(VERSION), '__frames__': self.frames}
+        for n, (key, column) in enumerate(self._columns.items()):
+            arrays[f'{n}/data'] = column.data[:self._n]
+            arrays[f'{n}/present'] = column.present[:self._n]
+            arrays[f'{n}/meta'] = np.array([key, column.kind])
+        np.savez_compressed(fn, **arrays)
+
+    @classmethod
+    def load(cls, fn: str):
+        """Read a table written by `save`."""
+        with np.load(Path(fn), allow_pickle=True) as f:
+            frames = f['__frames__']
+            meta = cls(capacity=max(len(frames), 1))
+            meta._n = len(frames)
+            meta._frames[:meta._n] = frames
+            meta._rows = {int(i): row for row, i in enumerate(frames)}
+            n = 0
+            while f'{n}/meta' in f:
+                key, kind = f[f'{n}/meta']
+                data = f[f'{n}/data']
+                column = _Column(str(kind), data.dtype, data.shape[1:], meta._capacity)
+                column.data[:meta._n] = data
+                column.present[:meta._n] = f[f'{n}/present']
+                meta._columns[str(key)] = column
+                n += 1
+        return meta
@@ -0,0 +1,56 @@
+"""Process pool that is kept alive between calls.
+
+`ProcessPoolMixin` is used by the image analysis engines
+(`CrystalFinder`, `HoleFinder`) to distribute images over worker
+processes. The pool is created on first use, and reused until `close` is
+called or the `with` block ends.
+
+Usage:
+    class Finder(ProcessPoolMixin):
+        def find_batch(self, images, processes=None):
+            return self._map(_worker, [(img, self.params) for img in images], processes)
+
+    with Finder() as finder:
+        finder.find_batch(images, processes=4)
+"""
+import os
+
+
+class ProcessPoolMixin:
+    """Adds a persistent process pool to a class."""
+
+    _pool = None
+    _processes = None
+
+    def _get_pool(self, processes: int):
+        from concurrent.futures import ProcessPoolExecutor
+        if self._pool is None or self._processes != processes:
+            self.close()
+            self._pool = ProcessPoolExecutor(max_workers=processes)
+            self._processes = processes
+        return self._pool
+
+    def _map(self, func, tasks: list, processes: int = None) -> list:
+        """Apply `func` to every task on `processes` worker processes
+        (defaults to the number of CPUs). With a single process or task,
+        the tasks are run in this process."""
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        if min(processes, len(tasks)) <= 1:
+            return [func(task) for task in tasks]
+
+        pool = self._get_pool(processes)
+        return list(pool.map(func, tasks))
+
+    def close(self) -> None:
+        """Shut down the process pool."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,376 @@
+"""Record and replay microscope/camera sessions.
+
+Enable with `session_record: True` in `settings.yaml`. Objects returned by
+`Microscope` and `Camera` are then wrapped in a proxy that logs every
+call (arguments, return value, start time and duration) to a compact
+binary log in the `logs` directory. Image data are stored in an HDF5
+sidecar file next to the log. The tem/cam servers create their backend
+through the same functions, so every command handled by
+`TemServer.evaluate`/`CamServer.evaluate` is recorded as well, including
+attribute reads on the camera.
+
+The log can be played back with the `replay` microscope/camera interface
+(see `ReplayMicroscope` and `CameraReplay`), set `session_replay` to the
+path of the log.
+
+Log format: a magic string followed by records, each record is a
+little-endian uint32 length followed by a pickled tuple:
+    (target, name, args, kwargs, t_start, duration, status, ret)
+where `status` is 200 for a normal return or 500 if an exception was
+raised (`ret` is then `(exception_name, args)`). Arrays are replaced by a
+`FrameRef` pointing to the dataset in the HDF5 file. Values that cannot be
+pickled (locks, COM handles, sockets) are replaced by an `Unpicklable`
+holding their `repr`.
+"""
+import atexit
+import datetime
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import defaultdict
+from collections import deque
+from functools import wraps
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'INSTAMATIC-SESSION-1\n'
+_LENGTH = struct.Struct('<I')
+
+
+class FrameRef:
+    """Reference to a frame stored in the HDF5 sidecar."""
+
+    __slots__ = ('index',)
+
+    def __init__(self, index: int):
+        self.index = index
+
+    def __getstate__(self):
+        return self.index
+
+    def __setstate__(self, state):
+        self.index = state
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.index})'
+
+
+class Unpicklable:
+    """Placeholder for a recorded value that could not be pickled."""
+
+    __slots__ = ('repr',)
+
+    def __init__(self, repr: str):
+        self.repr = repr
+
+    def __getstate__(self):
+        return self.repr
+
+    def __setstate__(self, state):
+        self.repr = state
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.repr})'
+
+
+def _picklable(obj):
+    """Return `obj`, or an `Unpicklable` placeholder if it cannot be
+    pickled."""
+    try:
+        pickle.dumps(obj, protocol=4)
+    except Exception as e:
+        logger.warning(f'Cannot record {type(obj).__name__} ({e}), storing its repr instead')
+        return Unpicklable(repr(obj))
+    return obj
+
+
+class SessionWriter:
+    """Write calls to a binary session log, with frames stored in
+    `{fn}.h5`.
+
+    fn : str
+        Path to the log file
+    min_frame_ndim : int
+        Arrays with at least this many dimensions are stored in the HDF5
+        sidecar, smaller arrays are pickled directly into the log.
+    """
+
+    def __init__(self, fn: str, min_frame_ndim: int = 2):
+        super().__init__()
+        self.fn = Path(fn)
+        self.h5_fn = self.fn.with_suffix('.h5')
+        self.min_frame_ndim = min_frame_ndim
+
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.n_records = 0
+        self.n_frames = 0
+
+        self._f = open(self.fn, 'wb')
+        self._f.write(MAGIC)
+        self._h5 = None
+
+    def _store_frame(self, arr: np.ndarray) -> FrameRef:
+        if self._h5 is None:
+            import h5py
+            self._h5 = h5py.File(self.h5_fn, 'w')
+        ref = FrameRef(self.n_frames)
+        self._h5.create_dataset(f'frames/{ref.index}', data=arr)
+        self.n_frames += 1
+        return ref
+
+    def _pack(self, obj):
+        if isinstance(obj, np.ndarray) and obj.ndim >= self.min_frame_ndim:
+            return self._store_frame(obj)
+        elif isinstance(obj, (tuple, list)):
+            return type(obj)(self._pack(item) for item in obj)
+        return obj
+
+    def write(self, target: str, name: str, args: tuple, kwargs: dict,
+              t_start: float, duration: float, status: int, ret) -> None:
+        """Append a single call to the log, `t_start` is a
+        `time.perf_counter` timestamp."""
+        with self.lock:
+            if self._f.closed:
+                return
+            args, ret = self._pack(args), self._pack(ret)
+            record = (target, name, args, kwargs, t_start - self.t0, duration, status, ret)
+            try:
+                data = pickle.dumps(record, protocol=4)
+            except Exception:
+                # recording must never break the proxied call
+                args, kwargs, ret = _picklable(args), _picklable(kwargs), _picklable(ret)
+                record = (target, name, args, kwargs, t_start - self.t0, duration, status, ret)
+                data = pickle.dumps(record, protocol=4)
+            self._f.write(_LENGTH.pack(len(data)))
+            self._f.write(data)
+            self.n_records += 1
+
+    def flush(self) -> None:
+        with self.lock:
+            self._f.flush()
+            if self._h5 is not None:
+                self._h5.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            if not self._f.closed:
+                self._f.close()
+            if self._h5 is not None:
+                self._h5.close()
+                self._h5 = None
+
+
+def read_session(fn: str) -> list:
+    """Read all records from session log `fn`
+
+    Returns a list of tuples `(target, name, args, kwargs, t_start,
+    duration, status, ret)`. Frames are returned as `FrameRef`, use
+    `load_frames` or `SessionReplay` to resolve them.
+    """
+    records = []
+    with open(fn, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise OSError(f'Not an instamatic session log: `{fn}`')
+        while True:
+            head = f.read(_LENGTH.size)
+            if len(head) < _LENGTH.size:
+                break
+            n, = _LENGTH.unpack(head)
+            data = f.read(n)
+            if len(data) < n:
+                break  # truncated (interrupted session)
+            records.append(pickle.loads(data))
+    return records
+
+
+def load_frames(fn: str) -> dict:
+    """Load all frames from the HDF5 sidecar of session log `fn` into a
+    dict `{index: array}`, `SessionReplay` reads them on demand instead."""
+    h5_fn = Path(fn).with_suffix('.h5')
+    if not h5_fn.exists():
+        return {}
+    import h5py
+    with h5py.File(h5_fn, 'r') as f:
+        return {int(key): dataset[:] for key, dataset in f['frames'].items()}
+
+
+class RecordingProxy:
+    """Wraps an object and logs all public method calls and attribute reads
+    to `writer` under `target`"""
+
+    def __init__(self, obj, target: str, writer: SessionWriter):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_writer', writer)
+
+    def __getattr__(self, attr_name):
+        obj = self._obj
+        writer = self._writer
+        target = self._target
+
+        t_start = time.perf_counter()
+        attr = getattr(obj, attr_name)
+
+        if attr_name.startswith('_'):
+            return attr
+
+        if not callable(attr):
+            writer.write(target, attr_name, None, None, t_start, 0.0, 200, attr)
+            return attr
+
+        @wraps(attr)
+        def wrapper(*args, **kwargs):
+            t_start = time.perf_counter()
+            try:
+                ret = attr(*args, **kwargs)
+            except Exception as e:
+                writer.write(target, attr_name, args, kwargs, t_start,
+                             time.perf_counter() - t_start, 500, (e.__class__.__name__, e.args))
+                raise
+            writer.write(target, attr_name, args, kwargs, t_start,
+                         time.perf_counter() - t_start, 200, ret)
+            return ret
+
+        return wrapper
+
+    def __setattr__(self, attr_name, value):
+        setattr(self._obj, attr_name, value)
+
+    def __dir__(self):
+        return dir(self._obj)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self._obj!r})'
+
+
+_writer = None
+
+
+def get_writer() -> SessionWriter:
+    """Return the session writer for this process, creating a new log in the
+    logs directory on first use."""
+    global _writer
+    if _writer is None:
+        from instamatic import config
+        now = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        fn = config.locations['logs'] / f'instamatic_session_{now}_{os.getpid()}.bin'
+        _writer = SessionWriter(fn)
+        atexit.register(_writer.close)
+        print(f'Recording session to {fn}')
+    return _writer
+
+
+def record(obj, target: str):
+    """Return `obj` wrapped in a `RecordingProxy` if `session_record` is
+    enabled, else return `obj` unchanged.
+
+    target : str
+        Label for the recorded calls, i.e. `tem` or `cam`
+    """
+    from instamatic import config
+    if not config.settings.session_record:
+        return obj
+    return RecordingProxy(obj, target=target, writer=get_writer())
+
+
+class SessionReplay:
+    """Play back the calls for `target` from session log `fn`
+
+    Every call to `name` returns the next recorded value for `name`. Once
+    the recorded calls run out, the last value is repeated, so that
+    experiment code that polls more often than the original session still
+    gets sensible values. Recorded exceptions are re-raised.
+
+    realtime : bool
+        If True, each call sleeps for its recorded duration, otherwise the
+        session is played back as fast as possible.
+
+    The frames are read from the HDF5 sidecar when they are replayed, the
+    file is kept open until `close` is called.
+    """
+
+    def __init__(self, fn: str, target: str, realtime: bool = False):
+        super().__init__()
+        self.fn = fn
+        self.target = target
+        self.realtime = realtime
+
+        self.lock = threading.Lock()
+        self.queues = defaultdict(deque)
+        self.last = {}
+
+        for record in read_session(fn):
+            if record[0] == target:
+                self.queues[record[1]].append(record)
+
+        self.h5_fn = Path(fn).with_suffix('.h5')
+        self._h5 = None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.queues or name in self.last
+
+    def get_frame(self, index: int) -> np.ndarray:
+        """Read frame `index` from the HDF5 sidecar."""
+        with self.lock:
+            if self._h5 is None:
+                import h5py
+                self._h5 = h5py.File(self.h5_fn, 'r')
+            return self._h5[f'frames/{index}'][:]
+
+    def close(self) -> None:
+        with self.lock:
+            if self._h5 is not None:
+                self._h5.close()
+                self._h5 = None
+
+    def _unpack(self, obj):
+        if isinstance(obj, FrameRef):
+            return self.get_frame(obj.index)
+        elif isinstance(obj, (tuple, list)):
+            return type(obj)(self._unpack(item) for item in obj)
+        return obj
+
+    def next(self, name: str):
+        """Return the next recorded record for `name`"""
+        with self.lock:
+            queue = self.queues.get(name)
+            if queue:
+                record = queue.popleft()
+                self.last[name] = record
+            elif name in self.last:
+                record = self.last[name]
+            else:
+                raise AttributeError(f'`{name}` was not recorded in session `{self.fn}`')
+        return record
+
+    def call(self, name: str):
+        """Replay the next call to `name` and return the recorded value."""
+        target, name, args, kwargs, t_start, duration, status, ret = self.next(name)
+
+        if self.realtime:
+            time.sleep(duration)
+
+        if status == 500:
+            from instamatic.exceptions import exception_list
+            error_code, error_args = ret
+            raise exception_list.get(error_code, RuntimeError)(*error_args)
+
+        return self._unpack(ret)
+
+    def is_attribute(self, name: str) -> bool:
+        """Check if `name` was recorded as an attribute read (i.e. not
+        called)."""
+        record = self.queues[name][0] if self.queues.get(name) else self.last[name]
+        return record[2] is None
+
+    def remaining(self) -> dict:
+        """Number of remaining recorded calls by name."""
+        return {name: len(queue) for name, queue in self.queues.items() if queue}
@@ -0,0 +1,214 @@
+"""Route planning for acquisitions at many stage positions.
+
+`plan_route` reorders a list of stage positions to minimize the total
+estimated stage time, starting from the current stage position. The
+route is built with the nearest-neighbour heuristic, and improved with
+2-opt (segment reversal) and Or-opt (moving segments of 1-3 items) until
+no move improves it further.
+
+The cost of a move is given by `StageCostModel`. The axes move at the
+same time, so the time of an x/y move is set by the slowest axis, z is
+moved separately (as in `AcquireAtItems.move_to_item`). With backlash
+correction, a target is always approached from the negative x/y
+direction. A move that goes in the positive x and y direction already
+does this, so it is done directly; any other move first overshoots to
+`(x - step, y - step)`. The cost matrix is therefore asymmetric, and the
+route favours runs of positive moves.
+
+Usage:
+    model = StageCostModel(speed=(50_000, 50_000, 10_000))
+    route = plan_route(coords, model=model, start=ctrl.stage.get()[:3])
+    print(route)  # estimated vs original time
+    items = [items[i] for i in route.order]
+"""
+from collections import namedtuple
+
+import numpy as np
+
+
+class Route(namedtuple('Route', ['order', 'time', 'original_time'])):
+    """Optimized visiting order of the positions (indices), and the
+    estimated stage time (seconds) of the optimized and the original
+    route."""
+
+    def __str__(self):
+        saved = self.original_time - self.time
+        return (f'Estimated stage time: {self.time:.0f} s, in file order: {self.original_time:.0f} s '
+                f'({saved:.0f} s saved for {len(self.order)} items)')
+
+
+class StageCostModel:
+    """Estimate the time needed to move the stage.
+
+    speed: tuple
+        Speed of the x, y, and z axes in nm/s
+    overhead: float
+        Fixed time in seconds per stage command (communication, settling)
+    backlash: bool
+        Approach every target from the negative x/y direction
+    step: float
+        Overshoot in nm for the backlash correction (see
+        `Stage.set_xy_with_backlash_correction`)
+    settle_delay: float
+        Delay in seconds after each of the two backlash correction moves
+    """
+
+    def __init__(self,
+                 speed: tuple = (50_000, 50_000, 10_000),
+                 overhead: float = 0.5,
+                 backlash: bool = True,
+                 step: float = 10_000,
+                 settle_delay: float = 0.2,
+                 ):
+        super().__init__()
+        self.speed = np.array(speed, dtype=float)
+        self.overhead = overhead
+        self.backlash = backlash
+        self.step = step
+        self.settle_delay = settle_delay
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(speed={tuple(self.speed)}, overhead={self.overhead}, backlash={self.backlash})'
+
+    def _travel(self, dx: np.ndarray, dy: np.ndarray) -> np.ndarray:
+        return np.maximum(np.abs(dx) / self.speed[0], np.abs(dy) / self.speed[1]) + self.overhead
+
+    def cost_matrix(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        """Time (s) to move from every position in `src` to every position
+        in `dst`, both arrays of (x, y) or (x, y, z) in nm.
+
+        Returns an array with shape (len(src), len(dst)).
+        """
+        src = np.atleast_2d(np.asarray(src, dtype=float))
+        dst = np.atleast_2d(np.asarray(dst, dtype=float))
+        dx = dst[None, :, 0] - src[:, None, 0]
+        dy = dst[None, :, 1] - src[:, None, 1]
+
+        if self.backlash:
+            direct = (dx >= 0) & (dy >= 0)
+            corrected = (self._travel(dx - self.step, dy - self.step)
+                         + self._travel(self.step, self.step)
+                         + 2 * self.settle_delay)
+            cost = np.where(direct, self._travel(dx, dy), corrected)
+        else:
+            cost = self._travel(dx, dy)
+
+        if src.shape[1] > 2 and dst.shape[1] > 2:
+            dz = np.abs(dst[None, :, 2] - src[:, None, 2])
+            cost += np.where(dz > 0, dz / self.speed[2] + self.overhead, 0)
+
+        return cost
+
+    def route_time(self, positions: np.ndarray, order=None, start: np.ndarray = None) -> float:
+        """Total time (s) to visit `positions` in `order`, starting from
+        `start` if given."""
+        positions = np.asarray(positions, dtype=float)
+        if order is not None:
+            positions = positions[np.asarray(order)]
+        if start is not None:
+            positions = np.vstack((np.asarray(start, dtype=float)[:positions.shape[1]], positions))
+        if len(positions) < 2:
+            return 0.0
+        return float(sum(self.cost_matrix(a, b)[0, 0] for a, b in zip(positions[:-1], positions[1:])))
+
+
+def _nearest_neighbour(cost: np.ndarray) -> list:
+    """Greedy path from node 0 through all nodes, ending at the last node."""
+    n = len(cost)
+    visited = np.zeros(n, dtype=bool)
+    visited[[0, n - 1]] = True
+    path = [0]
+    for _ in range(n - 2):
+        row = np.where(visited, np.inf, cost[path[-1]])
+        nxt = int(np.argmin(row))
+        visited[nxt] = True
+        path.append(nxt)
+    path.append(n - 1)
+    return path
+
+
+def _two_opt(path: np.ndarray, cost: np.ndarray) -> bool:
+    """Improve `path` in place by segment reversals, the first and last
+    node stay in place. Returns True if the path was changed."""
+    m = len(path)
+    changed = False
+    for i in range(1, m - 2):
+        fwd = np.concatenate(([0], np.cumsum(cost[path[:-1], path[1:]])))
+        bwd = np.concatenate(([0], np.cumsum(cost[path[1:], path[:-1]])))
+        j = np.arange(i + 1, m - 1)
+        # the segment i..j is traversed in the opposite direction
+        delta = (cost[path[i - 1], path[j]] + cost[path[i], path[j + 1]]
+                 - cost[path[i - 1], path[i]] - cost[path[j], path[j + 1]]
+                 + (bwd[j] - bwd[i]) - (fwd[j] - fwd[i]))
+        k = int(np.argmin(delta))
+        if delta[k] < -1e-9:
+            j = j[k]
+            path[i:j + 1] = path[i:j + 1][::-1]
+            changed = True
+    return changed
+
+
+def _or_opt(path: np.ndarray, cost: np.ndarray, max_length: int = 3) -> bool:
+    """Improve `path` in place by moving segments of up to `max_length`
+    nodes to another position. Returns True if the path was changed."""
+    m = len(path)
+    changed = False
+    for length in range(1, max_length + 1):
+        for i in range(1, m - length):
+            e = i + length - 1
+            prev, nxt = path[i - 1], path[e + 1]
+            gain = cost[prev, path[i]] + cost[path[e], nxt] - cost[prev, nxt]
+            # insert between path[k] and path[k + 1], outside of the segment
+            k = np.concatenate((np.arange(0, i - 1), np.arange(e + 1, m - 1)))
+            if not len(k):
+                continue
+            delta = cost[path[k], path[i]] + cost[path[e], path[k + 1]] - cost[path[k], path[k + 1]] - gain
+            n = int(np.argmin(delta))
+            if delta[n] < -1e-9:
+                k = k[n]
+                segment = path[i:e + 1].copy()
+                rest = np.concatenate((path[:i], path[e + 1:]))
+                pos = k + 1 if k < i else k + 1 - length
+                path[:] = np.concatenate((rest[:pos], segment, rest[pos:]))
+                changed = True
+    return changed
+
+
+def plan_route(positions, model: StageCostModel = None, start=None, max_iter: int = 1000) -> Route:
+    """Find a short route through all `positions`
+
+    positions: array_like
+        Stage positions as (x, y) or (x, y, z) in nm
+    model: StageCostModel
+        The cost model, uses the default model if None
+    start: array_like
+        Current stage position, the route starts here if given
+    max_iter: int
+        Maximum number of 2-opt/Or-opt passes
+
+    Returns a `Route` with the visiting order and the estimated times.
+    """
+    if model is None:
+        model = StageCostModel()
+    positions = np.asarray(positions, dtype=float)
+    n = len(positions)
+
+    original_time = model.route_time(positions, start=start)
+    if n < 3:
+        return Route(np.arange(n), original_time, original_time)
+
+    # node 0 is the start, node n + 1 a free end that can be reached from
+    # every position at no cost, both stay in place, so that only the
+    # order of the positions 1..n is optimized
+    cost = np.zeros((n + 2, n + 2))
+    cost[1:n + 1, 1:n + 1] = model.cost_matrix(positions, positions)
+    if start is not None:
+        cost[0, 1:n + 1] = model.cost_matrix(np.asarray(start, dtype=float)[:positions.shape[1]], positions)[0]
+
+    path = np.array(_nearest_neighbour(cost))
+    for _ in range(max_iter):
+        if not (_two_opt(path, cost) or _or_opt(path, cost)):
+            break
+
+    order = path[1:-1] - 1
+    return Route(order, model.route_time(positions, order, start=start), original_time)
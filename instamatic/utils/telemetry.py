@@ -0,0 +1,234 @@
+"""Fixed-rate telemetry sampler for microscope variables.
+
+Usage:
+    sampler = TelemetrySampler({'stage': ctrl.stage.get,
+                                'beamshift': ctrl.beamshift.get},
+                               rate=20, out='telemetry.h5')
+    sampler.start()
+    ...
+    data = sampler.stop()  # structured array with fields `t`, `stage`, `beamshift`
+
+The getters are called on a monotonic clock (`time.perf_counter`) from a
+background thread. Sample times are scheduled on an absolute grid
+(`t0 + n / rate`), so that the sampling does not drift when a getter is
+slow; ticks that are missed entirely are skipped and counted in
+`n_missed`. Samples go into a preallocated NumPy structured ring buffer
+holding the last `capacity` samples, and are optionally streamed to an
+HDF5 (`.h5`) or Parquet (`.parquet`, requires `pyarrow`) file.
+"""
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+class _HDF5Writer:
+    def __init__(self, fn: str, dtype: np.dtype, chunk: int):
+        import h5py
+        self.f = h5py.File(fn, 'w')
+        self.dataset = self.f.create_dataset('telemetry', shape=(0,), maxshape=(None,),
+                                             dtype=dtype, chunks=(chunk,))
+
+    def write(self, rows: np.ndarray) -> None:
+        n = len(self.dataset)
+        self.dataset.resize((n + len(rows),))
+        self.dataset[n:] = rows
+        self.f.flush()
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class _ParquetWriter:
+    def __init__(self, fn: str, dtype: np.dtype, chunk: int):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.columns = []
+        for name in dtype.names:
+            shape = dtype[name].shape
+            if shape:
+                self.columns.extend((f'{name}_{i}', name, i) for i in range(int(np.prod(shape))))
+            else:
+                self.columns.append((name, name, None))
+        schema = pa.schema([(col, pa.from_numpy_dtype(dtype[name].base)) for col, name, i in self.columns])
+        self.writer = pq.ParquetWriter(str(fn), schema)
+
+    def write(self, rows: np.ndarray) -> None:
+        arrays = []
+        for col, name, i in self.columns:
+            values = rows[name]
+            if i is not None:
+                values = values.reshape(len(rows), -1)[:, i]
+            arrays.append(self.pa.array(np.ascontiguousarray(values)))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, names=[col[0] for col in self.columns]))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class TelemetrySampler:
+    """Sample a set of getters at a fixed rate.
+
+    getters: dict
+        Mapping of channel names to functions without arguments, each must
+        return a number or a sequence of numbers of fixed length
+    rate: float
+        Sampling rate in Hz
+    capacity: int
+        Size of the in-memory ring buffer (number of samples)
+    out: str
+        Stream samples to this file (`.h5` or `.parquet`), optional
+    chunk: int
+        Number of samples per write to `out`
+    callback: callable
+        Called as `callback(sample)` after every sample, optional
+    """
+
+    def __init__(self,
+                 getters: dict,
+                 rate: float = 10.0,
+                 capacity: int = 100_000,
+                 out: str = None,
+                 chunk: int = 256,
+                 callback=None,
+                 ):
+        super().__init__()
+        self.getters = dict(getters)
+        self.interval = 1.0 / rate
+        self.capacity = capacity
+        self.out = Path(out) if out else None
+        self.chunk = chunk
+        self.callback = callback
+
+        self.buffer = None
+        self.n_samples = 0
+        self.n_missed = 0
+        self.n_errors = 0
+        self.t0 = None
+
+        self._n_written = 0
+        self._writer = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _make_dtype(self) -> np.dtype:
+        """Call every getter once to figure out the shape of its field."""
+        fields = [('t', np.float64)]
+        for name, getter in self.getters.items():
+            shape = np.shape(getter())
+            fields.append((name, np.float64, shape))
+        return np.dtype(fields)
+
+    def _open_writer(self, dtype: np.dtype):
+        if not self.out:
+            return None
+        if self.out.suffix == '.parquet':
+            return _ParquetWriter(self.out, dtype, self.chunk)
+        else:
+            return _HDF5Writer(self.out, dtype, self.chunk)
+
+    def start(self) -> None:
+        """Start sampling in a background thread."""
+        if self._thread:
+            raise RuntimeError('Sampler is already running')
+
+        dtype = self._make_dtype()
+        self.buffer = np.full(self.capacity, np.nan, dtype=dtype)
+        self.n_samples = self.n_missed = self.n_errors = self._n_written = 0
+        self._writer = self._open_writer(dtype)
+
+        self._stop_event.clear()
+        self.t0 = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _sample(self, t: float) -> None:
+        row = self.buffer[self.n_samples % self.capacity]
+        row['t'] = t
+        for name, getter in self.getters.items():
+            try:
+                row[name] = getter()
+            except Exception:
+                row[name] = np.nan
+                self.n_errors += 1
+        self.n_samples += 1
+
+        if self.callback:
+            self.callback(row)
+
+        if self._writer and self.n_samples - self._n_written >= self.chunk:
+            self._flush()
+
+    def _flush(self) -> None:
+        """Write pending samples to the output file."""
+        n_pending = self.n_samples - self._n_written
+        if n_pending > self.capacity:
+            # fell behind by more than the ring buffer, these are lost
+            self._n_written = self.n_samples - self.capacity
+            n_pending = self.capacity
+        if n_pending <= 0:
+            return
+        idx = np.arange(self._n_written, self.n_samples) % self.capacity
+        self._writer.write(self.buffer[idx])
+        self._n_written = self.n_samples
+
+    def _run(self) -> None:
+        interval = self.interval
+        t_next = self.t0
+        while not self._stop_event.is_set():
+            now = time.perf_counter()
+            if now < t_next:
+                if self._stop_event.wait(t_next - now):
+                    break
+                now = time.perf_counter()
+
+            self._sample(now - self.t0)
+
+            t_next += interval
+            now = time.perf_counter()
+            if now > t_next:
+                n_skip = int((now - t_next) // interval) + 1
+                self.n_missed += n_skip
+                t_next += n_skip * interval
+
+    def stop(self) -> np.ndarray:
+        """Stop sampling, close the output file and return the samples in
+        the ring buffer."""
+        if not self._thread:
+            raise RuntimeError('Sampler is not running')
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+        if self._writer:
+            self._flush()
+            self._writer.close()
+            self._writer = None
+
+        return self.data()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None
+
+    def data(self) -> np.ndarray:
+        """Return a copy of the samples currently in the ring buffer in
+        chronological order.
+
+        Can be called while sampling, the most recent sample may then be
+        incomplete.
+        """
+        n = self.n_samples
+        if n <= self.capacity:
+            return self.buffer[:n].copy()
+        i = n % self.capacity
+        return np.concatenate((self.buffer[i:], self.buffer[:i]))
+
+    def effective_rate(self) -> float:
+        """Achieved sampling rate in Hz."""
+        data = self.data()
+        if len(data) < 2:
+            return float('nan')
+        return (len(data) - 1) / (data['t'][-1] - data['t'][0])
@@ -0,0 +1,65 @@
+"""Benchmark loading the configuration with a cold versus warm config
+cache.
+
+Cold: the cache snapshot is removed, so all yaml files are parsed.
+Warm: all files are read from the cache snapshot.
+
+Each load runs in a fresh interpreter (`import instamatic.config`), the
+in-process time of `load_all`/`get_alignments` and calibration lookups
+is measured as well.
+
+Usage:
+    python scripts/benchmark_config.py [-n 5]
+"""
+import argparse
+import subprocess
+import sys
+import timeit
+
+CODE = """
+import time
+t0 = time.perf_counter()
+import instamatic.config
+print(time.perf_counter() - t0)
+"""
+
+
+def time_import(cold: bool, cache_fn) -> float:
+    if cold and cache_fn.exists():
+        cache_fn.unlink()
+    out = subprocess.run([sys.executable, '-c', CODE], stdout=subprocess.PIPE, check=True)
+    return float(out.stdout.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    options = parser.parse_args()
+    n = options.repeat
+
+    from instamatic import config
+    cache_fn = config.yaml_cache.fn
+
+    cold = [time_import(True, cache_fn) for i in range(n)]
+    warm = [time_import(False, cache_fn) for i in range(n)]
+    print(f'import instamatic.config  cold: {min(cold) * 1000:8.2f} ms   warm: {min(warm) * 1000:8.2f} ms')
+
+    for name, func in (
+        ('load_all', config.load_all),
+        ('get_alignments', config.get_alignments),
+    ):
+        t_warm = min(timeit.repeat(func, number=1, repeat=n))
+        t_cold = min(timeit.repeat(func, setup=config.yaml_cache.entries.clear, number=1, repeat=n))
+        print(f'{name:24s}  cold: {t_cold * 1000:8.2f} ms   warm: {t_warm * 1000:8.2f} ms')
+
+    mag = next(iter(config.calibration['mag1']['pixelsize']))
+    number = 100_000
+    t_dict = min(timeit.repeat(lambda: config.calibration['mag1']['pixelsize'][mag], number=number, repeat=n))
+    t_table = min(timeit.repeat(lambda: config.calibration_tables['mag1', 'pixelsize', mag], number=number, repeat=n))
+    print(f"{'pixelsize lookup':24s}  dict: {t_dict / number * 1e9:8.1f} ns   table: {t_table / number * 1e9:8.1f} ns")
+
+    config.load_all()  # restore the cache snapshot
+
+
+if __name__ == '__main__':
+    main()
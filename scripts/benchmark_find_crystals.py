@@ -0,0 +1,116 @@
+"""Benchmark the segmentation backends of the crystal finder and report
+their agreement with the reference random walker (`bf`) backend.
+
+The fixture set is a series of synthetic low-contrast images with a
+known set of crystals on an uneven background. Images can also be given
+on the command line, the pixel size (in micrometer) is then taken from
+`--pixelsize`.
+
+For every backend, the time per image is reported, as well as the
+overlap of the segmentation with the reference (IoU), and the fraction of
+reference crystal positions that are found within `--tolerance` pixels
+(recall) and vice versa (precision).
+
+Usage:
+    python scripts/benchmark_find_crystals.py [-n 10] [--batch 4] [IMG ...]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from instamatic.processing.find_crystals import CrystalFinder
+from instamatic.processing.find_crystals import SEGMENTATION_METHODS
+
+
+def make_fixture(seed: int, shape=(512, 512), n_crystals: int = 8) -> np.ndarray:
+    """Synthetic bright-field image with dark crystals on a sloped
+    background."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.indices(shape)
+    img = 1000 + 200 * (xx / shape[1]) + rng.normal(0, 30, shape)
+    for i in range(n_crystals):
+        y, x = rng.uniform(40, np.array(shape) - 40)
+        a, b = rng.uniform(6, 25, 2)
+        theta = rng.uniform(0, np.pi)
+        u = (yy - y) * np.cos(theta) + (xx - x) * np.sin(theta)
+        v = -(yy - y) * np.sin(theta) + (xx - x) * np.cos(theta)
+        img[(u / a) ** 2 + (v / b) ** 2 < 1] -= rng.uniform(200, 500)
+    return img
+
+
+def match_fraction(a: list, b: list, tolerance: float) -> float:
+    """Fraction of positions in `a` that have a position in `b` within
+    `tolerance`"""
+    if not a:
+        return float('nan')
+    if not b:
+        return 0.0
+    a = np.array([(c.x, c.y) for c in a])
+    b = np.array([(c.x, c.y) for c in b])
+    dist = np.linalg.norm(a[:, None] - b[None], axis=-1)
+    return float(np.mean(dist.min(axis=1) <= tolerance))
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.sum((a > 0) | (b > 0))
+    return float(np.sum((a > 0) & (b > 0)) / union) if union else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='*', metavar='IMG')
+    parser.add_argument('-n', '--number', type=int, default=10, help='Number of synthetic fixtures')
+    parser.add_argument('--pixelsize', type=float, default=0.05, help='Pixel size in micrometer')
+    parser.add_argument('--tolerance', type=float, default=10.0, help='Matching tolerance in pixels')
+    parser.add_argument('--batch', type=int, default=0, help='Also time `find_batch` with this many processes')
+    parser.add_argument('--timepix', action='store_true', help='Use the timepix defaults')
+    options = parser.parse_args()
+
+    if options.images:
+        from instamatic.formats import read_image
+        images = [read_image(fn)[0] for fn in options.images]
+    else:
+        images = [make_fixture(seed) for seed in range(options.number)]
+
+    make_finder = CrystalFinder.timepix if options.timepix else CrystalFinder
+    finders = {method: make_finder(method=method) for method in SEGMENTATION_METHODS}
+
+    results = {}
+    for method, finder in finders.items():
+        times = []
+        crystals = []
+        segmented = []
+        for img in images:
+            np.random.seed(0)  # kmeans initialization
+            t0 = time.perf_counter()
+            crystals.append(finder.locate(img, options.pixelsize))
+            times.append(time.perf_counter() - t0)
+            segmented.append(finder.segment(img)[1])
+        results[method] = times, crystals, segmented
+
+    ref_times, ref_crystals, ref_segmented = results['bf']
+
+    print(f'{len(images)} images, tolerance: {options.tolerance} px\n')
+    print(f"{'method':10s} {'ms/img':>8s} {'speedup':>8s} {'n':>6s} {'IoU':>6s} {'recall':>7s} {'prec.':>7s}")
+    for method, (times, crystals, segmented) in results.items():
+        n = sum(len(c) for c in crystals)
+        seg_iou = np.mean([iou(a, b) for a, b in zip(ref_segmented, segmented)])
+        recall = np.nanmean([match_fraction(a, b, options.tolerance) for a, b in zip(ref_crystals, crystals)])
+        precision = np.nanmean([match_fraction(b, a, options.tolerance) for a, b in zip(ref_crystals, crystals)])
+        print(f'{method:10s} {np.mean(times) * 1000:8.1f} {np.mean(ref_times) / np.mean(times):8.2f} '
+              f'{n:6d} {seg_iou:6.3f} {recall:7.3f} {precision:7.3f}')
+
+    if options.batch:
+        print()
+        for method, finder in finders.items():
+            with finder:
+                finder.find_batch(images[:options.batch], processes=options.batch, pixelsize=options.pixelsize)  # start the pool
+                t0 = time.perf_counter()
+                finder.find_batch(images, processes=options.batch, pixelsize=options.pixelsize)
+                dt = time.perf_counter() - t0
+            print(f'{method:10s} find_batch({options.batch} processes): {dt / len(images) * 1000:8.1f} ms/img')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Benchmark the forward pass of the crystal quality neural network.
+
+Compares the vectorized `predict`/`predict_batch` with the original
+loop-based implementation of the convolution and max pooling layers, and
+checks that the scores are identical. Also compares `preprocess` with
+`preprocess_batch` on synthetic diffraction patterns.
+
+Usage:
+    python scripts/benchmark_neural_network.py [-n 10]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from instamatic.neural_network import neural_network
+from instamatic.neural_network import preprocess
+from instamatic.neural_network.preprocess import preprocess_batch
+
+
+def conv_layer_loop(in_layer, weight, offset):
+    first_layer = np.ones([(in_layer.shape[0] - 2) * (in_layer.shape[1] - 2), in_layer.shape[2], 3, 3])
+    q = 0
+    for n in range(in_layer.shape[0] - 2):
+        for p in range(in_layer.shape[1] - 2):
+            first_layer[q] = np.transpose(in_layer[n:n + 3, p:p + 3], [2, 0, 1])
+            q += 1
+    convoluted = np.tensordot(first_layer, weight, axes=(((2, 3, 1), (0, 1, 2))))
+    convoluted_reshaped = convoluted.reshape([in_layer.shape[0] - 2, in_layer.shape[1] - 2, 64])
+    convoluted_reshaped += offset
+    return convoluted_reshaped
+
+
+def relu_loop(convoluted):
+    convoluted[convoluted < 0] = 0
+    return convoluted
+
+
+def max_pooling_loop(convoluted):
+    pooled = np.ones((convoluted.shape[0] // 2, convoluted.shape[1] // 2, convoluted.shape[2]))
+    for n in range(convoluted.shape[0] // 2):
+        for p in range(convoluted.shape[1] // 2):
+            pooled[n, p] = np.amax(convoluted[n * 2:n * 2 + 2, p * 2:p * 2 + 2], axis=(0, 1))
+    return pooled
+
+
+def predict_loop(image, weights=neural_network.weights):
+    """Original implementation of `neural_network.predict`"""
+    x = image
+    for i in range(0, 8, 2):
+        x = max_pooling_loop(relu_loop(conv_layer_loop(x, weights[i], weights[i + 1])))
+    flattened = relu_loop(conv_layer_loop(x, weights[8], weights[9])).reshape((1, 1600))
+    dense1 = relu_loop(np.tensordot(flattened, weights[10], axes=(1, 0)) + weights[11])
+    dense2 = relu_loop(np.tensordot(dense1, weights[12], axes=(1, 0)) + weights[13])
+    dense3 = np.tensordot(dense2, weights[14], axes=(1, 0)) + weights[15]
+    return neural_network.logistic(dense3)[0][0]
+
+
+def make_pattern(rng, shape=(516, 516), n_spots=30) -> np.ndarray:
+    """Synthetic diffraction pattern with a direct beam and some spots."""
+    yy, xx = np.indices(shape)
+    cy, cx = rng.uniform(150, np.array(shape) - 150)
+    img = rng.poisson(5, shape).astype(float)
+    img += 5000 * np.exp(-((yy - cy)**2 + (xx - cx)**2) / 20)
+    for y, x in rng.uniform(20, np.array(shape) - 20, (n_spots, 2)):
+        img += rng.uniform(100, 2000) * np.exp(-((yy - y)**2 + (xx - x)**2) / 4)
+    return img
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=10, help='Number of images')
+    options = parser.parse_args()
+    n = options.number
+
+    rng = np.random.default_rng(0)
+    images = rng.random((n, 150, 150, 1)) * 0.01
+
+    t0 = time.perf_counter()
+    expected = [predict_loop(image) for image in images]
+    t_loop = (time.perf_counter() - t0) / n
+
+    t0 = time.perf_counter()
+    scores = [neural_network.predict(image) for image in images]
+    t_predict = (time.perf_counter() - t0) / n
+
+    t0 = time.perf_counter()
+    batch = neural_network.predict_batch(images)
+    t_batch = (time.perf_counter() - t0) / n
+
+    print(f'{n} images (150x150)')
+    print(f'loop:           {t_loop * 1000:8.1f} ms/img')
+    print(f'predict:        {t_predict * 1000:8.1f} ms/img ({t_loop / t_predict:.1f}x)')
+    print(f'predict_batch:  {t_batch * 1000:8.1f} ms/img ({t_loop / t_batch:.1f}x)')
+    print(f'identical: {scores == expected and batch.tolist() == expected}')
+
+    patterns = np.array([make_pattern(rng) for i in range(n)])
+
+    t0 = time.perf_counter()
+    expected = np.array([preprocess(pattern) for pattern in patterns])
+    t_single = (time.perf_counter() - t0) / n
+
+    t0 = time.perf_counter()
+    processed = preprocess_batch(patterns)
+    t_batch = (time.perf_counter() - t0) / n
+
+    corr = np.mean([np.corrcoef(a.ravel(), b.ravel())[0, 1] for a, b in zip(expected, processed)])
+    print(f'\n{n} patterns {patterns.shape[1:]}')
+    print(f'preprocess:        {t_single * 1000:8.1f} ms/img')
+    print(f'preprocess_batch:  {t_batch * 1000:8.1f} ms/img ({t_single / t_batch:.1f}x)')
+    print(f'mean correlation with preprocess: {corr:.4f}')
+
+
+if __name__ == '__main__':
+    main()
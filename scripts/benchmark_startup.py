@@ -0,0 +1,62 @@
+"""Measure the import time of the instamatic entry points.
+
+Each module is imported in a fresh interpreter, so that the numbers
+reflect the cold start of the console scripts. Also lists which of the
+heavy dependencies end up being imported.
+
+Usage:
+    python scripts/benchmark_startup.py [-n 5] [module ...]
+"""
+import argparse
+import subprocess
+import sys
+
+MODULES = (
+    'instamatic.server.tem_server',
+    'instamatic.server.cam_server',
+    'instamatic.formats',
+    'instamatic.TEMController',
+    'instamatic.calibrate',
+    'instamatic.main',
+)
+
+HEAVY = ('matplotlib', 'skimage', 'scipy', 'h5py', 'tifffile', 'pandas', 'lmfit')
+
+CODE = """
+import sys, time
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(dt, ','.join(heavy))
+"""
+
+
+def time_import(module: str, repeat: int = 5) -> tuple:
+    """Return the best import time of `module` over `repeat` runs and the
+    heavy modules it imports."""
+    times = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', CODE.format(module=module, heavy=HEAVY)],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if out.returncode:
+            return float('nan'), 'import failed'
+        dt, _, heavy = out.stdout.decode().strip().splitlines()[-1].partition(' ')
+        times.append(float(dt))
+    return min(times), heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    options = parser.parse_args()
+
+    print(f"{'module':40s} {'time (s)':>9s}  heavy imports")
+    for module in options.modules:
+        dt, heavy = time_import(module, repeat=options.repeat)
+        print(f'{module:40s} {dt:9.3f}  {heavy}')
+
+
+if __name__ == '__main__':
+    main()
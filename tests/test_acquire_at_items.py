@@ -0,0 +1,69 @@
+import time
+
+from instamatic.acquire_at_items import AcquireAtItems
+
+
+def test_acquire_at_items_pipelined(ctrl):
+    items = [(i * 1000, 0) for i in range(6)]
+    written = []
+
+    def acquire(ctrl):
+        return ctrl.current_i
+
+    def process(result):
+        time.sleep(0.05 * (result.i % 2))  # finish out of order
+        return result.raw['acquire'] * 2
+
+    def write(result):
+        written.append((result.i, result.data['process']))
+
+    aai = AcquireAtItems(ctrl, items, acquire=acquire, process=process, write=write,
+                         backlash=False, workers=3, max_pending=2)
+    aai.start()
+
+    assert written == [(i, i * 2) for i in range(6)]
+    assert [result.i for result in aai.results] == list(range(6))
+    assert all(result.raw == {} for result in aai.results)
+    assert aai.timings['process'][1] >= 0.05
+
+
+def test_acquire_at_items_error(ctrl):
+    items = [(i * 1000, 0) for i in range(20)]
+
+    def process(result):
+        if result.i == 1:
+            raise ValueError('bad item')
+
+    aai = AcquireAtItems(ctrl, items, acquire=lambda ctrl: None, process=process,
+                         backlash=False, max_pending=1)
+    aai.start()
+
+    assert isinstance(aai.results[1].error, ValueError)
+    assert len(aai.results) < len(items)
+
+
+def test_acquire_at_items_release_raw(ctrl):
+    items = [(i * 1000, 0) for i in range(3)]
+
+    aai = AcquireAtItems(ctrl, items, acquire=lambda ctrl: ctrl.current_i, backlash=False)
+    aai.start()
+
+    assert not aai.pipelined
+    assert [result.i for result in aai.results] == list(range(3))
+    assert all(result.raw == {} for result in aai.results)
+
+
+def test_acquire_at_items_route_indices(ctrl):
+    items = [(0, 0), (50_000, 0), (1000, 0), (51_000, 0), (2000, 0)]
+    visited = []
+
+    def acquire(ctrl):
+        visited.append(ctrl.current_i)
+        assert ctrl.current_item == items[ctrl.current_i]
+
+    aai = AcquireAtItems(ctrl, items, acquire=acquire, backlash=False, optimize_route=True)
+    aai.start(start_index=1)
+
+    # the route is reordered, the indices refer to `items`
+    assert sorted(visited) == [1, 2, 3, 4] != visited
+    assert [result.i for result in aai.results] == visited
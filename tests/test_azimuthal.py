@@ -0,0 +1,47 @@
+import numpy as np
+
+from instamatic.utils.azimuthal import AzimuthalIntegrator
+
+
+def radial_average_reference(z, center):
+    y, x = np.indices(z.shape)
+    r = np.sqrt((x - center[1])**2 + (y - center[0])**2).astype(int)
+    return np.bincount(r.ravel(), z.ravel()) / np.bincount(r.ravel())
+
+
+def test_integrate():
+    rng = np.random.default_rng(0)
+    stack = rng.poisson(10, (3, 64, 80)).astype(float)
+    center = (30.0, 45.0)
+
+    integrator = AzimuthalIntegrator()
+    profile = integrator.integrate(stack[0], center)
+    np.testing.assert_allclose(profile, radial_average_reference(stack[0], center))
+
+    profiles, variance = integrator.integrate(stack, center, variance=True)
+    assert profiles.shape == variance.shape == (3, len(profile))
+    np.testing.assert_allclose(profiles[0], profile)
+
+    bins = integrator.get_bins(stack.shape[1:], center)
+    values = stack[1].ravel()[bins.bins == 10]
+    np.testing.assert_allclose(variance[1, 10], np.var(values))
+
+    # nearby centers share the bin map
+    assert integrator.get_bins(stack.shape[1:], (30.01, 44.99)) is bins
+    assert integrator.misses == 1
+
+
+def test_integrate_mask():
+    img = np.ones((50, 50))
+    mask = np.zeros_like(img, dtype=bool)
+    mask[20:30, :] = True
+    img[mask] = 1000
+
+    integrator = AzimuthalIntegrator()
+    profile = integrator.integrate(img, (25, 25), mask=mask)
+    valid = ~np.isnan(profile)
+    np.testing.assert_allclose(profile[valid], 1)
+    assert np.isnan(profile[0])  # all pixels in the first bin are masked
+
+    radial_map = integrator.radial_map(img, (25, 25), mask=mask)
+    assert np.all(np.isnan(radial_map[mask]))
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from instamatic.processing.bad_pixels import BadPixelMap
+from instamatic.processing.flatfield import apply_center_pixel_correction
+
+
+def test_bad_pixel_map(tmp_path):
+    rng = np.random.default_rng(0)
+    flatfield = rng.normal(1000, 10, (516, 516))
+    flatfield[10, 20] = 0
+    flatfield[0, 0] = 0
+    flatfield[100:102, 200] = 0  # cluster
+    darkfield = rng.normal(5, 1, (516, 516))
+    darkfield[300, 400] = 100
+
+    bad_pixels = BadPixelMap.from_flatfield(flatfield, darkfield)
+    bad_pixels.add_timepix_cross()
+    np.testing.assert_array_equal(bad_pixels.dead, [[0, 0], [10, 20], [100, 200], [101, 200]])
+    np.testing.assert_array_equal(bad_pixels.hot, [[300, 400]])
+
+    img = rng.integers(0, 1000, (516, 516)).astype(float)
+    out = bad_pixels.correct(img)
+    assert out[10, 20] == pytest.approx((img[9:12, 19:22].sum() - img[10, 20]) / 8)
+    assert out[0, 0] == pytest.approx((img[:2, :2].sum() - img[0, 0]) / 3)
+    assert out[100, 200] == pytest.approx((img[99:102, 199:202].sum() - img[100:102, 200].sum()) / 7)
+    np.testing.assert_allclose(out[255:261, 255:261], apply_center_pixel_correction(img.copy())[255:261, 255:261])
+    untouched = ~bad_pixels.bad
+    untouched[255:261, 255:261] = False
+    np.testing.assert_array_equal(out[untouched], img[untouched])
+
+    # in place on an integer stack
+    stack = np.array([img, img]).astype(np.uint16)
+    bad_pixels.correct_stack(stack, out=stack)
+    np.testing.assert_allclose(stack[1], out, atol=0.5)
+
+    fn = BadPixelMap.sidecar(tmp_path / 'flatfield.tiff')
+    bad_pixels.save(fn)
+    loaded = BadPixelMap.load(fn)
+    np.testing.assert_array_equal(loaded.correct(img), out)
+    assert len(loaded) == 4 + 1 + 36
+
+
+def test_bad_pixel_map_isolated():
+    img = np.ones((8, 8))
+    bad_pixels = BadPixelMap(img.shape, dead=np.ones((8, 8), dtype=bool), max_radius=1)
+    np.testing.assert_array_equal(bad_pixels.correct(img), img)
+
+
+def test_bad_pixel_map_legacy_flatfield(tmp_path):
+    from instamatic.formats import write_tiff
+    from instamatic.processing.flatfield import apply_corrections
+
+    # flatfield without a bad pixel map, the dead pixels are in the header
+    deadpixels = np.array([[10, 20], [300, 400]])
+    fn = tmp_path / 'flatfield.tiff'
+    write_tiff(fn, np.ones((516, 516)), header={'deadpixels': deadpixels})
+
+    bad_pixels = BadPixelMap.for_flatfield(fn, timepix=True)
+    assert len(bad_pixels) == 2 + 36
+
+    img = np.random.default_rng(0).integers(0, 1000, (516, 516)).astype(float)
+    expected = apply_corrections(img.copy(), deadpixels=deadpixels)
+    np.testing.assert_allclose(apply_corrections(img.copy(), bad_pixels=bad_pixels), expected)
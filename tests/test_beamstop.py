@@ -0,0 +1,55 @@
+import numpy as np
+
+from instamatic.utils.beamstop import BeamstopTracker
+
+
+def make_frame(rng, shift: float, shape=(256, 256), center=(128, 128)):
+    """Diffraction pattern with a beamstop arm next to the direct beam,
+    the arm moves `shift` pixels along x."""
+    yy, xx = np.indices(shape)
+    r = np.hypot(yy - center[0], xx - center[1])
+    img = rng.poisson(2000 * np.exp(-r / 30) + 50 + 200 * np.exp(-((r - 60) / 3)**2)).astype(float)
+    arm = (abs(yy - center[0]) < 8) & (xx > center[1] + 20 + shift)
+    img[arm] = rng.poisson(5, arm.sum())
+    return img
+
+
+def test_beamstop_tracker():
+    rng = np.random.default_rng(0)
+    n = 60
+    images = [make_frame(rng, shift=0.1 * i) for i in range(n)]
+    centers = [(128, 128)] * n
+
+    track = BeamstopTracker(n_samples=5).track(images, centers=centers)
+    assert len(track) == n
+    assert len(track.sample_indices) == 5
+
+    # the beamstop edge moves with the arm (+pad)
+    for i in (1, n // 2, n):
+        rect = track.rect(i)
+        assert abs(rect[:, 1].min() - (148 + 0.1 * (i - 1) - 0.5)) <= 1.5
+        assert rect[:, 0].min() < 121 and rect[:, 0].max() > 135
+
+    blocks = track.blocks(tolerance=2.0)
+    assert blocks[0][0] == 1 and blocks[-1][1] == n
+    assert all(b[0] == a[1] + 1 for a, b in zip(blocks, blocks[1:]))
+    assert len(track.untrusted_areas(tolerance=2.0)) == len(blocks) > 1
+
+
+def test_beamstop_tracker_reads_samples_only():
+    from instamatic.processing.ImgConversion import _FrameSequence
+
+    rng = np.random.default_rng(1)
+    frame = make_frame(rng, shift=0)
+    reads = []
+
+    class Frames(dict):
+        def __getitem__(self, i):
+            reads.append(i)
+            return frame
+
+    data = Frames.fromkeys(range(1, 201))
+    tracker = BeamstopTracker(n_samples=3)
+    track = tracker.track(_FrameSequence(data, list(range(1, 201))), centers=[(128, 128)] * 200)
+    assert len(track) == 200
+    assert len(reads) <= 3 * tracker.average
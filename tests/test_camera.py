@@ -1,3 +1,8 @@
+import time
+
+import pytest
+
+
 def test_get_image(ctrl):
     bin1 = 1
     bin2 = 2
@@ -22,3 +27,33 @@ def test_functions(ctrl):
     dims = ctrl.cam.getImageDimensions()
     assert isinstance(dims, tuple)
     assert len(dims) == 2
+
+
+def test_emmenu_export(ctrl, tmp_path):
+    cam = ctrl.cam
+    cam.set_image_index(0)
+    cam.set_exposure(10)  # ms
+    cam.start_record()
+    time.sleep(0.1)
+    cam.stop_record()
+    end_index = cam.get_image_index()
+    assert end_index > 1
+
+    timestamps = cam.get_timestamps(1, end_index)
+    assert len(timestamps) == end_index
+    assert timestamps == sorted(timestamps)
+
+    progress = []
+    cam.writeTiffs(1, end_index, path=tmp_path, workers=2, wait=False,
+                   callback=lambda n_done, n_total: progress.append(n_done))
+    export = cam._export
+    cam.wait_export()  # also done before the next recording
+    assert export.done
+    assert export.n_written == end_index
+    assert sorted(progress) == list(range(1, end_index + 1))
+    assert len(list(tmp_path.glob('*.tiff'))) == end_index
+
+    # the buffers are gone, the failed images must not pass silently
+    cam.writeTiffs(1, end_index, path=tmp_path, clear_buffer=True)
+    with pytest.raises(OSError):
+        cam.writeTiffs(1, end_index, path=tmp_path)
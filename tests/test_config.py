@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from instamatic import config
+from instamatic.config.calibration_tables import CalibrationTables
+from instamatic.config.config_cache import YAMLCache
+
+
+def test_yaml_cache(tmp_path):
+    fn = tmp_path / 'test.yaml'
+    fn.write_text('a: 1\nb: [1, 2]\n')
+    cache_fn = tmp_path / 'cache.pickle'
+
+    cache = YAMLCache(cache_fn)
+    d = cache.load(fn)
+    assert d == {'a': 1, 'b': [1, 2]}
+    assert cache.misses == 1
+    cache.save()
+    assert cache_fn.exists()
+
+    cache = YAMLCache(cache_fn)
+    d = cache.load(fn)
+    assert d == {'a': 1, 'b': [1, 2]}
+    assert cache.hits == 1
+
+    # returns a fresh copy
+    d['b'].append(3)
+    assert cache.load(fn)['b'] == [1, 2]
+
+    assert not cache.changed()
+    fn.write_text('a: 2\n')
+    st = os.stat(fn)
+    os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert cache.changed() == [str(fn)]
+    assert cache.load(fn) == {'a': 2}
+    assert cache.misses == 1
+
+
+def test_calibration_tables():
+    tables = CalibrationTables({
+        'name': 'test',
+        'diff': {'pixelsize': {300: 0.004, 150: 0.008, 600: 0.002}},
+    })
+    assert tables['diff', 'pixelsize', 300] == 0.004
+    assert tables.get('diff', 'rot90', 300, 0) == 0
+    mags, values = tables.table('diff', 'pixelsize')
+    assert mags.tolist() == [150, 300, 600]
+    assert values.tolist() == [0.008, 0.004, 0.002]
+    assert tables.nearest('diff', 'pixelsize', 200) == 0.008
+    assert tables.nearest('diff', 'pixelsize', 1000) == 0.002
+
+    with pytest.raises(KeyError):
+        tables['diff', 'pixelsize', 250]
+
+
+def test_config_tables():
+    for mag, value in config.calibration['mag1']['pixelsize'].items():
+        assert config.calibration_tables['mag1', 'pixelsize', mag] == value
+
+
+def test_reload():
+    assert not config.reload()
+    settings = config.settings
+    assert config.reload(force=True)
+    assert config.settings is not settings
+    assert config.settings.mapping == settings.mapping
@@ -0,0 +1,54 @@
+import numpy as np
+
+from instamatic.processing.crystal_tracker import beam_center
+from instamatic.processing.crystal_tracker import CrystalTracker
+
+
+def make_image(beam, crystal, rng, shape=(256, 256)):
+    """Defocused beam with a dark elongated crystal, and the cross between
+    the Timepix chips."""
+    yy, xx = np.indices(shape)
+    img = np.where((yy - beam[0]) ** 2 + (xx - beam[1]) ** 2 < 60 ** 2, 1000.0, 50.0)
+    img[((yy - crystal[0]) / 15) ** 2 + ((xx - crystal[1]) / 8) ** 2 < 1] -= 600
+    img = rng.poisson(img).astype(float)
+    img[126:130] = 0
+    img[:, 126:130] = 0
+    return img
+
+
+def test_crystal_tracker():
+    rng = np.random.default_rng(0)
+    beam = np.array([128.0, 132.0])
+    crystal = beam.copy()
+    velocity = np.array([1.0, -0.5])  # px per frame
+
+    tracker = CrystalTracker(make_image(beam, crystal, rng), angle=0, cross=(126, 130))
+
+    for i in range(1, 20):
+        crystal = crystal + velocity
+        img = make_image(beam, crystal, rng)
+        result = tracker.update(img, angle=i)
+
+        assert not result.fallback
+        np.testing.assert_allclose(result.offset, crystal - beam_center(img), atol=2)
+
+        # follow the crystal with the beam
+        beam = beam + result.offset
+        tracker.correct(result.offset)
+
+    np.testing.assert_allclose(tracker.velocity, velocity, atol=0.3)
+
+
+def test_crystal_tracker_fallback():
+    rng = np.random.default_rng(1)
+    beam = np.array([128.0, 128.0])
+    tracker = CrystalTracker(make_image(beam, beam, rng), cross=(126, 130),
+                             fallback=lambda img, center: (5.0, 5.0))
+
+    # crystal gone, the correlation with an empty beam is low
+    yy, xx = np.indices((256, 256))
+    empty = np.where((yy - 128) ** 2 + (xx - 128) ** 2 < 60 ** 2, 1000.0, 50.0)
+    result = tracker.update(rng.poisson(empty).astype(float), angle=1)
+    assert result.fallback
+    assert tracker.n_fallback == 1
+    np.testing.assert_allclose(result.offset, (5, 5))
@@ -88,3 +88,32 @@ def test_red(ctrl):
     red_exp.finalize()
 
     tempdrc.cleanup()
+
+
+def test_serialed_corrections(tmp_path):
+    """serialED only repairs the dead pixels and divides by the flatfield,
+    also if the bad pixel map includes the Timepix cross."""
+    import numpy as np
+    from instamatic.experiments.serialed.experiment import Experiment
+    from instamatic.formats import write_tiff
+    from instamatic.processing.bad_pixels import BadPixelMap
+    from instamatic.processing.flatfield import apply_flatfield_correction
+    from instamatic.processing.flatfield import remove_deadpixels
+
+    rng = np.random.default_rng(0)
+    deadpixels = np.array([[10, 20], [300, 400]])
+    flatfield = rng.normal(1000, 10, (516, 516))
+    fn = tmp_path / 'flatfield.tiff'
+    write_tiff(fn, flatfield, header={'deadpixels': deadpixels})
+    img = rng.integers(0, 1000, (516, 516)).astype(float)
+    expected = apply_flatfield_correction(remove_deadpixels(img.copy(), deadpixels), flatfield)
+
+    for sidecar in (False, True):
+        if sidecar:
+            bad_pixels = BadPixelMap(flatfield.shape, dead=deadpixels)
+            bad_pixels.add_timepix_cross()
+            bad_pixels.save(BadPixelMap.sidecar(fn))
+        exp = Experiment.__new__(Experiment)
+        exp.load_flatfield(fn)
+        out, h = exp.apply_corrections(img.copy(), {})
+        np.testing.assert_allclose(out, expected)
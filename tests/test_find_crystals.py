@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from instamatic.processing.find_crystals import CrystalFinder
+from instamatic.processing.find_crystals import find_crystals
+from instamatic.processing.find_crystals import SEGMENTATION_METHODS
+
+
+CRYSTALS = ((60, 60), (60, 190), (190, 120))
+
+
+def make_image(shape=(256, 256), radius=12):
+    rng = np.random.default_rng(0)
+    img = 1000 + rng.normal(0, 20, shape)
+    yy, xx = np.indices(shape)
+    for y, x in CRYSTALS:
+        img[(yy - y) ** 2 + (xx - x) ** 2 < radius ** 2] -= 400
+    return img
+
+
+@pytest.mark.parametrize('method', SEGMENTATION_METHODS)
+def test_crystal_finder(method):
+    img = make_image()
+    finder = CrystalFinder(method=method, spread=10.0)
+    crystals = finder.locate(img, pixelsize=0.1)
+
+    assert len(crystals) == len(CRYSTALS)
+    found = sorted((round(c.x), round(c.y)) for c in crystals)
+    np.testing.assert_allclose(found, sorted(CRYSTALS), atol=2)
+
+
+def test_crystal_finder_reference():
+    img = make_image()
+    magnification = 2500
+    expected = find_crystals(img, magnification, spread=10.0)
+    crystals = CrystalFinder(method='bf', spread=10.0)(img, magnification)
+    assert crystals == expected
+
+
+@pytest.mark.parametrize('processes', (1, 2))
+def test_find_batch(processes):
+    images = [make_image(), make_image()[::-1]]
+    finder = CrystalFinder(method='threshold', spread=10.0)
+    with finder:
+        results = finder.find_batch(images, magnification=2500, processes=processes)
+    assert results == [finder(img, 2500) for img in images]
+
+
+def test_submit():
+    img = make_image()
+    with CrystalFinder(method='threshold', spread=10.0) as finder:
+        future = finder.submit(img, magnification=2500)
+        assert future.result() == finder(img, 2500)
+
+
+def test_invalid_method():
+    with pytest.raises(ValueError):
+        CrystalFinder(method='magic')
@@ -0,0 +1,52 @@
+import numpy as np
+
+from instamatic.processing.find_holes import find_holes
+from instamatic.processing.find_holes import find_holes_multiscale
+from instamatic.processing.find_holes import HOLE_DTYPE
+from instamatic.processing.find_holes import HoleFinder
+
+
+def make_grid(shape=(512, 512), pitch=100, radius=25, seed=0):
+    """Synthetic grid atlas with bright holes on a noisy background."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.indices(shape)
+    img = 50 + rng.normal(0, 8, shape)
+    for cy in np.arange(pitch / 2, shape[0], pitch):
+        for cx in np.arange(pitch / 2, shape[1], pitch):
+            cy, cx = cy + rng.uniform(-5, 5), cx + rng.uniform(-5, 5)
+            img[(yy - cy)**2 + (xx - cx)**2 < radius**2] += 150
+    return img
+
+
+def test_find_holes_multiscale():
+    img = make_grid()
+    area = np.pi * 25**2
+
+    expected = find_holes(img, area=area, plot=False, verbose=False)
+    holes = find_holes_multiscale(img, area=area, coarse_maxdim=128)
+    assert holes.dtype == HOLE_DTYPE
+    assert len(holes) == len(expected) == 25
+
+    expected = np.array(sorted((prop.centroid[0], prop.centroid[1], prop.equivalent_diameter) for prop in expected))
+    found = np.sort(holes[['x', 'y', 'diameter']]).tolist()
+    np.testing.assert_allclose(found, expected)
+
+
+def test_hole_finder_tiles():
+    img = make_grid()
+    finder = HoleFinder(area=np.pi * 25**2, coarse_maxdim=128)
+    reference = finder.find(img)
+
+    # 2x2 overlapping tiles, 5 nm per pixel
+    stagematrix = np.eye(2) * 5
+    tiles = []
+    stagecoords = []
+    for y0 in (0, 192):
+        for x0 in (0, 192):
+            tiles.append(img[y0:y0 + 320, x0:x0 + 320])
+            stagecoords.append(((y0 + 160) * 5, (x0 + 160) * 5))
+
+    holes = finder.find_batch(tiles, stagecoords, stagematrix, processes=1)
+    assert len(holes) == len(reference)
+    stage = np.sort(holes[['stage_x', 'stage_y']]).tolist()
+    np.testing.assert_allclose(stage, np.sort(reference[['x', 'y']]).tolist() * np.array(5), atol=1e-6)
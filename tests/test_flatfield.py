@@ -0,0 +1,44 @@
+import numpy as np
+
+from instamatic import config
+from instamatic.config.calibration_tables import CalibrationTables
+from instamatic.processing.flatfield import accumulate_frames
+from instamatic.processing.flatfield import collect_flatfield
+from instamatic.processing.flatfield import FrameStatistics
+
+
+def test_frame_statistics():
+    rng = np.random.default_rng(0)
+    frames = rng.poisson(100, (50, 32, 48)).astype(np.uint16)
+
+    stats = FrameStatistics()
+    stats.add_stack(frames)
+    assert stats.n == 50
+    np.testing.assert_allclose(stats.mean, frames.mean(axis=0))
+    np.testing.assert_allclose(stats.variance, frames.var(axis=0, ddof=1))
+    np.testing.assert_allclose(stats.std, frames.std(axis=0, ddof=1))
+
+
+def test_collect_flatfield(ctrl, tmp_path):
+    ret = collect_flatfield(ctrl, frames=5, confirm=False, drc=tmp_path)
+    shape = ret['flatfield'].shape
+    for key in ('darkfield', 'gain', 'noise'):
+        assert ret[key].shape == shape
+    assert len(list(tmp_path.glob('flatfield_*.badpixels.npz'))) == 1
+    assert len(list(tmp_path.glob('noise_*.tiff'))) == 1
+
+
+def test_accumulate_frames_rotation(ctrl, tmp_path, monkeypatch):
+    mode = ctrl.mode.get()
+    mag = ctrl.magnification.value
+    monkeypatch.setattr(config, 'calibration_tables', CalibrationTables({mode: {'rot90': {mag: 1}}}))
+
+    raw = np.arange(512 * 512, dtype=float).reshape(512, 512)
+    monkeypatch.setattr(ctrl.cam, 'getImage', lambda exposure=None, binsize=None, **kwargs: raw.copy())
+
+    # the stream and the saved images have the orientation of `ctrl.get_image`
+    img, h = ctrl.get_image(exposure=0.01, binsize=1, header_keys=None)
+    assert not np.array_equal(img, raw)
+    for save_images in (False, True):
+        stats = accumulate_frames(ctrl, 2, exposure=0.01, binsize=1, save_images=save_images, drc=tmp_path)
+        np.testing.assert_array_equal(stats.mean, img)
@@ -0,0 +1,36 @@
+import numpy as np
+
+from instamatic.utils.framebuffer import FrameBuffer
+
+
+def test_frame_buffer(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = [(i, rng.integers(0, 1000, (16, 16)).astype(np.uint16), {'i': i}) for i in range(1, 12)]
+
+    buffer = FrameBuffer(tmp_path / 'scratch', window=2, segment_size=4)
+    for frame in frames:
+        buffer.append(frame)
+    buffer.close()
+
+    assert len(buffer) == len(frames)
+    assert len(list((tmp_path / 'scratch').glob('frames_*.npy'))) == 3
+    for (i, img, h), (j, stored, stored_h) in zip(frames, buffer):
+        assert i == j
+        assert h == stored_h
+        np.testing.assert_array_equal(img, stored)
+
+    data = buffer.frames(transform=lambda img: img * 2)
+    np.testing.assert_array_equal(data[5], frames[4][1] * 2)
+    data[20] = np.zeros((16, 16))
+    del data[1]
+    assert list(data) == list(range(2, 12)) + [20]
+
+    # recover the data from the scratch files
+    recovered = FrameBuffer(tmp_path / 'scratch', mode='r')
+    assert recovered.indices == list(range(1, 12))
+    assert recovered.headers[3] == {'i': 3}
+    np.testing.assert_array_equal(recovered[11], frames[-1][1])
+
+    del recovered
+    buffer.delete()
+    assert not (tmp_path / 'scratch').exists()
@@ -0,0 +1,30 @@
+import numpy as np
+
+from instamatic.calibrate.height_map import HeightMap
+
+
+def test_height_map(tmp_path):
+    rng = np.random.default_rng(0)
+    fn = tmp_path / 'grid.yaml'
+    height_map = HeightMap.load(fn, max_uncertainty=1000, noise=100)
+
+    def plane(x, y):
+        return 5000 + 0.02 * x - 0.01 * y
+
+    assert height_map.needs_measurement(0, 0)
+
+    for x, y in rng.uniform(-200_000, 200_000, (10, 2)):
+        height_map.add(x, y, plane(x, y) + rng.normal(0, 100))
+
+    z, sigma = height_map.predict(50_000, -50_000)
+    assert abs(z - plane(50_000, -50_000)) < 3 * sigma
+    assert not height_map.needs_measurement(50_000, -50_000)
+    # the uncertainty grows away from the measurements
+    assert height_map.predict(5_000_000, 0).sigma > sigma
+
+    height_map.add(0, 0, 5000, angles=[30, 0, -30], offsets=[-300, 0, 300])
+
+    loaded = HeightMap.load(fn, noise=100)
+    assert len(loaded) == 11
+    np.testing.assert_allclose(loaded.predict(50_000, -50_000), height_map.predict(50_000, -50_000))
+    np.testing.assert_allclose(loaded.predict_track(1000, 0, [-15, 0, 15]), [150, 0, -150])
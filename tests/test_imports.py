@@ -0,0 +1,22 @@
+import subprocess
+import sys
+
+import pytest
+
+
+HEAVY_MODULES = ('matplotlib', 'skimage')
+
+
+@pytest.mark.parametrize('module', [
+    'instamatic.server.tem_server',
+    'instamatic.formats',
+    'instamatic.TEMController',
+])
+def test_lazy_imports(module):
+    """Importing the modules needed by the console scripts should not pull
+    in matplotlib or scikit-image."""
+    code = (f'import sys, {module}; '
+            f'print([m for m in {HEAVY_MODULES!r} if m in sys.modules])')
+    out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True)
+    loaded = out.stdout.decode().strip().splitlines()[-1]
+    assert loaded == '[]', f'`{module}` imports {loaded}'
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from instamatic import config
+from instamatic.utils import instrumentation
+
+
+@pytest.fixture()
+def enabled():
+    config.settings.instrumentation = True
+    recorder = instrumentation.get_recorder()
+    recorder.reset()
+    yield recorder
+    config.settings.instrumentation = False
+    recorder.reset()
+
+
+def test_disabled_passthrough():
+    obj = object()
+    assert instrumentation.instrument(obj) is obj
+    assert instrumentation.track('test') is instrumentation.track('test')
+
+
+def test_instrument_microscope(enabled, tmpdir):
+    from instamatic.TEMController import Microscope
+    tem = Microscope()
+
+    for i in range(10):
+        tem.getStagePosition()
+
+    with instrumentation.track('block'):
+        tem.getFunctionMode()
+
+    stats = {row['name']: row for row in enabled.summary()}
+    row = stats['SimuMicroscope.getStagePosition']
+    assert row['count'] == 10
+    assert row['min_ms'] <= row['p50_ms'] <= row['p99_ms'] <= row['max_ms']
+    assert stats['block']['count'] == 1
+
+    assert 'SimuMicroscope.getStagePosition' in enabled.stats_table()
+
+    stem = enabled.dump(drc=tmpdir)
+    trace = json.load(open(stem.with_name(stem.name + '_trace.json')))
+    assert len(trace['traceEvents']) == 12
+
+
+def test_percentiles():
+    stats = instrumentation.CallStats('test')
+    for duration in (0.001, 0.002, 0.003, 0.100):
+        stats.add(duration)
+    assert stats.percentile(50) == pytest.approx(0.002, rel=0.05)
+    assert stats.percentile(99) == pytest.approx(0.100, rel=0.05)
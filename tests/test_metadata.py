@@ -0,0 +1,48 @@
+import numpy as np
+import yaml
+
+from instamatic.utils.metadata import FrameMetadata
+
+
+def test_frame_metadata(tmp_path):
+    meta = FrameMetadata(capacity=2)
+    headers = {}
+    for i in range(1, 6):
+        h = {
+            'ImageGetTime': 1600000000.0 + i,
+            'ImageExposureTime': 0.5,
+            'ImageBinsize': 1,
+            'ImageResolution': (516, 516),
+            'ImageComment': '',
+            'StagePosition': {'x': i, 'y': 0},
+        }
+        if i == 3:
+            h['ImageBinsize'] = 1.5     # int -> float
+            h['ImageResolution'] = 'unknown'  # -> object
+            h['extra'] = [1, 2]
+        meta.append(i, h)
+        headers[i] = h
+
+    assert len(meta) == 5
+    np.testing.assert_array_equal(meta.frames, [1, 2, 3, 4, 5])
+    np.testing.assert_array_equal(meta['ImageGetTime'], 1600000000.0 + np.arange(1, 6))
+    np.testing.assert_array_equal(meta['ImageBinsize'], [1, 1, 1.5, 1, 1])
+    np.testing.assert_array_equal(meta.present('extra'), [False, False, True, False, False])
+
+    for i, h in headers.items():
+        assert dict(meta.headers[i]) == h
+    assert meta.headers[1]['ImageResolution'] == (516, 516)
+    assert yaml.dump(dict(meta.headers[1])) == yaml.dump(dict(headers[1], ImageBinsize=1.0))
+
+    meta.headers[2]['beam_center'] = (257.5, 258.0)
+    assert meta.headers[2]['beam_center'] == (257.5, 258.0)
+    assert 'beam_center' not in meta.headers[1]
+    meta['beam_center'] = np.arange(10.0).reshape(5, 2)
+    assert meta.headers[5]['beam_center'] == (8.0, 9.0)
+
+    fn = tmp_path / 'frame_metadata.npz'
+    meta.save(fn)
+    loaded = FrameMetadata.load(fn)
+    assert loaded.columns == meta.columns
+    for i in headers:
+        assert dict(loaded.headers[i]) == dict(meta.headers[i])
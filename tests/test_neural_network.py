@@ -0,0 +1,95 @@
+import numpy as np
+
+from instamatic.neural_network import neural_network
+from instamatic.neural_network import predict
+from instamatic.neural_network import predict_batch
+from instamatic.neural_network import preprocess
+from instamatic.neural_network.preprocess import area_average_operator
+from instamatic.neural_network.preprocess import find_beam_centers
+from instamatic.neural_network.preprocess import preprocess_batch
+
+
+def conv_layer_loop(in_layer, weight, offset):
+    """Reference implementation of the convolution."""
+    first_layer = np.ones([(in_layer.shape[0] - 2) * (in_layer.shape[1] - 2), in_layer.shape[2], 3, 3])
+    q = 0
+    for n in range(in_layer.shape[0] - 2):
+        for p in range(in_layer.shape[1] - 2):
+            first_layer[q] = np.transpose(in_layer[n:n + 3, p:p + 3], [2, 0, 1])
+            q += 1
+    convoluted = np.tensordot(first_layer, weight, axes=(((2, 3, 1), (0, 1, 2))))
+    convoluted_reshaped = convoluted.reshape([in_layer.shape[0] - 2, in_layer.shape[1] - 2, 64])
+    convoluted_reshaped += offset
+    return convoluted_reshaped
+
+
+def max_pooling_loop(convoluted):
+    """Reference implementation of the max pooling."""
+    pooled = np.ones((convoluted.shape[0] // 2, convoluted.shape[1] // 2, convoluted.shape[2]))
+    for n in range(convoluted.shape[0] // 2):
+        for p in range(convoluted.shape[1] // 2):
+            pooled[n, p] = np.amax(convoluted[n * 2:n * 2 + 2, p * 2:p * 2 + 2], axis=(0, 1))
+    return pooled
+
+
+def test_layers():
+    weights = neural_network.weights
+    rng = np.random.default_rng(0)
+
+    x = rng.random((37, 37, 1))
+    expected = conv_layer_loop(x, weights[0], weights[1])
+    np.testing.assert_array_equal(neural_network.conv_layer(x, weights[0], weights[1]), expected)
+    np.testing.assert_array_equal(neural_network.max_pooling(expected), max_pooling_loop(expected))
+
+    x = rng.random((17, 17, 64))
+    expected = conv_layer_loop(x, weights[2], weights[3])
+    np.testing.assert_array_equal(neural_network.conv_layer(x, weights[2], weights[3]), expected)
+    np.testing.assert_array_equal(neural_network.max_pooling(expected), max_pooling_loop(expected))
+
+
+def test_predict_batch():
+    rng = np.random.default_rng(0)
+    images = rng.random((3, 150, 150, 1)) * 0.01
+    scores = predict_batch(images, chunksize=2)
+    assert scores.shape == (3,)
+    np.testing.assert_allclose(scores, [predict(image) for image in images], rtol=1e-12)
+
+
+def make_pattern(center, shape=(516, 516)):
+    rng = np.random.default_rng(0)
+    yy, xx = np.indices(shape)
+    img = rng.poisson(5, shape).astype(float)
+    img += 5000 * np.exp(-((yy - center[0])**2 + (xx - center[1])**2) / 50)
+    return img
+
+
+def test_area_average_operator():
+    op = area_average_operator(400, 150)
+    assert op.shape == (150, 400)
+    np.testing.assert_allclose(op.sum(axis=1), 1)
+    np.testing.assert_allclose(op @ np.ones(400), 1)
+    np.testing.assert_allclose(area_average_operator(8, 8), np.eye(8))
+    np.testing.assert_allclose(area_average_operator(8, 4) @ np.arange(8), [0.5, 2.5, 4.5, 6.5])
+
+
+def test_preprocess_batch():
+    stack = np.array([make_pattern((258, 258)), make_pattern((100, 400)), make_pattern((20, 500), shape=(516, 516))])
+
+    for frame, center in zip(stack, find_beam_centers(stack)):
+        x, y = np.where(frame > frame.max() * 0.99)
+        assert tuple(center) == (int(np.mean(x)), int(np.mean(y)))
+
+    processed = preprocess_batch(stack)
+    assert processed.shape == (3, 150, 150, 1)
+    assert processed.dtype == np.float32
+    assert processed.flags['C_CONTIGUOUS']
+    assert processed.min() >= 0 and processed.max() <= 1
+
+    # stream of frames, in chunks
+    np.testing.assert_array_equal(preprocess_batch(iter(stack), chunksize=2), processed)
+
+    # other detector size
+    assert preprocess_batch(make_pattern((300, 300), shape=(1024, 1024))).shape == (1, 150, 150, 1)
+
+    expected = preprocess(stack[0])
+    assert np.corrcoef(expected.ravel(), processed[0].ravel())[0, 1] > 0.99
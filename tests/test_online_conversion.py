@@ -0,0 +1,58 @@
+import numpy as np
+
+from instamatic.formats import read_tiff
+from instamatic.processing.ImgConversionTPX import ImgConversionTPX
+from instamatic.processing.online_conversion import OnlineConversion
+
+
+def make_buffer(n=6, shape=(64, 64)):
+    rng = np.random.default_rng(0)
+    buffer = []
+    for i in range(1, n + 1):
+        img = rng.poisson(10, shape).astype(np.uint16)
+        img[30:34, 28 + i:32 + i] += 1000
+        buffer.append((i, img, {'ImageGetTime': 1600000000.0 + i, 'ImageExposureTime': 0.5}))
+    return buffer
+
+
+def make_img_conv(buffer, **kwargs):
+    return ImgConversionTPX(buffer,
+                            osc_angle=0.5,
+                            start_angle=-10,
+                            end_angle=-7,
+                            rotation_axis=0.5,
+                            acquisition_time=0.5,
+                            flatfield=None,
+                            pixelsize=0.01,
+                            physical_pixelsize=0.055,
+                            wavelength=0.0251,
+                            **kwargs)
+
+
+def test_online_conversion(tmp_path):
+    online, offline = tmp_path / 'online', tmp_path / 'offline'
+
+    conv = OnlineConversion(tiff_path=online / 'tiff', smv_path=online / 'SMV', mrc_path=online / 'RED', workers=2, maxsize=2)
+    for i, img, h in make_buffer():
+        conv.submit(i, img, h)
+    conv.join()
+    assert len(conv.filenames) == 3 * 6
+
+    img_conv = make_img_conv(make_buffer(), beam_centers=conv.beam_centers)
+    img_conv.update_smv_headers(online / 'SMV')
+
+    reference = make_img_conv(make_buffer())
+    reference.threadpoolwriter(tiff_path=offline / 'tiff', smv_path=offline / 'SMV', mrc_path=offline / 'RED', workers=2)
+    np.testing.assert_array_equal(img_conv.mean_beam_center, reference.mean_beam_center)
+
+    for i in range(1, 7):
+        fn = f'{i:05d}'
+        for subdrc, ext in (('SMV/data', 'img'), ('RED', 'mrc')):
+            assert (online / subdrc / f'{fn}.{ext}').read_bytes() == (offline / subdrc / f'{fn}.{ext}').read_bytes()
+        img, h = read_tiff(online / 'tiff' / f'{fn}.tiff')
+        ref, ref_h = read_tiff(offline / 'tiff' / f'{fn}.tiff')
+        np.testing.assert_array_equal(img, ref)
+        np.testing.assert_allclose(h['beam_center'], ref_h['beam_center'])
+
+    conv.discard()
+    assert not list((online / 'tiff').iterdir())
@@ -0,0 +1,72 @@
+import threading
+
+import numpy as np
+import pytest
+
+from instamatic.exceptions import TEMValueError
+from instamatic.utils import recording
+
+
+class Dummy:
+    name = 'dummy'
+
+    def __init__(self):
+        self.i = 0
+        self.lock = threading.Lock()
+
+    def get_value(self):
+        self.i += 1
+        return self.i
+
+    def get_frame(self):
+        return np.full((8, 8), self.i)
+
+    def fail(self):
+        raise TEMValueError('fail')
+
+
+def test_record_replay(tmpdir):
+    fn = tmpdir / 'session.bin'
+    writer = recording.SessionWriter(fn)
+    obj = recording.RecordingProxy(Dummy(), target='tem', writer=writer)
+
+    assert obj.name == 'dummy'
+    assert obj.lock is not None  # cannot be pickled, must not raise
+    values = [obj.get_value() for i in range(3)]
+    frame = obj.get_frame()
+    with pytest.raises(TEMValueError):
+        obj.fail()
+    writer.close()
+
+    records = recording.read_session(fn)
+    assert len(records) == 7
+    assert isinstance(records[1][-1], recording.Unpicklable)
+    assert isinstance(records[5][-1], recording.FrameRef)
+
+    replay = recording.SessionReplay(fn, target='tem')
+    assert [replay.call('get_value') for i in range(3)] == values
+    assert replay.call('get_value') == values[-1]  # repeats last value
+    assert np.all(replay.call('get_frame') == frame)
+    assert replay.is_attribute('name')
+    with pytest.raises(TEMValueError):
+        replay.call('fail')
+    with pytest.raises(AttributeError):
+        replay.call('missing')
+    replay.close()
+
+
+def test_replay_microscope(tmpdir):
+    from instamatic.TEMController.simu_microscope import SimuMicroscope
+    from instamatic.TEMController.replay_microscope import ReplayMicroscope
+
+    fn = tmpdir / 'session.bin'
+    writer = recording.SessionWriter(fn)
+    tem = recording.RecordingProxy(SimuMicroscope(), target='tem', writer=writer)
+    pos = tem.getStagePosition()
+    mode = tem.getFunctionMode()
+    writer.close()
+
+    tem = ReplayMicroscope(fn=fn)
+    assert tem.getStagePosition() == pos
+    assert tem.getFunctionMode() == mode
+    assert not hasattr(tem, 'getBeamShift')
@@ -0,0 +1,42 @@
+import numpy as np
+
+from instamatic.experiments.serialed.scan_planner import ScanPlanner
+
+
+def make_overview(particles, shape=(200, 200), radius=4):
+    rng = np.random.default_rng(0)
+    img = 1000 + rng.normal(0, 10, shape)
+    yy, xx = np.indices(shape)
+    for y, x in particles:
+        img[(yy - y) ** 2 + (xx - x) ** 2 < radius ** 2] -= 400
+    return img
+
+
+def test_scan_planner():
+    # 5x5 cells of 20 um, overview at 1 um/px centered on the grid
+    box = 20_000
+    xx, yy = np.meshgrid(np.arange(-2, 3), np.arange(-2, 3))
+    positions = np.stack((xx.ravel(), yy.ravel()), axis=1) * box
+
+    # particles in two cells only, 3 in cell (1, 1) and 1 in cell (-1, 0)
+    particles = [(125, 125), (114, 114), (114, 126), (80, 100)]
+    img = make_overview(particles)
+
+    planner = ScanPlanner(positions, box=(box, box), t_image=10, t_crystal=60)
+    planner.estimate([img], stagecoords=[(0, 0)], stagematrix=np.eye(2) * 1000, processes=1)
+
+    dense = int(np.argmin(np.linalg.norm(positions - (box, box), axis=1)))
+    sparse = int(np.argmin(np.linalg.norm(positions - (-box, 0), axis=1)))
+    assert planner.prior[dense] > planner.prior[sparse] > 0
+    assert np.nansum(planner.prior) == planner.prior[dense] + planner.prior[sparse]
+
+    order = planner.plan(start=(0, 0))
+    assert order == [dense, sparse]  # empty cells are skipped
+
+    assert planner.next((0, 0)) == dense
+    planner.update(dense, 0)  # the detector overestimates
+    assert planner.scale < 1
+    assert planner.expected[sparse] < planner.prior[sparse]
+
+    report = planner.report(start=(0, 0))
+    assert 'Uniform grid' in report and 'Adaptive' in report
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from instamatic.processing.spot_finder import SpotFinder
+from instamatic.processing.spot_finder import SpotMonitor
+
+
+def make_pattern(rng, n_spots=40, shape=(516, 516), center=(258, 258)):
+    """Poisson noise on a direct beam with diffuse scattering and
+    gaussian spots."""
+    yy, xx = np.indices(shape)
+    r = np.hypot(yy - center[0], xx - center[1])
+    lam = 20 + 3000 * np.exp(-r / 8) + 200 * np.exp(-r / 60)
+    positions = rng.uniform(40, shape[0] - 40, (n_spots, 2))
+    for y, x in positions:
+        lam = lam + 300 * np.exp(-((yy - y)**2 + (xx - x)**2) / (2 * 1.2**2))
+    return rng.poisson(lam).astype(np.uint16), positions
+
+
+def test_spot_finder():
+    rng = np.random.default_rng(1)
+    img, positions = make_pattern(rng)
+
+    finder = SpotFinder(pixelsize=0.005)
+    spots = finder.find_spots(img)
+    assert len(spots) == len(positions)
+
+    found = np.stack((spots['x'], spots['y']), axis=1)
+    dist = np.linalg.norm(found[:, None] - positions[None], axis=-1)
+    assert dist.min(axis=1).max() < 0.5
+    assert np.all(spots['i_sigma'] > 3)
+
+    quality = finder(img)
+    assert quality.n_spots == len(positions)
+    assert quality.d_min == finder.estimate_resolution(spots)
+    assert 0.5 < quality.d_min < 2
+
+    empty, _ = make_pattern(rng, n_spots=0)
+    quality = finder(empty)
+    assert quality.n_spots == 0
+    assert np.isnan(quality.d_min)
+
+
+def test_spot_monitor(tmp_path):
+    rng = np.random.default_rng(2)
+    monitor = SpotMonitor(SpotFinder(), maxsize=100, history=5)
+    for i in range(1, 4):
+        monitor.submit(i, make_pattern(rng, n_spots=10)[0])
+    for i in range(4, 7):
+        monitor.submit(i, make_pattern(rng, n_spots=0)[0])
+    results = monitor.stop()
+
+    assert [results[i].n_spots for i in range(1, 7)] == [10, 10, 10, 0, 0, 0]
+    assert monitor.is_dead(window=3)
+    assert not monitor.is_dead(window=4)
+    # only the last `history` results are kept for the window
+    assert [i for i, quality in monitor.latest(10)] == [2, 3, 4, 5, 6]
+    with pytest.raises(ValueError):
+        monitor.is_dead(window=6)
+
+    monitor.write(tmp_path / 'spot_statistics.txt')
+    arr = np.loadtxt(tmp_path / 'spot_statistics.txt')
+    assert arr.shape == (6, 4)
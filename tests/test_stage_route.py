@@ -0,0 +1,30 @@
+import numpy as np
+
+from instamatic.utils.stage_route import plan_route
+from instamatic.utils.stage_route import StageCostModel
+
+
+def test_cost_model_backlash():
+    model = StageCostModel(speed=(10_000, 10_000, 1_000), overhead=0.0, step=10_000, settle_delay=0.0)
+
+    # positive moves go directly, others overshoot to (x - step, y - step)
+    assert model.cost_matrix((0, 0), (10_000, 5_000))[0, 0] == 1.0
+    assert model.cost_matrix((10_000, 5_000), (0, 0))[0, 0] == 3.0
+    assert model.cost_matrix((0, 0, 0), (10_000, 0, 1_000))[0, 0] == 2.0
+
+
+def test_plan_route():
+    rng = np.random.default_rng(0)
+    positions = rng.uniform(-500_000, 500_000, size=(60, 2))
+    model = StageCostModel()
+
+    route = plan_route(positions, model=model, start=(0, 0, 0))
+
+    assert sorted(route.order) == list(range(len(positions)))
+    assert route.time < route.original_time
+    assert np.isclose(route.time, model.route_time(positions, route.order, start=(0, 0)))
+
+    # points on a line are visited in the positive direction
+    line = [(x, 0) for x in (30_000, 10_000, 20_000, 0)]
+    route = plan_route(line, model=model, start=(-10_000, 0))
+    assert list(route.order) == [3, 1, 2, 0]
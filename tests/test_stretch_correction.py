@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from instamatic.processing.stretch_correction import apply_stretch_correction
+from instamatic.processing.stretch_correction import StretchCorrector
+
+
+@pytest.mark.parametrize('center', (None, (30.3, 35.7)))
+def test_stretch_corrector(center):
+    rng = np.random.default_rng(0)
+    img = rng.random((64, 70)) * 1000
+    azimuth, amplitude = 30, 2.5
+
+    expected = apply_stretch_correction(img, center=center, azimuth=azimuth, amplitude=amplitude)
+    corrector = StretchCorrector(azimuth, amplitude, tolerance=0)
+    np.testing.assert_allclose(corrector(img, center=center), expected)
+
+    stack = np.array([img, img])
+    out = corrector.correct_stack(stack, centers=center)
+    np.testing.assert_allclose(out[1], expected)
+
+    # in place, integer data
+    stack = stack.astype(np.uint16)
+    corrector.correct_stack(stack, centers=center, out=stack)
+    expected = apply_stretch_correction(img.astype(np.uint16), center=center, azimuth=azimuth, amplitude=amplitude)
+    assert stack.dtype == np.uint16
+    np.testing.assert_allclose(stack[0], expected, atol=1)
+
+
+def test_stretch_corrector_center_rounding():
+    yy, xx = np.indices((64, 64))
+    img = np.exp(-((yy - 32)**2 + (xx - 30)**2) / 200)
+
+    corrector = StretchCorrector(30, 2.5, tolerance=0.01)
+    operator = corrector.get_operator(img.shape, (32.0, 32.0))
+    assert corrector.get_operator(img.shape, (32.05, 31.98)) is operator
+
+    # the error in the source coordinates is at most `tolerance`
+    expected = apply_stretch_correction(img, center=(32.05, 31.98), azimuth=30, amplitude=2.5)
+    result = corrector(img, center=(32.05, 31.98))
+    np.testing.assert_allclose(result[2:-2, 2:-2], expected[2:-2, 2:-2], atol=0.01)
@@ -0,0 +1,39 @@
+import time
+
+import numpy as np
+
+from instamatic.utils.telemetry import TelemetrySampler
+
+
+def test_telemetry(tmpdir):
+    counter = iter(range(10_000))
+    fn = tmpdir / 'telemetry.h5'
+
+    sampler = TelemetrySampler({'count': lambda: next(counter),
+                                'vector': lambda: (1, 2, 3)},
+                               rate=200, capacity=50, chunk=16, out=fn)
+    sampler.start()
+    time.sleep(0.5)
+    data = sampler.stop()
+
+    assert len(data) == min(sampler.n_samples, 50)
+    assert data['vector'].shape == (len(data), 3)
+    assert np.all(np.diff(data['t']) > 0)
+    assert np.all(np.diff(data['count']) == 1)
+
+    import h5py
+    with h5py.File(fn, 'r') as f:
+        stored = f['telemetry'][:]
+    assert len(stored) == sampler.n_samples
+    assert np.all(stored['count'][-len(data):] == data['count'])
+
+
+def test_trace_variable():
+    from instamatic.TEMController.microscope_client import TraceVariable
+
+    t = TraceVariable(lambda: 1.0, interval=0.05)
+    t.start()
+    time.sleep(0.2)
+    values = t.stop()
+    assert len(values) >= 2
+    assert values[0][1] == 1.0